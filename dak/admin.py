@@ -268,6 +268,7 @@ def component_rm(name):
         session.rollback()
     else:
         session.commit()
+        clear_lookup_cache()
 
 def component_rename(oldname, newname):
     session = DBConn().session()
@@ -279,6 +280,7 @@ def component_rename(oldname, newname):
         session.rollback()
     else:
         session.commit()
+        clear_lookup_cache()
 
 def component(command):
     mode = command[1]
@@ -383,6 +385,7 @@ def __suite_rm(d, args):
                 die("E: Cannot find suite {0}".format(name))
             s.delete(su)
             s.commit()
+            clear_lookup_cache()
         except IntegrityError as e:
             die("E: Integrity error removing suite {0} (suite-arch entries probably still exist)".format(name))
         except SQLAlchemyError as e:
@@ -31,6 +31,7 @@
 ################################################################################
 
 import commands
+import errno
 import os
 import stat
 import sys
@@ -38,11 +39,20 @@ import time
 import apt_pkg
 import apt_inst
 
+from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS
 from daklib.dbconn import *
+from daklib.hashcache import hash_fh
 from daklib import utils
 from daklib.config import Config
 from daklib.dak_exceptions import InvalidDscError, ChangesUnicodeError, CantOpenError
 
+from sqlalchemy.sql import text as sql_text
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
 ################################################################################
 
 db_files = {}                  #: Cache of filenames as known by the database
@@ -60,6 +70,14 @@ Run various sanity checks of the archive and/or database.
 
   -h, --help                show this help and exit.
 
+Options for the checksums and files modes:
+  -j, --jobs=N              use N processes
+
+Options for the checksums mode:
+  -m, --max-age=DAYS        only check files not verified in the last DAYS days
+  -l, --limit=N             check at most N files
+  -r, --rate=MB             read at most MB megabytes per second
+
 The following MODEs are available:
 
   checksums          - validate the checksums stored in the database
@@ -104,10 +122,110 @@ def process_dir (unused, dirname, filenames):
 
 ################################################################################
 
+def _sorted_entries(directory):
+    """
+    List a directory in the order used by L{_walk_sorted}
+
+    @rtype:  list of tuples
+    @return: (name, is_dir, is_symlink) for each entry; symlinks to
+             directories are not reported as directories
+    """
+    entries = []
+    try:
+        if scandir is not None:
+            for entry in scandir(directory):
+                is_symlink = entry.is_symlink()
+                entries.append((entry.name, not is_symlink and entry.is_dir(), is_symlink))
+        else:
+            for name in os.listdir(directory):
+                st = os.lstat(os.path.join(directory, name))
+                entries.append((name, stat.S_ISDIR(st.st_mode), stat.S_ISLNK(st.st_mode)))
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+    # directories sort as "name/" so the full paths are in byte order
+    entries.sort(key=lambda e: e[0] + '/' if e[1] else e[0])
+    return entries
+
+def _walk_sorted(top, relative=''):
+    """
+    Yield (path relative to C{top}, is_symlink) for all files below C{top}
+    in byte order of the relative path, without keeping more than one
+    directory listing per level in memory.
+    """
+    for name, is_dir, is_symlink in _sorted_entries(os.path.join(top, relative)):
+        path = os.path.join(relative, name)
+        if is_dir:
+            for entry in _walk_sorted(top, path):
+                yield entry
+        elif not is_symlink or not os.path.isdir(os.path.join(top, path)):
+            yield (path, is_symlink)
+
+def check_pool_prefix(archive_id, archive_name, top, component, prefix):
+    """
+    Compare the files in one prefix directory of the pool with the database
+
+    Files expected by the database are streamed in the same order as
+    L{_walk_sorted} lists the directory and both are compared in a single
+    merge pass. If C{prefix} is C{None}, only files directly in the
+    component directory are compared.
+
+    @return: (PROC_STATUS_SUCCESS, list of messages)
+    """
+    messages = []
+    session = DBConn().session()
+    sql = """
+        SELECT f.filename
+          FROM files_archive_map af
+          JOIN component c ON af.component_id = c.id
+          JOIN files f ON af.file_id = f.id
+         WHERE af.archive_id = :archive_id AND c.component_name = :component"""
+    params = {'archive_id': archive_id, 'component': component}
+    if prefix is None:
+        sql += " AND strpos(f.filename, '/') = 0"
+    else:
+        sql += " AND f.filename LIKE :pattern"
+        params['pattern'] = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+    sql += ' ORDER BY f.filename COLLATE "C"'
+    connection = session.connection().execution_options(stream_results = True)
+    expected = ( row[0] for row in connection.execute(sql_text(sql), **params) )
+
+    component_dir = os.path.join(top, component)
+    if prefix is None:
+        found = ( (name, is_symlink) for name, is_dir, is_symlink in _sorted_entries(component_dir)
+                  if not is_dir and not (is_symlink and os.path.isdir(os.path.join(component_dir, name))) )
+    else:
+        found = _walk_sorted(component_dir, prefix)
+
+    db_filename = next(expected, None)
+    fs_entry = next(found, None)
+    while db_filename is not None or fs_entry is not None:
+        if fs_entry is None or (db_filename is not None and db_filename < fs_entry[0]):
+            messages.append("MISSING-FILE {0} {1} {2}".format(archive_name, db_filename, os.path.join(component_dir, db_filename)))
+            db_filename = next(expected, None)
+        elif db_filename is None or fs_entry[0] < db_filename:
+            messages.append("UNEXPECTED-FILE {0} {1}".format(archive_name, os.path.join(component_dir, fs_entry[0])))
+            fs_entry = next(found, None)
+        else:
+            path = os.path.join(component_dir, db_filename)
+            # dangling symlinks do not count as existing
+            if fs_entry[1] and not os.path.exists(path):
+                messages.append("MISSING-FILE {0} {1} {2}".format(archive_name, db_filename, path))
+            db_filename = next(expected, None)
+            fs_entry = next(found, None)
+
+    session.close()
+    return (PROC_STATUS_SUCCESS, messages)
+
 def check_files():
     """
-    Prepare the dictionary of existing filenames, then walk through the archive
-    pool/ directory to compare it.
+    Check for files missing from archives or the pool, then compare the pool
+    directories with the database.
+
+    Files listed in the database and the directory listings are both sorted
+    by path and compared as a merge join, so no per-file stat() calls are
+    needed and memory usage does not grow with the size of the archive.
     """
     cnf = Config()
     session = DBConn().session()
@@ -143,27 +261,47 @@ def check_files():
     for row in session.execute(query):
         print "MISSING-ARCHIVE-FILE {0} {1} {2}".vformat(row)
 
-    archive_files = session.query(ArchiveFile) \
-        .join(ArchiveFile.archive).join(ArchiveFile.file) \
-        .order_by(Archive.archive_name, PoolFile.filename)
-
-    expected_files = set()
-    for af in archive_files:
-        path = af.path
-        expected_files.add(af.path)
-        if not os.path.exists(path):
-            print "MISSING-FILE {0} {1} {2}".format(af.archive.archive_name, af.file.filename, path)
-
-    archives = session.query(Archive).order_by(Archive.archive_name)
-
-    for a in archives:
-        top = os.path.join(a.path, 'pool')
-        for dirpath, dirnames, filenames in os.walk(top):
-            for fn in filenames:
-                path = os.path.join(dirpath, fn)
-                if path in expected_files:
-                    continue
-                print "UNEXPECTED-FILE {0} {1}".format(a.archive_name, path)
+    # Split the pool into prefix directories like pool/main/h/ and compare
+    # each with the database in a worker process
+    units = []
+    for archive_id, archive_name, archive_path in session.execute(
+            "SELECT id, name, path FROM archive ORDER BY name"):
+        top = os.path.join(archive_path, 'pool')
+        prefixes = set()
+        for component, prefix in session.execute(
+                """SELECT DISTINCT c.component_name,
+                          CASE WHEN strpos(f.filename, '/') > 0 THEN split_part(f.filename, '/', 1) END
+                     FROM files_archive_map af
+                     JOIN component c ON af.component_id = c.id
+                     JOIN files f ON af.file_id = f.id
+                    WHERE af.archive_id = :archive_id""", {'archive_id': archive_id}):
+            prefixes.add((component, prefix))
+        for name, is_dir, is_symlink in _sorted_entries(top):
+            if not is_dir:
+                if not is_symlink or not os.path.isdir(os.path.join(top, name)):
+                    print "UNEXPECTED-FILE {0} {1}".format(archive_name, os.path.join(top, name))
+                continue
+            prefixes.add((name, None))
+            for prefix, prefix_is_dir, prefix_is_symlink in _sorted_entries(os.path.join(top, name)):
+                if prefix_is_dir:
+                    prefixes.add((name, prefix))
+        for component, prefix in sorted(prefixes):
+            units.append((archive_id, archive_name, top, component, prefix))
+    session.close()
+
+    jobs = int(cnf["Check-Archive::Options::Jobs"] or 1)
+    pool = DakProcessPool(jobs)
+    for unit in units:
+        pool.apply_async(check_pool_prefix, unit)
+    pool.close()
+    pool.join()
+
+    for status, messages in pool.results:
+        if status != PROC_STATUS_SUCCESS:
+            utils.warn("checking pool failed: %s" % (messages,))
+            continue
+        for message in messages:
+            print message
 
 ################################################################################
 
@@ -265,41 +403,159 @@ def check_source_in_one_dir():
     print "Found %d source packages where the source is not all in one directory." % (broken_count)
 
 ################################################################################
+class Throttle(object):
+    """limit the read rate of file objects to C{rate} bytes per second"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.time()
+        self.count = 0
+
+    def wrap(self, fh):
+        throttle = self
+        class ThrottledFile(object):
+            def read(self, size=-1):
+                data = fh.read(size)
+                throttle.wait(len(data))
+                return data
+        return ThrottledFile()
+
+    def wait(self, count):
+        self.count += count
+        delay = self.count / float(self.rate) - (time.time() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+def verify_checksums(files, rate=None):
+    """
+    Verify size and checksums of files, reading each file only once
+
+    @type  files: list of tuples
+    @param files: (file_id, filename, size, md5sum, sha1sum, sha256sum)
+
+    @type  rate: int
+    @param rate: maximum number of bytes to read per second
+
+    @return: (PROC_STATUS_SUCCESS, (verified file ids, warnings))
+    """
+    verified = []
+    warnings = []
+    throttle = Throttle(rate) if rate else None
+
+    for file_id, filename, size, md5sum, sha1sum, sha256sum in files:
+        try:
+            fi = open(filename, 'r')
+        except IOError:
+            warnings.append("can't open '%s'." % (filename))
+            continue
+        try:
+            hashes = hash_fh(throttle.wrap(fi) if throttle else fi)
+        finally:
+            fi.close()
+
+        ok = True
+        for name, current, db in (('size', hashes.size, size),
+                                  ('md5sum', hashes.md5sum, md5sum),
+                                  ('sha1sum', hashes.sha1sum, sha1sum),
+                                  ('sha256sum', hashes.sha256sum, sha256sum)):
+            if current != db:
+                warnings.append("**WARNING** %s mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (name, filename, current, db))
+                ok = False
+        if ok:
+            verified.append(file_id)
+
+    return (PROC_STATUS_SUCCESS, (verified, warnings))
+
 def check_checksums():
     """
     Validate all files
-    """
-    print "Getting file information from database..."
-    q = DBConn().session().query(PoolFile)
 
-    print "Checking file checksums & sizes..."
-    for f in q:
-        filename = f.fullpath
+    Files are hashed by a pool of C{--jobs} processes. The time of the last
+    successful verification is stored for each file, so with C{--max-age}
+    only files that were never verified or not within the given number of
+    days are checked. Files are checked oldest verification first and
+    progress is committed after every batch, so an interrupted run
+    continues where it stopped when run again.
+    """
+    cnf = Config()
+    Options = cnf.subtree("Check-Archive::Options")
 
+    def int_option(name):
+        if not Options[name]:
+            return None
         try:
-            fi = utils.open_file(filename)
-        except:
-            utils.warn("can't open '%s'." % (filename))
-            continue
+            return int(Options[name])
+        except ValueError:
+            utils.fubar("--%s must be an integer" % (name.lower()))
+
+    jobs = int_option("Jobs") or 1
+    max_age = int_option("Max-Age")
+    limit = int_option("Limit")
+    rate = int_option("Rate")
+    if rate:
+        # MB/s shared by all workers
+        rate = rate * 1024 * 1024 / jobs
+    batch_size = cnf.find_i("Check-Archive::Checksums::BatchSize", 100)
 
-        size = os.stat(filename)[stat.ST_SIZE]
-        if size != f.filesize:
-            utils.warn("**WARNING** size mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, size, f.filesize))
+    pool = DakProcessPool(jobs)
 
-        md5sum = apt_pkg.md5sum(fi)
-        if md5sum != f.md5sum:
-            utils.warn("**WARNING** md5sum mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, md5sum, f.md5sum))
+    print "Getting file information from database..."
+    session = DBConn().session()
+    query = """
+      SELECT f.id,
+             (SELECT ar.path || '/pool/' || c.component_name || '/' || f.filename
+                FROM files_archive_map af
+                JOIN archive ar ON af.archive_id = ar.id
+                JOIN component c ON af.component_id = c.id
+               WHERE af.file_id = f.id
+               ORDER BY ar.tainted DESC
+               LIMIT 1) AS path,
+             f.size, f.md5sum, f.sha1sum, f.sha256sum
+        FROM files f"""
+    params = {}
+    if max_age is not None:
+        query += " WHERE f.last_verified IS NULL OR f.last_verified < now() - :max_age * interval '1 day'"
+        params['max_age'] = max_age
+    query += " ORDER BY f.last_verified NULLS FIRST, f.id"
+    if limit is not None:
+        query += " LIMIT :limit"
+        params['limit'] = limit
+    files = []
+    for row in session.execute(query, params):
+        if row[1] is None:
+            utils.warn("file id %s is not in any archive." % (row[0]))
+            continue
+        files.append(tuple(row))
+    session.close()
 
-        fi.seek(0)
-        sha1sum = apt_pkg.sha1sum(fi)
-        if sha1sum != f.sha1sum:
-            utils.warn("**WARNING** sha1sum mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, sha1sum, f.sha1sum))
+    print "Checking file checksums & sizes..."
+    counts = { 'verified': 0, 'problems': 0 }
 
-        fi.seek(0)
-        sha256sum = apt_pkg.sha256sum(fi)
-        if sha256sum != f.sha256sum:
-            utils.warn("**WARNING** sha256sum mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, sha256sum, f.sha256sum))
+    results = []
+    for i in range(0, len(files), batch_size):
+        results.append(pool.apply_async(verify_checksums, (files[i:i + batch_size], rate)))
+    pool.close()
 
+    # results are recorded here in the order the batches were queued;
+    # the pool's callbacks run in a helper thread which must not fail
+    session = DBConn().session()
+    for result in results:
+        status, message = result.get()
+        if status != PROC_STATUS_SUCCESS:
+            utils.warn("checksum verification failed: %s" % (message,))
+            continue
+        verified, warnings = message
+        for warning in warnings:
+            utils.warn(warning)
+        counts['verified'] += len(verified)
+        counts['problems'] += len(warnings)
+        if verified:
+            session.execute("UPDATE files SET last_verified = now() WHERE id = ANY(:ids)",
+                            {'ids': verified})
+            session.commit()
+    session.close()
+    pool.join()
+
+    print "Verified %d files, %d problems." % (counts['verified'], counts['problems'])
     print "Done."
 
 ################################################################################
@@ -546,8 +802,12 @@ def main ():
 
     cnf = Config()
 
-    Arguments = [('h',"help","Check-Archive::Options::Help")]
-    for i in [ "help" ]:
+    Arguments = [('h',"help","Check-Archive::Options::Help"),
+                 ('j',"jobs","Check-Archive::Options::Jobs","HasArg"),
+                 ('m',"max-age","Check-Archive::Options::Max-Age","HasArg"),
+                 ('l',"limit","Check-Archive::Options::Limit","HasArg"),
+                 ('r',"rate","Check-Archive::Options::Rate","HasArg")]
+    for i in [ "help", "jobs", "max-age", "limit", "rate" ]:
         if not cnf.has_key("Check-Archive::Options::%s" % (i)):
             cnf["Check-Archive::Options::%s" % (i)] = ""
 
@@ -107,9 +107,9 @@ def process(osuite, affected_suites, originosuite, component, otype, session):
     if ot is None:
         utils.fubar("Type '%s' not recognised. (Valid types are deb, udeb and dsc)" % (otype))
     type_id = ot.overridetype_id
-    dsc_type_id = get_override_type("dsc", session).overridetype_id
+    dsc_type_id = get_override_type_id("dsc", session)
 
-    source_priority_id = get_priority("source", session).priority_id
+    source_priority_id = get_priority_id("source", session)
 
     if otype == "deb" or otype == "udeb":
         packages = {}
@@ -34,12 +34,15 @@
 
 ################################################################################
 
+import errno
+import json
 import os
 import stat
 import sys
 import time
 import apt_pkg
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 
 from daklib.config import Config
 from daklib.dbconn import *
@@ -215,12 +218,184 @@ def clean_binaries(now_date, session):
 
 ########################################
 
-def clean(now_date, archives, max_delete, session):
+def remove_pool_file(filename, dest_filename, use_morgue):
+    """Remove a single file from the pool
+
+    Runs in a worker thread, so errors are returned instead of raised.
+
+    @rtype:  tuple
+    @return: (action, size, message) with action being one of 'missing',
+             'symlink', 'moved', 'removed' or 'error'
+    """
+    try:
+        if not os.path.exists(filename):
+            return ('missing', 0, None)
+        if not os.path.isfile(filename):
+            return ('error', 0, "%s is neither symlink nor file?!" % (filename))
+        if os.path.islink(filename):
+            if not Options["No-Action"]:
+                os.unlink(filename)
+            return ('symlink', 0, None)
+        size = os.stat(filename)[stat.ST_SIZE]
+        if Options["No-Action"]:
+            return ('moved' if use_morgue else 'removed', size, None)
+        if use_morgue:
+            utils.move(filename, dest_filename)
+            return ('moved', size, None)
+        os.unlink(filename)
+        return ('removed', size, None)
+    except (Exception, SystemExit) as e:
+        return ('error', 0, "%s: %s" % (filename, e))
+
+def read_checkpoint(checkpoint):
+    """finish the batch an interrupted run was working on
+
+    Entries for files that are already gone from the pool are removed from
+    the database. Remaining files will be found again as candidates.
+    """
+    try:
+        with open(checkpoint, 'r') as fh:
+            entries = json.load(fh)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+    except ValueError:
+        Logger.log(["ignoring invalid checkpoint", checkpoint])
+        return []
+
+    Logger.log(["resuming from checkpoint", checkpoint, len(entries)])
+    return [ entry for entry in entries if not os.path.lexists(entry['path']) ]
+
+def write_checkpoint(checkpoint, entries):
+    fh = open(checkpoint + '.new', 'w')
+    try:
+        json.dump(entries, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    finally:
+        fh.close()
+    os.rename(checkpoint + '.new', checkpoint)
+
+def delete_archive_files(entries, session):
+    if len(entries) == 0:
+        return
+    session.execute("""DELETE FROM files_archive_map
+                        WHERE file_id = :file_id AND archive_id = :archive_id AND component_id = :component_id""",
+                    [ dict(file_id=e['file_id'], archive_id=e['archive_id'], component_id=e['component_id']) for e in entries ])
+
+def clean_pool(dest, archives, max_delete, session):
+    """Remove files no longer used by their archive from the pool
+
+    Candidates are collected with a single query and processed in batches
+    of C{Clean-Suites::BatchSize} files. Files of a batch are moved to the
+    morgue by C{Clean-Suites::Workers} threads, then the database entries
+    are removed and committed together. The current batch is recorded in
+    the checkpoint file C{Clean-Suites::Checkpoint}, so an interrupted run
+    finishes it when started again.
+
+    @rtype:  tuple
+    @return: (number of files, total size)
+    """
     cnf = Config()
+    batch_size = cnf.find_i("Clean-Suites::BatchSize", 1000)
+    workers = cnf.find_i("Clean-Suites::Workers", 4)
+    checkpoint = cnf.get("Clean-Suites::Checkpoint", os.path.join(cnf["Dir::Lock"], "clean-suites.checkpoint"))
 
     count = 0
     size = 0
 
+    if not Options["No-Action"]:
+        done = read_checkpoint(checkpoint)
+        for entry in done:
+            Logger.log(["delete archive file (resumed)", entry['path']])
+        delete_archive_files(done, session)
+        session.commit()
+        if os.path.exists(checkpoint):
+            os.unlink(checkpoint)
+
+    params = {}
+    query = """
+      SELECT af.file_id, af.archive_id, af.component_id, ar.use_morgue,
+             ar.path || '/pool/' || c.component_name || '/' || f.filename AS path
+        FROM files_archive_map af
+        JOIN archive ar ON af.archive_id = ar.id
+        JOIN archive_delete_date ad ON af.archive_id = ad.archive_id
+        JOIN component c ON af.component_id = c.id
+        JOIN files f ON af.file_id = f.id
+       WHERE af.last_used <= ad.delete_date"""
+    if archives is not None:
+        query += " AND af.archive_id = ANY(:archive_ids)"
+        params['archive_ids'] = [ a.archive_id for a in archives ]
+    query += " ORDER BY af.archive_id, f.filename"
+    if max_delete is not None:
+        query += " LIMIT :max_delete"
+        params['max_delete'] = max_delete
+        Logger.log(["Limiting removals to %d" % max_delete])
+
+    candidates = [ dict(file_id=row[0], archive_id=row[1], component_id=row[2], use_morgue=row[3], path=row[4])
+                   for row in session.execute(query, params) ]
+
+    pool = ThreadPool(workers)
+    try:
+        for start in range(0, len(candidates), batch_size):
+            batch = candidates[start:start + batch_size]
+
+            # Pick destinations here, files with the same name might be in one batch
+            reserved = set()
+            for entry in batch:
+                dest_filename = os.path.join(dest, os.path.basename(entry['path']))
+                extra = 0
+                while dest_filename in reserved or os.path.lexists(dest_filename):
+                    dest_filename = os.path.join(dest, os.path.basename(entry['path'])) + '.' + repr(extra)
+                    extra += 1
+                    if extra >= 100:
+                        raise utils.NoFreeFilenameError
+                reserved.add(dest_filename)
+                entry['dest'] = dest_filename
+
+            if not Options["No-Action"]:
+                write_checkpoint(checkpoint, batch)
+
+            results = pool.map(lambda e: remove_pool_file(e['path'], e['dest'], e['use_morgue']), batch)
+
+            done = []
+            errors = []
+            for entry, (action, file_size, message) in zip(batch, results):
+                filename = entry['path']
+                if action == 'error':
+                    errors.append(message)
+                    continue
+                if action == 'missing':
+                    Logger.log(["database referred to non-existing file", filename])
+                else:
+                    Logger.log(["delete archive file", filename])
+                    count += 1
+                    size += file_size
+                    if action == 'symlink':
+                        Logger.log(["delete symlink", filename])
+                    elif action == 'moved':
+                        Logger.log(["move to morgue", filename, entry['dest']])
+                    else:
+                        Logger.log(["removed file", filename])
+                done.append(entry)
+
+            if not Options["No-Action"]:
+                delete_archive_files(done, session)
+                session.commit()
+                os.unlink(checkpoint)
+
+            if errors:
+                utils.fubar("\n".join(errors))
+    finally:
+        pool.close()
+        pool.join()
+
+    return count, size
+
+def clean(now_date, archives, max_delete, session):
+    cnf = Config()
+
     Logger.log(["Cleaning out packages..."])
 
     morguedir = cnf.get("Dir::Morgue", os.path.join("Dir::Pool", 'morgue'))
@@ -268,51 +443,7 @@ def clean(now_date, archives, max_delete, session):
         session.commit()
 
     # Delete files from the pool
-    old_files = session.query(ArchiveFile).filter('files_archive_map.last_used <= (SELECT delete_date FROM archive_delete_date ad WHERE ad.archive_id = files_archive_map.archive_id)').join(Archive)
-    if max_delete is not None:
-        old_files = old_files.limit(max_delete)
-        Logger.log(["Limiting removals to %d" % max_delete])
-
-    if archives is not None:
-        archive_ids = [ a.archive_id for a in archives ]
-        old_files = old_files.filter(ArchiveFile.archive_id.in_(archive_ids))
-
-    for af in old_files:
-        filename = af.path
-        if not os.path.exists(filename):
-            Logger.log(["database referred to non-existing file", af.path])
-            session.delete(af)
-            continue
-        Logger.log(["delete archive file", filename])
-        if os.path.isfile(filename):
-            if os.path.islink(filename):
-                count += 1
-                Logger.log(["delete symlink", filename])
-                if not Options["No-Action"]:
-                    os.unlink(filename)
-            else:
-                size += os.stat(filename)[stat.ST_SIZE]
-                count += 1
-
-                dest_filename = dest + '/' + os.path.basename(filename)
-                # If the destination file exists; try to find another filename to use
-                if os.path.lexists(dest_filename):
-                    dest_filename = utils.find_next_free(dest_filename)
-
-                if not Options["No-Action"]:
-                    if af.archive.use_morgue:
-                        Logger.log(["move to morgue", filename, dest_filename])
-                        utils.move(filename, dest_filename)
-                    else:
-                        Logger.log(["removed file", filename])
-                        os.unlink(filename)
-
-            if not Options["No-Action"]:
-                session.delete(af)
-                session.commit()
-
-        else:
-            utils.fubar("%s is neither symlink nor file?!" % (filename))
+    count, size = clean_pool(dest, archives, max_delete, session)
 
     if count > 0:
         Logger.log(["total", count, utils.size_type(size)])
@@ -99,7 +99,8 @@ def binary_scan_all(cnf, limit):
     result = BinaryContentsScanner.scan_all(limit)
     processed = '%(processed)d packages processed' % result
     remaining = '%(remaining)d packages remaining' % result
-    Logger.log([processed, remaining])
+    failed = '%(failed)d batches with errors' % result
+    Logger.log([processed, remaining, failed])
     Logger.close()
 
 ################################################################################
@@ -44,8 +44,9 @@
 import sys
 import apt_pkg
 import os
+from StringIO import StringIO
 
-from daklib.archive import ArchiveTransaction
+from daklib.archive import ArchiveTransaction, ArchiveException
 from daklib.config import Config
 from daklib.dbconn import *
 from daklib import daklog
@@ -78,8 +79,10 @@ def get_pkg(package, version, architecture, session):
         q = session.query(DBSource).filter_by(source=package, version=version) \
             .join(DBSource.poolfile)
     else:
+        arch_ids = [arch_id for arch_id in (get_architecture_id(architecture, session), get_architecture_id('all', session))
+                    if arch_id is not None]
         q = session.query(DBBinary).filter_by(package=package, version=version) \
-            .join(DBBinary.architecture).filter(Architecture.arch_string.in_([architecture, 'all'])) \
+            .filter(DBBinary.arch_id.in_(arch_ids)) \
             .join(DBBinary.poolfile)
 
     pkg = q.first()
@@ -170,10 +173,10 @@ def version_checks(package, architecture, target_suite, new_version, session, fo
 
     for suite, version in suite_version_list:
         cmp = apt_pkg.version_compare(new_version, version)
-        if suite in must_be_newer_than and cmp < 1:
+        if suite in must_be_newer_than and cmp <= 0:
             utils.warn("%s (%s): version check violated: %s targeted at %s is *not* newer than %s in %s" % (package, architecture, new_version, target_suite, version, suite))
             violations = True
-        if suite in must_be_older_than and cmp > 1:
+        if suite in must_be_older_than and cmp > 0:
             utils.warn("%s (%s): version check violated: %s targeted at %s is *not* older than %s in %s" % (package, architecture, new_version, target_suite, version, suite))
             violations = True
 
@@ -202,66 +205,273 @@ def cmp_package_version(a, b):
 
 #######################################################################################
 
-def set_suite(file, suite, transaction, britney=False, force=False):
-    session = transaction.session
-    suite_id = suite.suite_id
-    lines = file.readlines()
+def load_desired(lines, session):
+    """Load the desired suite content into the temporary table
+    control_suite_desired and resolve it to source and binary ids.
 
-    # Our session is already in a transaction
-
-    # Build up a dictionary of what is currently in the suite
-    current = {}
-    q = session.execute("""SELECT b.package, b.version, a.arch_string, ba.id
-                             FROM binaries b, bin_associations ba, architecture a
-                            WHERE ba.suite = :suiteid
-                              AND ba.bin = b.id AND b.architecture = a.id""", {'suiteid': suite_id})
-    for i in q:
-        key = i[:3]
-        current[key] = i[3]
-
-    q = session.execute("""SELECT s.source, s.version, 'source', sa.id
-                             FROM source s, src_associations sa
-                            WHERE sa.suite = :suiteid
-                              AND sa.source = s.id""", {'suiteid': suite_id})
-    for i in q:
-        key = i[:3]
-        current[key] = i[3]
-
-    # Build up a dictionary of what should be in the suite
-    desired = set()
+    The table is dropped at the end of the transaction.
+    """
+    rows = StringIO()
+    seen = set()
     for line in lines:
         split_line = line.strip().split()
         if len(split_line) != 3:
             utils.warn("'%s' does not break into 'package version architecture'." % (line[:-1]))
             continue
-        desired.add(tuple(split_line))
+        key = tuple(split_line)
+        if key in seen:
+            continue
+        seen.add(key)
+        rows.write("\t".join(utils.copy_escape(field) for field in key) + "\n")
+    rows.seek(0)
+
+    session.execute("""CREATE TEMPORARY TABLE control_suite_desired (
+                         package TEXT NOT NULL,
+                         version DEBVERSION NOT NULL,
+                         architecture TEXT NOT NULL,
+                         source_id INTEGER,
+                         binary_id INTEGER
+                       ) ON COMMIT DROP""")
+    cursor = session.connection().connection.cursor()
+    cursor.copy_from(rows, 'control_suite_desired', columns=('package', 'version', 'architecture'))
+
+    session.execute("""UPDATE control_suite_desired d SET source_id = s.id
+                         FROM source s
+                        WHERE d.architecture = 'source'
+                          AND s.source = d.package AND s.version = d.version""")
+    session.execute("""UPDATE control_suite_desired d SET binary_id = b.id
+                         FROM (SELECT DISTINCT ON (d.package, d.version, d.architecture)
+                                      d.package, d.version, d.architecture, b.id
+                                 FROM control_suite_desired d
+                                 JOIN binaries b ON b.package = d.package AND b.version = d.version
+                                 JOIN architecture a ON b.architecture = a.id
+                                WHERE a.arch_string IN (d.architecture, 'all')
+                                ORDER BY d.package, d.version, d.architecture, b.id) b
+                        WHERE d.architecture <> 'source'
+                          AND b.package = d.package AND b.version = d.version
+                          AND b.architecture = d.architecture""")
+    session.execute("ANALYZE control_suite_desired")
+
+    q = session.execute("""SELECT package, version, architecture FROM control_suite_desired
+                            WHERE source_id IS NULL AND binary_id IS NULL
+                            ORDER BY package, version, architecture""")
+    for package, version, architecture in q:
+        utils.warn("Could not find {0}_{1}_{2}.".format(package, version, architecture))
 
-    # Check to see which packages need added and add them
-    for key in sorted(desired, cmp=cmp_package_version):
-        if key not in current:
-            (package, version, architecture) = key
-            version_checks(package, architecture, suite.suite_name, version, session, force)
-            pkg = get_pkg(package, version, architecture, session)
-            if pkg is None:
-                continue
+# Desired packages that are not yet in the suite
+_added_sources_query = """
+    SELECT d.package, d.version, d.architecture, d.source_id
+      FROM control_suite_desired d
+     WHERE d.source_id IS NOT NULL
+       AND NOT EXISTS (SELECT 1 FROM src_associations sa
+                        WHERE sa.suite = :suite_id AND sa.source = d.source_id)"""
+
+_added_binaries_query = """
+    SELECT d.package, d.version, d.architecture, d.binary_id
+      FROM control_suite_desired d
+     WHERE d.binary_id IS NOT NULL
+       AND NOT EXISTS (SELECT 1 FROM bin_associations ba
+                        WHERE ba.suite = :suite_id AND ba.bin = d.binary_id)"""
+
+def bulk_version_checks(suite, session, force=False):
+    """Check the versions of all packages that will be added to C{suite}
+
+    This is the set-based equivalent of calling L{version_checks} for
+    every added package.
+    """
+    q = session.execute("""
+        WITH checks AS (
+               SELECT CAST(:suite_id AS INTEGER) AS reference, 'MustBeNewerThan' AS "check"
+               UNION
+               SELECT reference, "check" FROM version_check
+                WHERE suite = :suite_id AND "check" IN ('MustBeNewerThan', 'MustBeOlderThan')),
+             added AS ({0}
+               UNION ALL
+               {1}),
+             existing AS (
+               SELECT n.package, n.architecture, n.version AS new_version,
+                      s.version, sa.suite
+                 FROM added n
+                 JOIN source s ON s.source = n.package
+                 JOIN src_associations sa ON sa.source = s.id
+                WHERE n.architecture = 'source'
+               UNION ALL
+               SELECT n.package, n.architecture, n.version AS new_version,
+                      b.version, ba.suite
+                 FROM added n
+                 JOIN binaries b ON b.package = n.package
+                 JOIN architecture a ON b.architecture = a.id
+                 JOIN bin_associations ba ON ba.bin = b.id
+                WHERE n.architecture <> 'source'
+                  AND a.arch_string IN (n.architecture, 'all'))
+        SELECT DISTINCT e.package, e.architecture, e.new_version, c."check", e.version, su.suite_name
+          FROM existing e
+          JOIN checks c ON c.reference = e.suite
+          JOIN suite su ON su.id = e.suite
+         WHERE (c."check" = 'MustBeNewerThan' AND e.new_version <= e.version)
+            OR (c."check" = 'MustBeOlderThan' AND e.new_version > e.version)
+         ORDER BY e.package, e.architecture, e.new_version, su.suite_name
+        """.format(_added_sources_query, _added_binaries_query), {'suite_id': suite.suite_id})
 
-            component = pkg.poolfile.component
-            if architecture == "source":
-                transaction.copy_source(pkg, suite, component)
-            else:
-                transaction.copy_binary(pkg, suite, component)
+    violations = False
+    for package, architecture, new_version, check, version, suite_name in q:
+        if check == 'MustBeNewerThan':
+            relation = "newer"
+        else:
+            relation = "older"
+        utils.warn("%s (%s): version check violated: %s targeted at %s is *not* %s than %s in %s" % (package, architecture, new_version, suite.suite_name, relation, version, suite_name))
+        violations = True
 
-            Logger.log(["added", " ".join(key)])
+    if violations:
+        if force:
+            utils.warn("Continuing anyway (forced)...")
+        else:
+            utils.fubar("Aborting. Version checks violated and not forced.")
 
-    # Check to see which packages need removed and remove them
-    for key, pkid in current.iteritems():
-        if key not in desired:
-            (package, version, architecture) = key
-            if architecture == "source":
-                session.execute("""DELETE FROM src_associations WHERE id = :pkid""", {'pkid': pkid})
-            else:
-                session.execute("""DELETE FROM bin_associations WHERE id = :pkid""", {'pkid': pkid})
-            Logger.log(["removed", " ".join(key), pkid])
+def copy_missing_files(transaction, archive, files_query, params, allow_tainted=False, batch_size=1000):
+    """Copy files to C{archive} that are not yet present there
+
+    @type  files_query: str
+    @param files_query: query returning (file_id, component_id) of the files
+                        that have to be present in C{archive}
+    """
+    session = transaction.session
+    params = dict(params, archive_id=archive.archive_id, allow_tainted=allow_tainted)
+    q = session.execute("""
+        WITH needed AS ({0}),
+             missing AS (
+               SELECT DISTINCT n.file_id, n.component_id FROM needed n
+                WHERE NOT EXISTS (SELECT 1 FROM files_archive_map af
+                                   WHERE af.file_id = n.file_id
+                                     AND af.archive_id = :archive_id
+                                     AND af.component_id = n.component_id))
+        SELECT DISTINCT ON (m.file_id, m.component_id)
+               m.file_id, m.component_id, f.filename, c.component_name,
+               src.path AS source_path
+          FROM missing m
+          JOIN files f ON f.id = m.file_id
+          JOIN component c ON c.id = m.component_id
+          LEFT JOIN (SELECT af.file_id, af.archive_id,
+                            ar.path || '/pool/' || c.component_name || '/' || f.filename AS path
+                       FROM files_archive_map af
+                       JOIN archive ar ON af.archive_id = ar.id
+                       JOIN component c ON af.component_id = c.id
+                       JOIN files f ON af.file_id = f.id
+                      WHERE :allow_tainted OR NOT ar.tainted) src
+                 ON src.file_id = m.file_id
+         ORDER BY m.file_id, m.component_id, src.archive_id
+        """.format(files_query), params)
+    missing = q.fetchall()
+
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        for file_id, component_id, filename, component_name, source_path in batch:
+            if source_path is None:
+                raise ArchiveException('cp: Could not find {0} in any archive.'.format(filename))
+        session.execute("""INSERT INTO files_archive_map (file_id, archive_id, component_id)
+                           VALUES (:file_id, :archive_id, :component_id)""",
+                        [ {'file_id': row[0], 'archive_id': archive.archive_id, 'component_id': row[1]} for row in batch ])
+        for file_id, component_id, filename, component_name, source_path in batch:
+            target_path = os.path.join(archive.path, 'pool', component_name, filename)
+            transaction.fs.copy(source_path, target_path, link=False, mode=archive.mode)
+
+def set_suite(file, suite, transaction, britney=False, force=False):
+    """Set the content of C{suite} to the packages listed in C{file}
+
+    The desired content is loaded into a temporary table, so version checks,
+    copying files to the suite's archive and updating the associations are
+    done with a few set-based statements instead of several per package.
+    """
+    session = transaction.session
+    suite_id = suite.suite_id
+    archive = suite.archive
+    allow_tainted = archive.tainted
+    params = {'suite_id': suite_id}
+
+    # Our session is already in a transaction
+
+    # Remember the current source packages for the britney changelog
+    current = {}
+    if britney:
+        q = session.execute("""SELECT s.source, s.version, 'source', sa.id
+                                 FROM source s, src_associations sa
+                                WHERE sa.suite = :suiteid
+                                  AND sa.source = s.id""", {'suiteid': suite_id})
+        for i in q:
+            current[i[:3]] = i[3]
+
+    load_desired(file.readlines(), session)
+
+    added_sources = session.execute(_added_sources_query + " ORDER BY d.package, d.version", params).fetchall()
+    added_binaries = session.execute(_added_binaries_query + " ORDER BY d.package, d.version, d.architecture", params).fetchall()
+
+    if added_sources or added_binaries:
+        bulk_version_checks(suite, session, force)
+
+    # Copy files of added sources, in the component of the .dsc
+    copy_missing_files(transaction, archive, """
+        SELECT df.file AS file_id, dsc_af.component_id
+          FROM ({0}) a
+          JOIN source s ON s.id = a.source_id
+          JOIN (SELECT file_id, min(component_id) AS component_id
+                  FROM files_archive_map GROUP BY file_id) dsc_af ON dsc_af.file_id = s.file
+          JOIN dsc_files df ON df.source = s.id""".format(_added_sources_query),
+        params, allow_tainted=allow_tainted)
+
+    if added_binaries:
+        # Sources and Built-Using sources of added binaries must be present
+        q = session.execute("""
+            SELECT f.filename, s.source, s.version, ref.built_using
+              FROM ({0}) a
+              JOIN binaries b ON b.id = a.binary_id
+              JOIN files f ON f.id = b.file
+              JOIN (SELECT b.id AS bin_id, b.source AS src_id, FALSE AS built_using FROM binaries b
+                    UNION ALL
+                    SELECT bin_id, src_id, TRUE FROM extra_src_references) ref ON ref.bin_id = b.id
+              JOIN source s ON s.id = ref.src_id
+             WHERE NOT EXISTS (SELECT 1 FROM files_archive_map af
+                                WHERE af.file_id = s.file AND af.archive_id = :archive_id)
+             ORDER BY ref.built_using, f.filename
+             LIMIT 1""".format(_added_binaries_query), dict(params, archive_id=archive.archive_id))
+        row = q.fetchone()
+        if row is not None:
+            filename, source, version, built_using = row
+            if built_using:
+                raise ArchiveException('{0}: Built-Using refers to package {1} (= {2}) not in target archive {3}.'.format(filename, source, version, archive.archive_name))
+            raise ArchiveException('{0}: cannot copy to {1}: source is not present in target archive'.format(filename, suite.suite_name))
+
+        copy_missing_files(transaction, archive, """
+            SELECT b.file AS file_id, deb_af.component_id
+              FROM ({0}) a
+              JOIN binaries b ON b.id = a.binary_id
+              JOIN (SELECT file_id, min(component_id) AS component_id
+                      FROM files_archive_map GROUP BY file_id) deb_af ON deb_af.file_id = b.file""".format(_added_binaries_query),
+            params, allow_tainted=allow_tainted)
+
+    # Apply the difference between the current and the desired content
+    session.execute("""INSERT INTO src_associations (suite, source)
+                       SELECT DISTINCT :suite_id, a.source_id FROM ({0}) a""".format(_added_sources_query), params)
+    session.execute("""INSERT INTO bin_associations (suite, bin)
+                       SELECT DISTINCT :suite_id, a.binary_id FROM ({0}) a""".format(_added_binaries_query), params)
+    for package, version, architecture, pkid in added_sources + added_binaries:
+        Logger.log(["added", " ".join((package, version, architecture))])
+
+    q = session.execute("""DELETE FROM src_associations sa
+                            USING source s
+                            WHERE sa.suite = :suite_id AND sa.source = s.id
+                              AND NOT EXISTS (SELECT 1 FROM control_suite_desired d
+                                               WHERE d.source_id = sa.source)
+                        RETURNING s.source, s.version, 'source', sa.id""", params)
+    removed = q.fetchall()
+    q = session.execute("""DELETE FROM bin_associations ba
+                            USING binaries b, architecture a
+                            WHERE ba.suite = :suite_id AND ba.bin = b.id AND b.architecture = a.id
+                              AND NOT EXISTS (SELECT 1 FROM control_suite_desired d
+                                               WHERE d.binary_id = ba.bin)
+                        RETURNING b.package, b.version, a.arch_string, ba.id""", params)
+    removed.extend(q.fetchall())
+    for package, version, architecture, pkid in removed:
+        Logger.log(["removed", " ".join((package, version, architecture)), pkid])
 
     session.commit()
 
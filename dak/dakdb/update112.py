@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""
+Add index_journal table recording which indices need to be regenerated
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@copyright: 2016, Debian FTP Masters
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import psycopg2
+from daklib.dak_exceptions import DBUpdateError
+from daklib.config import Config
+
+statements = [
+"""
+CREATE TABLE index_journal (
+  id SERIAL PRIMARY KEY,
+  suite_id INT NOT NULL REFERENCES suite(id) ON DELETE CASCADE,
+  component_id INT REFERENCES component(id) ON DELETE CASCADE,
+  architecture_id INT REFERENCES architecture(id) ON DELETE CASCADE,
+  created TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+)
+""",
+
+"""
+COMMENT ON TABLE index_journal IS 'Indices touched since they were last generated (NULL component or architecture means all)'
+""",
+
+"""
+CREATE OR REPLACE FUNCTION trigger_index_journal() RETURNS TRIGGER
+SECURITY DEFINER
+SET search_path = public, pg_temp
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_row RECORD;
+BEGIN
+
+  CASE TG_OP
+    WHEN 'INSERT', 'UPDATE' THEN
+      v_row := NEW;
+    WHEN 'DELETE' THEN
+      v_row := OLD;
+    ELSE
+      RAISE EXCEPTION 'Unexpected TG_OP (%)', TG_OP;
+  END CASE;
+
+  CASE TG_TABLE_NAME
+    WHEN 'bin_associations' THEN
+      INSERT INTO index_journal (suite_id, component_id, architecture_id)
+        SELECT DISTINCT v_row.suite, fam.component_id, b.architecture
+          FROM binaries b
+          JOIN suite s ON s.id = v_row.suite
+          LEFT JOIN files_archive_map fam ON fam.file_id = b.file AND fam.archive_id = s.archive_id
+         WHERE b.id = v_row.bin;
+
+    WHEN 'src_associations' THEN
+      INSERT INTO index_journal (suite_id, component_id, architecture_id)
+        SELECT DISTINCT v_row.suite, fam.component_id, (SELECT id FROM architecture WHERE arch_string = 'source')
+          FROM source src
+          JOIN suite s ON s.id = v_row.suite
+          LEFT JOIN files_archive_map fam ON fam.file_id = src.file AND fam.archive_id = s.archive_id
+         WHERE src.id = v_row.source;
+
+    WHEN 'override', 'external_overrides' THEN
+      INSERT INTO index_journal (suite_id, component_id, architecture_id)
+        VALUES (v_row.suite, v_row.component, NULL);
+      IF TG_OP = 'UPDATE' AND (OLD.suite != NEW.suite OR OLD.component != NEW.component) THEN
+        INSERT INTO index_journal (suite_id, component_id, architecture_id)
+          VALUES (OLD.suite, OLD.component, NULL);
+      END IF;
+
+    ELSE
+      RAISE EXCEPTION 'trigger called for invalid table (%)', TG_TABLE_NAME;
+  END CASE;
+
+  RETURN NULL;
+
+END;
+$$
+""",
+
+"""
+CREATE TRIGGER trigger_bin_associations_index_journal
+  AFTER INSERT OR DELETE
+  ON bin_associations
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_index_journal()
+""",
+
+"""
+CREATE TRIGGER trigger_src_associations_index_journal
+  AFTER INSERT OR DELETE
+  ON src_associations
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_index_journal()
+""",
+
+"""
+CREATE TRIGGER trigger_override_index_journal
+  AFTER INSERT OR UPDATE OR DELETE
+  ON override
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_index_journal()
+""",
+
+"""
+CREATE TRIGGER trigger_external_overrides_index_journal
+  AFTER INSERT OR UPDATE OR DELETE
+  ON external_overrides
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_index_journal()
+""",
+]
+
+################################################################################
+def do_update(self):
+    print __doc__
+    try:
+        cnf = Config()
+
+        c = self.db.cursor()
+
+        for stmt in statements:
+            c.execute(stmt)
+
+        c.execute("UPDATE config SET value = '112' WHERE name = 'db_revision'")
+        self.db.commit()
+
+    except psycopg2.ProgrammingError as msg:
+        self.db.rollback()
+        raise DBUpdateError('Unable to apply sick update 112, rollback issued. Error message: {0}'.format(msg))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""
+Add a generation counter bumped by transactions changing the archive
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@copyright: 2016, Debian FTP Masters
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import psycopg2
+from daklib.dak_exceptions import DBUpdateError
+from daklib.config import Config
+
+statements = [
+"""
+CREATE TABLE cache_generation (
+  generation BIGINT NOT NULL,
+  txid BIGINT
+)
+""",
+
+"""
+COMMENT ON TABLE cache_generation IS 'Single row incremented by every transaction changing suite contents (used to invalidate caches)'
+""",
+
+"""
+INSERT INTO cache_generation (generation) VALUES (0)
+""",
+
+"""
+GRANT SELECT ON cache_generation TO PUBLIC
+""",
+
+"""
+CREATE OR REPLACE FUNCTION trigger_cache_generation() RETURNS TRIGGER
+SECURITY DEFINER
+SET search_path = public, pg_temp
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  -- The trigger is deferred and runs for each modified row at commit
+  -- time; only the first one in a transaction increments the counter.
+  -- It is only installed for tables and columns dakweb answers from, so
+  -- e.g. clean-suites updating files_archive_map.last_used does not
+  -- invalidate cached responses.
+  UPDATE cache_generation
+     SET generation = generation + 1, txid = txid_current()
+   WHERE txid IS DISTINCT FROM txid_current();
+  RETURN NULL;
+END;
+$$
+""",
+
+"""
+CREATE CONSTRAINT TRIGGER trigger_architecture_cache_generation
+  AFTER INSERT OR UPDATE OR DELETE
+  ON architecture
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_cache_generation()
+""",
+
+"""
+CREATE CONSTRAINT TRIGGER trigger_archive_cache_generation
+  AFTER INSERT OR UPDATE OR DELETE
+  ON archive
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_cache_generation()
+""",
+
+"""
+CREATE CONSTRAINT TRIGGER trigger_bin_associations_cache_generation
+  AFTER INSERT OR UPDATE OR DELETE
+  ON bin_associations
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_cache_generation()
+""",
+
+"""
+CREATE CONSTRAINT TRIGGER trigger_binaries_cache_generation
+  AFTER INSERT OR UPDATE OR DELETE
+  ON binaries
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_cache_generation()
+""",
+
+"""
+CREATE CONSTRAINT TRIGGER trigger_component_cache_generation
+  AFTER INSERT OR UPDATE OR DELETE
+  ON component
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_cache_generation()
+""",
+
+"""
+CREATE CONSTRAINT TRIGGER trigger_component_suite_cache_generation
+  AFTER INSERT OR UPDATE OR DELETE
+  ON component_suite
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_cache_generation()
+""",
+
+"""
+CREATE CONSTRAINT TRIGGER trigger_files_archive_map_cache_generation
+  AFTER INSERT OR DELETE OR UPDATE OF archive_id, component_id, file_id
+  ON files_archive_map
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_cache_generation()
+""",
+
+"""
+CREATE CONSTRAINT TRIGGER trigger_source_cache_generation
+  AFTER INSERT OR UPDATE OR DELETE
+  ON source
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_cache_generation()
+""",
+
+"""
+CREATE CONSTRAINT TRIGGER trigger_src_associations_cache_generation
+  AFTER INSERT OR UPDATE OR DELETE
+  ON src_associations
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_cache_generation()
+""",
+
+"""
+CREATE CONSTRAINT TRIGGER trigger_suite_cache_generation
+  AFTER INSERT OR UPDATE OR DELETE
+  ON suite
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_cache_generation()
+""",
+
+"""
+CREATE CONSTRAINT TRIGGER trigger_suite_architectures_cache_generation
+  AFTER INSERT OR UPDATE OR DELETE
+  ON suite_architectures
+  DEFERRABLE INITIALLY DEFERRED
+  FOR EACH ROW
+  EXECUTE PROCEDURE trigger_cache_generation()
+""",
+]
+
+################################################################################
+def do_update(self):
+    print __doc__
+    try:
+        cnf = Config()
+
+        c = self.db.cursor()
+
+        for stmt in statements:
+            c.execute(stmt)
+
+        c.execute("UPDATE config SET value = '116' WHERE name = 'db_revision'")
+        self.db.commit()
+
+    except psycopg2.ProgrammingError as msg:
+        self.db.rollback()
+        raise DBUpdateError('Unable to apply sick update 116, rollback issued. Error message: {0}'.format(msg))
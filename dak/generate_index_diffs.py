@@ -33,13 +33,14 @@
 
 import sys
 import os
-import tempfile
 import time
 import apt_pkg
 import glob
 
 from daklib import utils
 from daklib.dbconn import Archive, Component, DBConn, Suite, get_suite, get_suite_architectures
+from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS
+from daklib.pdiff import PdiffError, PdiffHashes, merge_patches, read_patch, write_hunks, write_patch
 #from daklib.regexes import re_includeinpdiff
 import re
 re_includeinpdiff = re.compile(r"(Translation-[a-zA-Z_]+\.(?:bz2|xz))")
@@ -73,98 +74,138 @@ def tryunlink(file):
         print "warning: removing of %s denied" % (file)
 
 def smartstat(file):
-    for ext in ["", ".gz", ".bz2"]:
+    for ext in ["", ".gz", ".bz2", ".xz"]:
         if os.path.isfile(file + ext):
             return (ext, os.stat(file + ext))
     return (None, None)
 
-def smartlink(f, t):
-    if os.path.isfile(f):
-        os.link(f,t)
-    elif os.path.isfile("%s.gz" % (f)):
-        os.system("gzip -d < %s.gz > %s" % (f, t))
-    elif os.path.isfile("%s.bz2" % (f)):
-        os.system("bzip2 -d < %s.bz2 > %s" % (f, t))
-    else:
-        print "missing: %s" % (f)
-        raise IOError(f)
-
-def smartopen(file):
-    if os.path.isfile(file):
-        f = open(file, "r")
-    elif os.path.isfile("%s.gz" % file):
-        f = create_temp_file(os.popen("zcat %s.gz" % file, "r"))
-    elif os.path.isfile("%s.bz2" % file):
-        f = create_temp_file(os.popen("bzcat %s.bz2" % file, "r"))
-    else:
-        f = None
-    return f
-
-def pipe_file(f, t):
-    f.seek(0)
-    while 1:
-        l = f.read()
-        if not l: break
-        t.write(l)
-    t.close()
+# (field name, attribute of PdiffHashes) for the hashes given in Index files
+HASH_FIELDS = [ ("SHA1", "sha1sum"), ("SHA256", "sha256sum") ]
+
+def read_hash_rows(fields, prefix, name):
+    """combine the rows of all <hash>-<name> fields of an Index file
+
+    Returns the names in order and a dict mapping them to PdiffHashes; hashes
+    missing from the Index are None.
+    """
+    order = []
+    rows = {}
+    for hashfield, attribute in HASH_FIELDS:
+        for hashsum, size, patch in fields.get("%s%s-%s" % (prefix, hashfield, name), []):
+            if name == "Download" and patch.endswith(".gz"):
+                patch = patch[:-3]
+            if not rows.has_key(patch):
+                order.append(patch)
+                rows[patch] = dict(size=size, sha1sum=None, sha256sum=None)
+            rows[patch][attribute] = hashsum
+    return order, dict((patch, PdiffHashes(**row)) for patch, row in rows.iteritems())
+
+def complete(hashes):
+    return hashes is not None and None not in hashes
 
 class Updates:
+    """the Index file describing the patches for an index file
+
+    Every entry of the history consists of the hashes of the file it applies
+    to, of the patch and of the compressed patch. Merged patches turn the
+    file of a history entry into the current file directly; their names
+    are "T-<current>-F-<entry>".
+    """
     def __init__(self, readpath = None, max = 56):
         self.can_path = None
         self.history = {}
         self.history_order = []
+        self.merged = {}
+        self.merged_current = None
+        self.stale = []
         self.max = max
         self.readpath = readpath
-        self.filesizesha1 = None
+        self.filehashes = None
 
         if readpath:
             try:
                 f = open(readpath + "/Index")
-                x = f.readline()
-
-                def read_hashs(ind, f, self, x=x):
-                    while 1:
-                        x = f.readline()
-                        if not x or x[0] != " ": break
-                        l = x.split()
-                        if not self.history.has_key(l[2]):
-                            self.history[l[2]] = [None,None]
-                            self.history_order.append(l[2])
-                        self.history[l[2]][ind] = (l[0], int(l[1]))
-                    return x
-
-                while x:
-                    l = x.split()
-
-                    if len(l) == 0:
-                        x = f.readline()
-                        continue
-
-                    if l[0] == "SHA1-History:":
-                        x = read_hashs(0,f,self)
-                        continue
+            except IOError:
+                return
 
-                    if l[0] == "SHA1-Patches:":
-                        x = read_hashs(1,f,self)
+            fields = {}
+            field = None
+            for x in f:
+                if x.startswith(" "):
+                    l = x.split()
+                    if field is not None and len(l) == 3:
+                        fields[field].append((l[0], int(l[1]), l[2]))
+                    continue
+                (key, sep, value) = x.partition(":")
+                value = value.strip()
+                if not sep:
+                    field = None
+                elif value:
+                    fields[key] = value
+                    field = None
+                else:
+                    fields[key] = []
+                    field = key
+            f.close()
+
+            self.can_path = fields.get("Canonical-Path", fields.get("Canonical-Name"))
+
+            current = dict(size=None, sha1sum=None, sha256sum=None)
+            for hashfield, attribute in HASH_FIELDS:
+                l = fields.get("%s-Current" % (hashfield), "").split()
+                if len(l) == 2:
+                    current[attribute] = l[0]
+                    current["size"] = int(l[1])
+            if current["size"] is not None:
+                self.filehashes = PdiffHashes(**current)
+
+            if fields.get("X-Patch-Precedence") == "merged":
+                unmerged = "X-Unmerged-"
+            else:
+                unmerged = ""
+
+            (order, history) = read_hash_rows(fields, unmerged, "History")
+            (_, patches) = read_hash_rows(fields, unmerged, "Patches")
+            (_, download) = read_hash_rows(fields, unmerged, "Download")
+            for h in order:
+                entry = [history.get(h), patches.get(h), download.get(h)]
+                # entries written before SHA256 and download hashes were
+                # recorded cannot be described completely, drop them
+                if all(complete(hashes) for hashes in entry):
+                    self.history[h] = entry
+                    self.history_order.append(h)
+                else:
+                    self.stale.append(h)
+
+            if unmerged:
+                (order, patches) = read_hash_rows(fields, "", "Patches")
+                (_, download) = read_hash_rows(fields, "", "Download")
+                for m in order:
+                    (current, sep, h) = m[2:].partition("-F-")
+                    if not m.startswith("T-") or not sep:
                         continue
+                    self.merged_current = current
+                    if self.history.has_key(h) and complete(patches.get(m)) and complete(download.get(m)):
+                        self.merged[h] = [patches[m], download[m]]
 
-                    if l[0] == "Canonical-Name:" or l[0]=="Canonical-Path:":
-                        self.can_path = l[1]
+    def merged_name(self, h, current=None):
+        return "T-%s-F-%s" % (current or self.merged_current, h)
 
-                    if l[0] == "SHA1-Current:" and len(l) == 3:
-                        self.filesizesha1 = (l[1], int(l[2]))
-
-                    x = f.readline()
-
-            except IOError:
-                0
+    def dump_rows(self, out, prefix, rows):
+        for i, name in enumerate(["History", "Patches", "Download"]):
+            suffix = ".gz" if name == "Download" else ""
+            for hashfield, attribute in HASH_FIELDS:
+                out.write("%s%s-%s:\n" % (prefix, hashfield, name))
+                for row in rows:
+                    out.write(" %s %7d %s%s\n" % (getattr(row[i + 1], attribute), row[i + 1].size, row[0], suffix))
 
     def dump(self, out=sys.stdout):
         if self.can_path:
             out.write("Canonical-Path: %s\n" % (self.can_path))
 
-        if self.filesizesha1:
-            out.write("SHA1-Current: %s %7d\n" % (self.filesizesha1))
+        if self.filehashes:
+            for hashfield, attribute in HASH_FIELDS:
+                out.write("%s-Current: %s %7d\n" % (hashfield, getattr(self.filehashes, attribute), self.filehashes.size))
 
         hs = self.history
         l = self.history_order[:]
@@ -174,33 +215,65 @@ class Updates:
             for h in l[:cnt-self.max]:
                 tryunlink("%s/%s.gz" % (self.readpath, h))
                 del hs[h]
+                if self.merged.has_key(h):
+                    tryunlink("%s/%s.gz" % (self.readpath, self.merged_name(h)))
+                    del self.merged[h]
             l = l[cnt-self.max:]
             self.history_order = l[:]
 
-        out.write("SHA1-History:\n")
-        for h in l:
-            out.write(" %s %7d %s\n" % (hs[h][0][0], hs[h][0][1], h))
-        out.write("SHA1-Patches:\n")
-        for h in l:
-            out.write(" %s %7d %s\n" % (hs[h][1][0], hs[h][1][1], h))
-
-def create_temp_file(r):
-    f = tempfile.TemporaryFile()
-    while 1:
-        x = r.readline()
-        if not x: break
-        f.write(x)
-    r.close()
-    del x,r
-    f.flush()
-    f.seek(0)
-    return f
-
-def sizesha1(f):
-    size = os.fstat(f.fileno())[6]
-    f.seek(0)
-    sha1sum = apt_pkg.sha1sum(f)
-    return (sha1sum, size)
+        for h in self.stale:
+            if os.path.exists("%s/%s.gz" % (self.readpath, h)):
+                tryunlink("%s/%s.gz" % (self.readpath, h))
+        self.stale = []
+
+        unmerged = [ [h] + hs[h] for h in l ]
+        merged = [ [self.merged_name(h), hs[h][0]] + self.merged[h] for h in l if self.merged.has_key(h) ]
+        if merged:
+            self.dump_rows(out, "", merged)
+            self.dump_rows(out, "X-Unmerged-", unmerged)
+            out.write("X-Patch-Precedence: merged\n")
+        else:
+            self.dump_rows(out, "", unmerged)
+
+def genmerged(upd, outdir, patchname):
+    """generate the merged patches for all entries of the history
+
+    The merged patch of an entry is the previous run's merged patch for it
+    followed by the new patch. Where the previous run left none, the
+    entry's own patch is merged with the merged patch of the next newer
+    entry instead. Returns the names of the files that are no longer used.
+    """
+    previous = upd.merged_current
+    previous_merged = upd.merged
+    upd.merged = {}
+    upd.merged_current = patchname
+
+    latest = None
+    following = None
+    for h in reversed(upd.history_order[-upd.max:]):
+        filename = "%s/%s.gz" % (outdir, upd.merged_name(h))
+        if os.path.exists(filename):
+            os.unlink(filename)
+        try:
+            if h == patchname:
+                latest = following = read_patch("%s/%s.gz" % (outdir, h))
+                os.link("%s/%s.gz" % (outdir, h), filename)
+                upd.merged[h] = upd.history[h][1:]
+                continue
+            elif previous_merged.has_key(h) and previous != patchname:
+                hunks = merge_patches(read_patch("%s/%s.gz" % (outdir, upd.merged_name(h, previous))), latest)
+            else:
+                hunks = merge_patches(read_patch("%s/%s.gz" % (outdir, h)), following)
+        except (PdiffError, IOError) as e:
+            # older entries are only available as unmerged patches
+            print "%s: cannot merge patches: %s" % (outdir, e)
+            break
+        upd.merged[h] = list(write_hunks(hunks, filename))
+        following = hunks
+
+    if previous is None or previous == patchname:
+        return []
+    return [ "%s/%s.gz" % (outdir, upd.merged_name(h, previous)) for h in previous_merged ]
 
 def genchanges(Options, outdir, oldfile, origfile, maxdiffs = 56):
     if Options.has_key("NoAct"):
@@ -211,13 +284,11 @@ def genchanges(Options, outdir, oldfile, origfile, maxdiffs = 56):
 
     # origfile = /path/to/Packages
     # oldfile  = ./Packages
-    # newfile  = ./Packages.tmp
     # difffile = outdir/patchname
     # index   => outdir/Index
 
     # (outdir, oldfile, origfile) = argv
 
-    newfile = oldfile + ".new"
     difffile = "%s/%s" % (outdir, patchname)
 
     upd = Updates(outdir, int(maxdiffs))
@@ -235,53 +306,43 @@ def genchanges(Options, outdir, oldfile, origfile, maxdiffs = 56):
         #print "%s: hardlink unbroken, assuming unchanged" % (origfile)
         return
 
-    oldf = smartopen(oldfile)
-    oldsizesha1 = sizesha1(oldf)
-
     # should probably early exit if either of these checks fail
     # alternatively (optionally?) could just trim the patch history
 
-    #if upd.filesizesha1:
-    #    if upd.filesizesha1 != oldsizesha1:
-    #        print "info: old file " + oldfile + " changed! %s %s => %s %s" % (upd.filesizesha1 + oldsizesha1)
+    #if upd.filehashes:
+    #    if upd.filehashes != oldhashes:
+    #        print "info: old file " + oldfile + " changed! %s => %s" % (upd.filehashes, oldhashes)
 
     if Options.has_key("CanonicalPath"): upd.can_path=Options["CanonicalPath"]
 
-    if os.path.exists(newfile): os.unlink(newfile)
-    smartlink(origfile, newfile)
-    newf = open(newfile, "r")
-    newsizesha1 = sizesha1(newf)
-    newf.close()
+    # Contents files are line based, everything else consists of stanzas
+    by_line = os.path.basename(origfile).startswith("Contents-")
+    result = write_patch(oldfile + oldext, origfile + origext, difffile + ".gz", by_line=by_line)
 
-    if newsizesha1 == oldsizesha1:
-        os.unlink(newfile)
-        oldf.close()
+    if result is None:
         #print "%s: unchanged" % (origfile)
-    else:
-        if not os.path.isdir(outdir):
-            os.mkdir(outdir)
+        return
 
-        w = os.popen("diff --ed - %s | gzip --rsyncable -c -9 > %s.gz" %
-                     (newfile, difffile), "w")
-        pipe_file(oldf, w)
-        oldf.close()
+    upd.history[patchname] = [result.old, result.patch, result.patch_download]
+    upd.history_order.append(patchname)
 
-        difff = smartopen(difffile)
-        difsizesha1 = sizesha1(difff)
-        difff.close()
+    upd.filehashes = result.new
 
-        upd.history[patchname] = (oldsizesha1, difsizesha1)
-        upd.history_order.append(patchname)
+    unused = genmerged(upd, outdir, patchname)
 
-        upd.filesizesha1 = newsizesha1
+    os.unlink(oldfile + oldext)
+    os.link(origfile + origext, oldfile + origext)
 
-        os.unlink(oldfile + oldext)
-        os.link(origfile + origext, oldfile + origext)
-        os.unlink(newfile)
+    f = open(outdir + "/Index", "w")
+    upd.dump(f)
+    f.close()
+
+    for filename in unused:
+        tryunlink(filename)
 
-        f = open(outdir + "/Index", "w")
-        upd.dump(f)
-        f.close()
+def genchanges_helper(Options, outdir, oldfile, origfile, maxdiffs):
+    genchanges(Options, outdir, oldfile, origfile, maxdiffs)
+    return (PROC_STATUS_SUCCESS, "%s: done" % (origfile))
 
 
 def main():
@@ -311,6 +372,11 @@ def main():
         format = "%Y-%m-%d-%H%M.%S"
         Options["PatchName"] = time.strftime( format )
 
+    # the configuration subtree cannot be passed to worker processes
+    options = dict((key, Options[key]) for key in ("PatchName", "NoAct", "CanonicalPath") if Options.has_key(key))
+
+    pool = DakProcessPool()
+
     session = DBConn().session()
 
     if not suites:
@@ -359,7 +425,7 @@ def main():
                         #print "Working: %s" % (processfile)
                         storename="%s/%s_%s_%s" % (Options["TempDir"], suite, component, fname)
                         #print "Storefile: %s" % (storename)
-                        genchanges(Options, processfile + ".diff", storename, processfile, maxdiffs)
+                        pool.apply_async(genchanges_helper, (options, processfile + ".diff", storename, processfile, maxdiffs))
         os.chdir(cwd)
 
         for archobj in architectures:
@@ -377,11 +443,20 @@ def main():
                     # Process Contents
                     file = "%s/%s/Contents-%s" % (tree, component, architecture)
                     storename = "%s/%s_%s_contents_%s" % (Options["TempDir"], suite, component, architecture)
-                    genchanges(Options, file + ".diff", storename, file, maxcontents)
+                    pool.apply_async(genchanges_helper, (options, file + ".diff", storename, file, maxcontents))
 
                 file = "%s/%s/%s/%s" % (tree, component, longarch, packages)
                 storename = "%s/%s_%s_%s" % (Options["TempDir"], suite, component, architecture)
-                genchanges(Options, file + ".diff", storename, file, maxsuite)
+                pool.apply_async(genchanges_helper, (options, file + ".diff", storename, file, maxsuite))
+
+    pool.close()
+    pool.join()
+
+    for status, message in pool.results:
+        if status != PROC_STATUS_SUCCESS:
+            print "E: %s" % (message)
+
+    sys.exit(pool.overall_status())
 
 ################################################################################
 
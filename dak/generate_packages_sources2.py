@@ -28,7 +28,7 @@ Generate Packages/Sources files
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import apt_pkg, sys
+import apt_pkg, os, sys
 
 def usage():
     print """Usage: dak generate-packages-sources2 [OPTIONS]
@@ -39,6 +39,7 @@ Generate the Packages/Sources files
                                Default: All suites not marked 'untouchable'
   -f, --force                  Allow processing of untouchable suites
                                CAREFUL: Only to be used at point release time!
+  -i, --incremental            only regenerate indices touched since the last run
   -h, --help                   show this help and exit
 
 SUITE can be a space seperated list, e.g.
@@ -104,6 +105,7 @@ s.source, s.version
 def generate_sources(suite_id, component_id):
     global _sources_query
     from daklib.filewriter import SourcesFileWriter
+    from daklib.hashcache import HashCache
     from daklib.dbconn import Component, DBConn, OverrideType, Suite
     from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
 
@@ -133,6 +135,11 @@ def generate_sources(suite_id, component_id):
 
     writer.close()
 
+    cache = HashCache(session)
+    cache.add_written_files(writer.hashes, writer.written)
+    cache.save()
+    session.commit()
+
     message = ["generate sources", suite.suite_name, component.component_name]
     session.rollback()
     return (PROC_STATUS_SUCCESS, message)
@@ -223,6 +230,7 @@ ORDER BY tmp.source, tmp.package, tmp.version
 def generate_packages(suite_id, component_id, architecture_id, type_name):
     global _packages_query
     from daklib.filewriter import PackagesFileWriter
+    from daklib.hashcache import HashCache
     from daklib.dbconn import Architecture, Component, DBConn, OverrideType, Suite
     from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
 
@@ -268,6 +276,11 @@ def generate_packages(suite_id, component_id, architecture_id, type_name):
 
     writer.close()
 
+    cache = HashCache(session)
+    cache.add_written_files(writer.hashes, writer.written)
+    cache.save()
+    session.commit()
+
     message = ["generate-packages", suite.suite_name, component.component_name, architecture.arch_string]
     session.rollback()
     return (PROC_STATUS_SUCCESS, message)
@@ -308,6 +321,7 @@ ORDER BY MIN(s.source), b.package, bm_description_md5.value
 def generate_translations(suite_id, component_id):
     global _translations_query
     from daklib.filewriter import TranslationFileWriter
+    from daklib.hashcache import HashCache
     from daklib.dbconn import DBConn, Suite, Component
     from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
 
@@ -332,12 +346,103 @@ def generate_translations(suite_id, component_id):
 
     writer.close()
 
+    cache = HashCache(session)
+    cache.add_written_files(writer.hashes, writer.written)
+    cache.save()
+    session.commit()
+
     message = ["generate-translations", suite.suite_name, component.component_name]
     session.rollback()
     return (PROC_STATUS_SUCCESS, message)
 
 #############################################################################
 
+class IndexJournal(object):
+    """changes recorded in the index_journal table
+
+    The journal is filled by triggers on the association and override
+    tables. Each row names a suite, component and architecture whose
+    indices need to be regenerated; a C{None} component or architecture
+    stands for all of them.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.max_id = session.execute("SELECT max(id) FROM index_journal").scalar()
+        self.entries = set()
+        self.components = set()
+        if self.max_id is not None:
+            r = session.execute(
+                """SELECT DISTINCT suite_id, component_id, architecture_id
+                     FROM index_journal WHERE id <= :max_id""",
+                {'max_id': self.max_id})
+            for suite_id, component_id, architecture_id in r:
+                self.entries.add((suite_id, component_id, architecture_id))
+                self.components.add((suite_id, component_id))
+
+    def touched(self, suite, component_id, architecture_ids=None):
+        """check if an index was touched
+
+        @type  suite: L{daklib.dbconn.Suite}
+        @param suite: suite of the index
+
+        @type  component_id: int
+        @param component_id: component of the index
+
+        @type  architecture_ids: list of int
+        @param architecture_ids: architectures the index covers or C{None}
+                                 if any architecture is relevant
+
+        @rtype:  bool
+        """
+        # Override changes are recorded for the override suite.
+        suite_ids = (suite.suite_id, suite.get_overridesuite().suite_id)
+        for suite_id in suite_ids:
+            for c_id in (component_id, None):
+                if architecture_ids is None:
+                    if (suite_id, c_id) in self.components:
+                        return True
+                    continue
+                for a_id in list(architecture_ids) + [None]:
+                    if (suite_id, c_id, a_id) in self.entries:
+                        return True
+        return False
+
+    def clear(self, suites):
+        """remove the journal entries handled by regenerating C{suites}
+
+        Entries of a suite are removed once all suites using them were
+        regenerated: the suite itself and the suites using it as override
+        suite. Untouchable suites are not regenerated incrementally and so
+        do not need the journal. Entries added after the journal was loaded
+        are kept.
+        """
+        from daklib.dbconn import Suite
+        if self.max_id is None:
+            return
+        processed = set(s.suite_id for s in suites)
+        journal_suite_ids = set(suite_id for suite_id, component_id in self.components)
+        done = []
+        for suite in self.session.query(Suite).filter(Suite.suite_id.in_(journal_suite_ids)):
+            users = self.session.query(Suite).filter_by(overridesuite=suite.suite_name, untouchable=False).all()
+            if not suite.untouchable:
+                users.append(suite)
+            if all(u.suite_id in processed for u in users):
+                done.append(suite.suite_id)
+        if done:
+            self.session.execute(
+                "DELETE FROM index_journal WHERE id <= :max_id AND suite_id = ANY(:suite_ids)",
+                {'max_id': self.max_id, 'suite_ids': done})
+
+def index_missing(writer_class, **keywords):
+    """check if none of the variants of an index exists on disk"""
+    path = writer_class(**keywords).path
+    for suffix in ('', '.gz', '.bz2', '.xz'):
+        if os.path.exists(path + suffix):
+            return False
+    return True
+
+#############################################################################
+
 def main():
     from daklib.config import Config
     from daklib import daklog
@@ -348,6 +453,7 @@ def main():
                  ('a','archive','Generate-Packages-Sources::Options::Archive','HasArg'),
                  ('s',"suite","Generate-Packages-Sources::Options::Suite"),
                  ('f',"force","Generate-Packages-Sources::Options::Force"),
+                 ('i',"incremental","Generate-Packages-Sources::Options::Incremental"),
                  ('o','option','','ArbItem')]
 
     suite_names = apt_pkg.parse_commandline(cnf.Cnf, Arguments, sys.argv)
@@ -364,7 +470,8 @@ def main():
 
     logger = daklog.Logger('generate-packages-sources2')
 
-    from daklib.dbconn import Component, DBConn, get_suite, Suite, Archive
+    from daklib.dbconn import Component, DBConn, get_architecture_id, get_suite, Suite, Archive
+    from daklib.filewriter import PackagesFileWriter, SourcesFileWriter, TranslationFileWriter
     session = DBConn().session()
     session.execute("SELECT add_missing_description_md5()")
     session.commit()
@@ -385,6 +492,7 @@ def main():
         suites = query.all()
 
     force = Options.has_key("Force") and Options["Force"]
+    incremental = Options.has_key("Incremental") and Options["Incremental"]
 
 
     def parse_results(message):
@@ -401,25 +509,43 @@ def main():
     session.execute("LOCK TABLE src_associations IN SHARE MODE")
     session.execute("LOCK TABLE bin_associations IN SHARE MODE")
 
+    journal = IndexJournal(session)
+    arch_all_id = get_architecture_id('all', session)
+    arch_source_id = get_architecture_id('source', session)
+
     for s in suites:
-        component_ids = [ c.component_id for c in s.components ]
         if s.untouchable and not force:
             import daklib.utils
             daklib.utils.fubar("Refusing to touch %s (untouchable and not forced)" % s.suite_name)
-        for c in component_ids:
-            pool.apply_async(generate_sources, [s.suite_id, c], callback=parse_results)
+        # the journal entries of untouchable suites are not kept
+        suite_incremental = incremental and not s.untouchable
+        for c in s.components:
+            c_id = c.component_id
+            writer_args = dict(archive=s.archive.path, suite=s.suite_name, component=c.component_name)
+
+            if not suite_incremental or journal.touched(s, c_id, [arch_source_id]) \
+                    or index_missing(SourcesFileWriter, **writer_args):
+                pool.apply_async(generate_sources, [s.suite_id, c_id], callback=parse_results)
             if not s.include_long_description:
-                pool.apply_async(generate_translations, [s.suite_id, c], callback=parse_results)
+                if not suite_incremental or journal.touched(s, c_id) \
+                        or index_missing(TranslationFileWriter, **writer_args):
+                    pool.apply_async(generate_translations, [s.suite_id, c_id], callback=parse_results)
             for a in s.architectures:
                 if a == 'source':
                     continue
-                pool.apply_async(generate_packages, [s.suite_id, c, a.arch_id, 'deb'], callback=parse_results)
-                pool.apply_async(generate_packages, [s.suite_id, c, a.arch_id, 'udeb'], callback=parse_results)
+                for debtype in ('deb', 'udeb'):
+                    if not suite_incremental or journal.touched(s, c_id, [a.arch_id, arch_all_id]) \
+                            or index_missing(PackagesFileWriter, architecture=a.arch_string, debtype=debtype, **writer_args):
+                        pool.apply_async(generate_packages, [s.suite_id, c_id, a.arch_id, debtype], callback=parse_results)
 
     pool.close()
     pool.join()
 
-    # this script doesn't change the database
+    # Only forget about changes once the indices were written. This also
+    # releases the table locks.
+    if pool.overall_status() == PROC_STATUS_SUCCESS:
+        journal.clear(suites)
+        session.commit()
     session.close()
 
     logger.close()
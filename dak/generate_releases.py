@@ -35,8 +35,6 @@ import os
 import os.path
 import stat
 import time
-import gzip
-import bz2
 import apt_pkg
 import subprocess
 from tempfile import mkstemp, mkdtemp
@@ -47,6 +45,8 @@ from daklib import utils, daklog
 from daklib.regexes import re_gensubrelease, re_includeinrelease
 from daklib.dak_exceptions import *
 from daklib.dbconn import *
+from daklib.hashcache import HashCache
+from daklib.compress import open_decompressed
 from daklib.config import Config
 from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS
 import daklib.daksubprocess
@@ -106,16 +106,6 @@ def sign_release_dir(suite, dirname):
         os.system("gpg %s %s %s --clearsign <%s >>%s" %
                   (keyring, defkeyid, arguments, relname, inlinedest))
 
-class XzFile(object):
-    def __init__(self, filename, mode='r'):
-        self.filename = filename
-    def read(self):
-        cmd = ("xz", "-d")
-        with open(self.filename, 'r') as stdin:
-            process = daklib.daksubprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE)
-            (stdout, stderr) = process.communicate()
-            return stdout
-
 class ReleaseWriter(object):
     def __init__(self, suite):
         self.suite = suite
@@ -222,14 +212,20 @@ class ReleaseWriter(object):
 
         os.chdir(os.path.join(suite.archive.path, "dists", suite.suite_name, suite_suffix))
 
-        hashfuncs = { 'MD5Sum' : apt_pkg.md5sum,
-                      'SHA1' : apt_pkg.sha1sum,
-                      'SHA256' : apt_pkg.sha256sum }
+        hashfuncs = { 'MD5Sum' : 'md5sum',
+                      'SHA1' : 'sha1sum',
+                      'SHA256' : 'sha256sum' }
 
         fileinfo = {}
 
         uncompnotseen = {}
 
+        # Files that did not change since the last run are not read again,
+        # the others are streamed through the hash functions in parallel.
+        suitedir = os.path.join(suite.archive.path, "dists", suite.suite_name, suite_suffix)
+        cache = HashCache(session, suitedir)
+        requests = {}
+
         for dirpath, dirnames, filenames in os.walk(".", followlinks=True, topdown=True):
             for entry in filenames:
                 # Skip things we don't want to include
@@ -240,45 +236,39 @@ class ReleaseWriter(object):
                     continue
 
                 filename = os.path.join(dirpath.lstrip('./'), entry)
-                fileinfo[filename] = {}
-                contents = open(filename, 'r').read()
+                requests[filename] = (filename, open)
 
                 # If we find a file for which we have a compressed version and
                 # haven't yet seen the uncompressed one, store the possibility
                 # for future use
                 if entry.endswith(".gz") and filename[:-3] not in uncompnotseen:
-                    uncompnotseen[filename[:-3]] = (gzip.GzipFile, filename)
+                    uncompnotseen[filename[:-3]] = filename
                 elif entry.endswith(".bz2") and filename[:-4] not in uncompnotseen:
-                    uncompnotseen[filename[:-4]] = (bz2.BZ2File, filename)
+                    uncompnotseen[filename[:-4]] = filename
                 elif entry.endswith(".xz") and filename[:-3] not in uncompnotseen:
-                    uncompnotseen[filename[:-3]] = (XzFile, filename)
-
-                fileinfo[filename]['len'] = len(contents)
-
-                for hf, func in hashfuncs.items():
-                    fileinfo[filename][hf] = func(contents)
+                    uncompnotseen[filename[:-3]] = filename
 
-        for filename, comp in uncompnotseen.items():
+        for filename, compressed in uncompnotseen.items():
             # If we've already seen the uncompressed file, we don't
             # need to do anything again
-            if filename in fileinfo:
+            if filename in requests:
                 continue
+            requests[filename] = (compressed, open_decompressed)
 
-            fileinfo[filename] = {}
-
-            # File handler is comp[0], filename of compressed file is comp[1]
-            contents = comp[0](comp[1], 'r').read()
-
-            fileinfo[filename]['len'] = len(contents)
-
-            for hf, func in hashfuncs.items():
-                fileinfo[filename][hf] = func(contents)
+        workers = Config().find_i("Generate-Releases::HashWorkers", 4)
+        hashes = cache.hash_files([ (os.path.join(suitedir, filename), os.path.join(suitedir, source), opener)
+                                    for filename, (source, opener) in requests.iteritems() ],
+                                  workers=workers)
+        for filename in requests:
+            fileinfo[filename] = hashes[os.path.normpath(os.path.join(suitedir, filename))]
 
+        cache.save(prune=True)
+        session.commit()
 
         for h in sorted(hashfuncs.keys()):
             out.write('%s:\n' % h)
             for filename in sorted(fileinfo.keys()):
-                out.write(" %s %8d %s\n" % (fileinfo[filename][h], fileinfo[filename]['len'], filename))
+                out.write(" %s %8d %s\n" % (getattr(fileinfo[filename], hashfuncs[h]), fileinfo[filename].size, filename))
 
         out.close()
         os.rename(outfile + '.new', outfile)
@@ -49,20 +49,26 @@ Generate changelog entry between two suites
 
 ################################################################################
 
+import json
 import os
 import sys
 import apt_pkg
 from glob import glob
 from shutil import rmtree
 from yaml import safe_dump
+from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS, PROC_STATUS_MISCFAILURE
 from daklib.dbconn import *
 from daklib import utils
 from daklib.contents import UnpackedSource
+from daklib.debiandir import read_debian_files, DebianDirError
 from daklib.regexes import re_no_epoch
 
 ################################################################################
 
 filelist = 'filelist.yaml'
+exported_list = 'exported.json'
+
+EXPORT_FILES = ('changelog', 'copyright', 'NEWS', 'NEWS.Debian', 'README.Debian')
 
 def usage (exit_code=0):
     print """Generate changelog between two suites
@@ -80,7 +86,8 @@ Options:
 
   -e, --export              export interesting files from source packages
   -a, --archive             archive to fetch data from
-  -p, --progress            display progress status"""
+  -p, --progress            display progress status
+  -j, --jobs=N              export files with N processes"""
 
     sys.exit(exit_code)
 
@@ -164,17 +171,78 @@ def display_changes(uploads, index):
         print upload[index]
         prev_upload = upload[0]
 
-def export_files(session, archive, clpool, progress=False):
+def export_source(dsc, filenames, outdir, tmpdir):
+    """
+    Export interesting files of a single source package to C{outdir}.
+
+    The files are read from the debian/ part of the source package if
+    possible, the source package is only unpacked as a fallback.
+
+    @return: (PROC_STATUS_SUCCESS, (dsc, names of the files found, names of
+             the files written, unpacked))
+    """
+    package = os.path.splitext(os.path.basename(dsc))[0].split('_')
+    try:
+        try:
+            contents = read_debian_files(os.path.dirname(dsc), filenames, EXPORT_FILES)
+            unpacked = False
+        except DebianDirError:
+            contents = {}
+            unpacked_source = UnpackedSource(dsc, tmpdir)
+            tempdir = unpacked_source.get_root_directory()
+            for file in EXPORT_FILES:
+                for f in glob(os.path.join(tempdir, 'debian', '*%s' % file)):
+                    with open(f, 'r') as fh:
+                        contents[os.path.basename(f)] = fh.read()
+            unpacked_source.cleanup()
+            unpacked = True
+
+        exported = []
+        for name, content in contents.iteritems():
+            version = os.path.join(outdir, '%s_%s_%s' % (package[0], package[1], name))
+            if not os.path.exists(version):
+                with open(version + '.new', 'w') as fh:
+                    fh.write(content)
+                os.rename(version + '.new', version)
+                exported.append(name)
+        return (PROC_STATUS_SUCCESS, (dsc, sorted(contents), exported, unpacked))
+    except Exception as e:
+        return (PROC_STATUS_MISCFAILURE, 'make-changelog: unable to unpack %s\n%s' % (dsc, e))
+
+def read_exported(clpool):
+    """
+    Returns the (source, version) pairs exported by previous runs.
+    """
+    try:
+        with open(os.path.join(clpool, exported_list), 'r') as fd:
+            return dict((source, set(versions)) for source, versions in json.load(fd).iteritems())
+    except (IOError, ValueError):
+        return {}
+
+def write_exported(clpool, exported):
+    filename = os.path.join(clpool, exported_list)
+    with open(filename + '.new', 'w') as fd:
+        json.dump(dict((source, sorted(versions)) for source, versions in exported.iteritems()), fd)
+    os.rename(filename + '.new', filename)
+
+def export_files(session, archive, clpool, procpool, progress=False):
     """
     Export interesting files from source packages.
+
+    Only the debian/ part of new source packages is read, by the worker
+    processes of C{procpool}. The (source, version) pairs already handled
+    are recorded in the changelog pool, so they are not looked at again by
+    later runs.
+
+    C{procpool} must have been created before the first database session
+    was opened.
     """
     pool = os.path.join(archive.path, 'pool')
 
     sources = {}
     unpack = {}
-    files = ('changelog', 'copyright', 'NEWS', 'NEWS.Debian', 'README.Debian')
-    stats = {'unpack': 0, 'created': 0, 'removed': 0, 'errors': 0, 'files': 0}
-    query = """SELECT DISTINCT s.source, su.suite_name AS suite, s.version, c.name || '/' || f.filename AS filename
+    stats = {'unpack': 0, 'created': 0, 'removed': 0, 'errors': 0, 'files': 0, 'full': 0}
+    query = """SELECT DISTINCT s.source, su.suite_name AS suite, s.version, c.name || '/' || f.filename AS filename, s.id
                FROM source s
                JOIN newest_source n ON n.source = s.source AND n.version = s.version
                JOIN src_associations sa ON sa.source = s.id
@@ -188,62 +256,82 @@ def export_files(session, archive, clpool, progress=False):
     for p in session.execute(query, {'archive_id': archive.archive_id}):
         if not sources.has_key(p[0]):
             sources[p[0]] = {}
-        sources[p[0]][p[1]] = (re_no_epoch.sub('', p[2]), p[3])
+        sources[p[0]][p[1]] = (re_no_epoch.sub('', p[2]), p[3], p[4])
+
+    exported = read_exported(clpool)
+    done = {}
 
     for p in sources.keys():
         for s in sources[p].keys():
-            path = os.path.join(clpool, '/'.join(sources[p][s][1].split('/')[:-1]))
+            version, filename, source_id = sources[p][s]
+            path = os.path.join(clpool, '/'.join(filename.split('/')[:-1]))
             if not os.path.exists(path):
                 os.makedirs(path)
-            if not os.path.exists(os.path.join(path, \
-                   '%s_%s_changelog' % (p, sources[p][s][0]))):
-                if not unpack.has_key(os.path.join(pool, sources[p][s][1])):
-                    unpack[os.path.join(pool, sources[p][s][1])] = (path, set())
-                unpack[os.path.join(pool, sources[p][s][1])][1].add(s)
+            if version not in exported.get(p, ()) and not os.path.exists(os.path.join(path, \
+                   '%s_%s_changelog' % (p, version))):
+                if not unpack.has_key(os.path.join(pool, filename)):
+                    unpack[os.path.join(pool, filename)] = (path, set(), source_id, p, version)
+                unpack[os.path.join(pool, filename)][1].add(s)
             else:
-                for file in glob('%s/%s_%s_*' % (path, p, sources[p][s][0])):
+                done.setdefault(p, set()).add(version)
+                for file in glob('%s/%s_%s_*' % (path, p, version)):
                     link = '%s%s' % (s, file.split('%s_%s' \
-                                      % (p, sources[p][s][0]))[1])
+                                      % (p, version))[1])
                     try:
                         os.unlink(os.path.join(path, link))
                     except OSError:
                         pass
                     os.link(os.path.join(path, file), os.path.join(path, link))
 
+    dsc_files = {}
+    if unpack:
+        q = session.execute("""SELECT df.source, f.filename
+                                 FROM dsc_files df
+                                 JOIN files f ON f.id = df.file
+                                WHERE df.source = ANY(:source_ids)""",
+                            {'source_ids': [ u[2] for u in unpack.values() ]})
+        for source_id, filename in q:
+            dsc_files.setdefault(source_id, []).append(os.path.basename(filename))
+    session.rollback()
+
     for p in unpack.keys():
-        package = os.path.splitext(os.path.basename(p))[0].split('_')
-        try:
-            unpacked = UnpackedSource(p, clpool)
-            tempdir = unpacked.get_root_directory()
-            stats['unpack'] += 1
-            if progress:
-                if stats['unpack'] % 100 == 0:
-                    sys.stderr.write('%d packages unpacked\n' % stats['unpack'])
-                elif stats['unpack'] % 10 == 0:
-                    sys.stderr.write('.')
-            for file in files:
-                for f in glob(os.path.join(tempdir, 'debian', '*%s' % file)):
-                    for s in unpack[p][1]:
-                        suite = os.path.join(unpack[p][0], '%s_%s' \
-                                % (s, os.path.basename(f)))
-                        version = os.path.join(unpack[p][0], '%s_%s_%s' % \
-                                  (package[0], package[1], os.path.basename(f)))
-                        if not os.path.exists(version):
-                            os.link(f, version)
-                            stats['created'] += 1
-                        try:
-                            os.unlink(suite)
-                        except OSError:
-                            pass
-                        os.link(version, suite)
-                        stats['created'] += 1
-            unpacked.cleanup()
-        except Exception as e:
-            print 'make-changelog: unable to unpack %s\n%s' % (p, e)
+        procpool.apply_async(export_source, (p, dsc_files.get(unpack[p][2], []), unpack[p][0], clpool))
+    procpool.close()
+    procpool.join()
+
+    for status, result in procpool.results:
+        if status != PROC_STATUS_SUCCESS:
+            print result
             stats['errors'] += 1
+            continue
+        p, names, created, unpacked = result
+        path, suites, source_id, source, version = unpack[p]
+        package = os.path.splitext(os.path.basename(p))[0].split('_')
+        stats['unpack'] += 1
+        stats['created'] += len(created)
+        if unpacked:
+            stats['full'] += 1
+        if progress:
+            if stats['unpack'] % 100 == 0:
+                sys.stderr.write('%d packages unpacked\n' % stats['unpack'])
+            elif stats['unpack'] % 10 == 0:
+                sys.stderr.write('.')
+        for name in names:
+            version_file = os.path.join(path, '%s_%s_%s' % (package[0], package[1], name))
+            for s in suites:
+                suite = os.path.join(path, '%s_%s' % (s, name))
+                try:
+                    os.unlink(suite)
+                except OSError:
+                    pass
+                os.link(version_file, suite)
+                stats['created'] += 1
+        done.setdefault(source, set()).add(version)
+
+    write_exported(clpool, done)
 
     for root, dirs, files in os.walk(clpool, topdown=False):
-        files = [f for f in files if f != filelist]
+        files = [f for f in files if f not in (filelist, exported_list)]
         if len(files):
             if root != clpool:
                 if root.split('/')[-1] not in sources.keys():
@@ -265,6 +353,7 @@ def export_files(session, archive, clpool, progress=False):
 
     print 'make-changelog: file exporting finished'
     print '  * New packages unpacked: %d' % stats['unpack']
+    print '  * Packages fully unpacked: %d' % stats['full']
     print '  * New files created: %d' % stats['created']
     print '  * New files removed: %d' % stats['removed']
     print '  * Unpack errors: %d' % stats['errors']
@@ -273,7 +362,7 @@ def export_files(session, archive, clpool, progress=False):
 def generate_export_filelist(clpool):
     clfiles = {}
     for root, dirs, files in os.walk(clpool):
-        for file in [f for f in files if f != filelist]:
+        for file in [f for f in files if f not in (filelist, exported_list)]:
             clpath = os.path.join(root, file).replace(clpool, '').strip('/')
             source = clpath.split('/')[2]
             elements = clpath.split('/')[3].split('_')
@@ -298,9 +387,10 @@ def main():
                  ('b','base-suite','Make-Changelog::Options::Base-Suite','HasArg'),
                  ('n','binnmu','Make-Changelog::Options::binNMU'),
                  ('e','export','Make-Changelog::Options::export'),
-                 ('p','progress','Make-Changelog::Options::progress')]
+                 ('p','progress','Make-Changelog::Options::progress'),
+                 ('j','jobs','Make-Changelog::Options::jobs','HasArg')]
 
-    for i in ['help', 'suite', 'base-suite', 'binnmu', 'export', 'progress']:
+    for i in ['help', 'suite', 'base-suite', 'binnmu', 'export', 'progress', 'jobs']:
         if not Cnf.has_key('Make-Changelog::Options::%s' % (i)):
             Cnf['Make-Changelog::Options::%s' % (i)] = ''
 
@@ -311,10 +401,18 @@ def main():
     binnmu = Cnf['Make-Changelog::Options::binNMU']
     export = Cnf['Make-Changelog::Options::export']
     progress = Cnf['Make-Changelog::Options::progress']
+    try:
+        jobs = int(Cnf['Make-Changelog::Options::jobs'] or 1)
+    except ValueError:
+        utils.fubar('Invalid number of jobs: %s' % Cnf['Make-Changelog::Options::jobs'])
 
     if Options['help'] or not (suite and base_suite) and not export:
         usage()
 
+    procpool = None
+    if export:
+        procpool = DakProcessPool(jobs)
+
     for s in suite, base_suite:
         if not export and not get_suite(s):
             utils.fubar('Invalid suite "%s"' % s)
@@ -325,7 +423,7 @@ def main():
         archive = session.query(Archive).filter_by(archive_name=Options['Archive']).one()
         exportpath = archive.changelog
         if exportpath:
-            export_files(session, archive, exportpath, progress)
+            export_files(session, archive, exportpath, procpool, progress)
             generate_export_filelist(exportpath)
         else:
             utils.fubar('No changelog export path defined')
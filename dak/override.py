@@ -260,7 +260,7 @@ def main ():
 
     Logger = daklog.Logger("override")
 
-    dsc_otype_id = get_override_type('dsc').overridetype_id
+    dsc_otype_id = get_override_type_id('dsc')
 
     # We're already in a transaction
     # We're in "do it" mode, we have something to do... do it
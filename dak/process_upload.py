@@ -171,6 +171,7 @@ import time
 from sqlalchemy.orm.exc import NoResultFound
 
 from daklib import daklog
+from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS
 from daklib.dbconn import *
 from daklib.urgencylog import UrgencyLog
 from daklib.summarystats import SummaryStats
@@ -182,6 +183,8 @@ import daklib.announce
 import daklib.archive
 import daklib.checks
 import daklib.upload
+from daklib.gpg import SignedFileVerifier
+from multiprocessing.pool import ThreadPool
 
 ###############################################################################
 
@@ -195,6 +198,8 @@ def usage (exit_code=0):
   -a, --automatic           automatic run
   -d, --directory <DIR>     process uploads in <DIR>
   -h, --help                show this help and exit.
+  -j, --jobs <N>            process uploads of up to <N> source packages
+                            at the same time (with -a or -n only)
   -n, --no-action           don't do anything
   -p, --no-lock             don't check lockfile !! for cron.daily only !!
   -s, --no-mail             don't send any mail
@@ -473,25 +478,162 @@ def process_it(directory, changes, keyrings):
 
 ###############################################################################
 
-def process_changes(changes_filenames):
+def lock_source(source_name):
+    """Lock processing of uploads for a source package
+
+    Returns a file descriptor; closing it releases the lock.
+    """
+    cnf = Config()
+    lockdir = os.path.join(cnf["Dir::Lock"], "process-upload")
+    if not os.path.isdir(lockdir):
+        os.makedirs(lockdir)
+    lock_fd = os.open(os.path.join(lockdir, "{0}.lock".format(source_name)), os.O_RDWR | os.O_CREAT)
+    fcntl.lockf(lock_fd, fcntl.LOCK_EX)
+    return lock_fd
+
+def read_source_name(filename):
+    """Read the source package name from a .changes file
+
+    The signature is not verified: the name is only used to group uploads
+    for worker processes, which verify the .changes files themselves.
+
+    Returns C{None} if there is no valid Source field.
+    """
+    with open(filename) as fh:
+        for line in fh:
+            if line.startswith("-----BEGIN PGP SIGNATURE-----"):
+                break
+            m = re_single_line_field.match(line)
+            if m is not None and m.group(1).lower() == "source":
+                m = re_field_source.match(m.group(2).strip())
+                if m is None:
+                    return None
+                return m.group('package')
+    return None
+
+def process_group(group, keyring_files):
+    """Process uploads for a single source package in a worker process
+
+    The uploads are verified, sorted and processed while holding the lock
+    for the source package. Returns the summary statistics and the number of
+    urgencies logged by this group as the message.
+    """
+    summarystats = SummaryStats()
+    summarystats.reset_accept()
+    summarystats.reset_reject()
+    urgency_writes = UrgencyLog().writes if not Options["No-Action"] else 0
+
+    source_name, changes_filenames = group
+    lock_fd = None
+    if not Options["No-Action"]:
+        lock_fd = lock_source(source_name)
+    try:
+        changes = []
+        for fn in changes_filenames:
+            directory, filename = os.path.split(fn)
+            try:
+                c = daklib.upload.Changes(directory, filename, keyring_files)
+            except Exception as e:
+                Logger.log([filename, "Error while loading changes: {0}".format(e)])
+                continue
+            changes.append([directory, c])
+
+        changes.sort(key=lambda x: x[1])
+
+        for directory, c in changes:
+            try:
+                signed_source_name = c.source_name
+            except Exception:
+                signed_source_name = "_invalid"
+            if signed_source_name != source_name:
+                # the lock we hold is not the one for this upload
+                Logger.log([c.filename, "Source field outside of signed data, skipped"])
+                continue
+            process_it(directory, c, keyring_files)
+    finally:
+        if lock_fd is not None:
+            os.close(lock_fd)
+
+    if not Options["No-Action"]:
+        urgency_writes = UrgencyLog().writes - urgency_writes
+    return (PROC_STATUS_SUCCESS, [summarystats.accept_count, summarystats.accept_bytes,
+                                  summarystats.reject_count, urgency_writes])
+
+def process_changes_in_pool(changes_filenames, keyring_files, jobs):
+    # Uploads for different source packages are independent of each other,
+    # so each source package is processed in its own task. Uploads for the
+    # same source are handled in a single task that puts them in order.
+    groups = []
+    groups_by_source = {}
+    for fn in sorted(changes_filenames):
+        try:
+            source_name = read_source_name(fn)
+        except EnvironmentError:
+            # the worker reports why the file cannot be loaded
+            source_name = None
+        if source_name is None:
+            # invalid Source field, the upload will be rejected on its own
+            groups.append(("_invalid", [fn]))
+            continue
+        if source_name not in groups_by_source:
+            groups_by_source[source_name] = (source_name, [])
+            groups.append(groups_by_source[source_name])
+        groups_by_source[source_name][1].append(fn)
+
+    pool = DakProcessPool(jobs)
+    for group in groups:
+        pool.apply_async(process_group, (group, keyring_files))
+    pool.close()
+    pool.join()
+
+    summarystats = SummaryStats()
+    for status, message in pool.results:
+        if status != PROC_STATUS_SUCCESS:
+            Logger.log(["Error while processing uploads", message])
+            utils.warn("Error while processing uploads: {0}".format(message))
+            continue
+        accept_count, accept_bytes, reject_count, urgency_writes = message
+        summarystats.accept_count += accept_count
+        summarystats.accept_bytes += accept_bytes
+        summarystats.reject_count += reject_count
+        if not Options["No-Action"]:
+            UrgencyLog().writes += urgency_writes
+
+def process_changes(changes_filenames, jobs=1):
     session = DBConn().session()
     keyrings = session.query(Keyring).filter_by(active=True).order_by(Keyring.priority)
     keyring_files = [ k.keyring_name for k in keyrings ]
     session.close()
 
-    changes = []
-    for fn in changes_filenames:
-        try:
+    if jobs > 1:
+        process_changes_in_pool(changes_filenames, keyring_files, jobs)
+        return
+
+    # signatures are verified by helper processes
+    gpg_workers = Config().find_i("Dinstall::GpgWorkers", 4)
+    verifier = SignedFileVerifier(keyring_files, workers=gpg_workers)
+    try:
+        def load_changes(fn):
             directory, filename = os.path.split(fn)
-            c = daklib.upload.Changes(directory, filename, keyring_files)
-            changes.append([directory, c])
-        except Exception as e:
-            Logger.log([filename, "Error while loading changes: {0}".format(e)])
+            try:
+                return [directory, daklib.upload.Changes(directory, filename, keyring_files, verifier=verifier)]
+            except Exception as e:
+                Logger.log([filename, "Error while loading changes: {0}".format(e)])
+                return None
 
-    changes.sort(key=lambda x: x[1])
+        loader = ThreadPool(gpg_workers)
+        try:
+            changes = [ c for c in loader.map(load_changes, changes_filenames, chunksize=1) if c is not None ]
+        finally:
+            loader.close()
+            loader.join()
+
+        changes.sort(key=lambda x: x[1])
 
-    for directory, c in changes:
-        process_it(directory, c, keyring_files)
+        for directory, c in changes:
+            process_it(directory, c, keyring_files)
+    finally:
+        verifier.close()
 
 ###############################################################################
 
@@ -506,10 +648,11 @@ def main():
                  ('n',"no-action","Dinstall::Options::No-Action"),
                  ('p',"no-lock", "Dinstall::Options::No-Lock"),
                  ('s',"no-mail", "Dinstall::Options::No-Mail"),
-                 ('d',"directory", "Dinstall::Options::Directory", "HasArg")]
+                 ('d',"directory", "Dinstall::Options::Directory", "HasArg"),
+                 ('j',"jobs", "Dinstall::Options::Jobs", "HasArg")]
 
     for i in ["automatic", "help", "no-action", "no-lock", "no-mail",
-              "version", "directory"]:
+              "version", "directory", "jobs"]:
         if not cnf.has_key("Dinstall::Options::%s" % (i)):
             cnf["Dinstall::Options::%s" % (i)] = ""
 
@@ -523,6 +666,16 @@ def main():
     if Options["No-Action"]:
         Options["Automatic"] = ""
 
+    jobs = 1
+    if Options["Jobs"]:
+        try:
+            jobs = int(Options["Jobs"])
+        except ValueError:
+            utils.fubar("Invalid number of jobs: {0}".format(Options["Jobs"]))
+        # interactive processing needs to ask one question at a time
+        if not Options["Automatic"] and not Options["No-Action"]:
+            jobs = 1
+
     # Check that we aren't going to clash with the daily cron job
     if not Options["No-Action"] and os.path.exists("%s/daily.lock" % (cnf["Dir::Lock"])) and not Options["No-Lock"]:
         utils.fubar("Archive maintenance in progress.  Try again later.")
@@ -558,7 +711,7 @@ def main():
     else:
         Logger.log(["Using changes files from command-line", len(changes_files)])
 
-    process_changes(changes_files)
+    process_changes(changes_files, jobs)
 
     if summarystats.accept_count:
         sets = "set"
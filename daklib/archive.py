@@ -47,9 +47,17 @@ class HashMismatchException(ArchiveException):
 class ArchiveTransaction(object):
     """manipulate the archive in a transaction
     """
+    #: number of new packages whose metadata is imported at once
+    metadata_batch_size = 200
+
     def __init__(self):
         self.fs = FilesystemTransaction()
         self.session = DBConn().session()
+        self.staging_directories = set()
+        """directories with private copies of files that may be hardlinked
+        into the pool (see L{_install_file})"""
+        self.pending_metadata = []
+        """new packages whose metadata is imported by L{flush}"""
 
     def get_file(self, hashed_file, source_name, check_hashes=True):
         """Look for file C{hashed_file} in database
@@ -111,7 +119,10 @@ class ArchiveTransaction(object):
 
             path = os.path.join(archive.path, 'pool', component.component_name, poolname)
             hashed_file_path = os.path.join(directory, hashed_file.input_filename)
-            self.fs.copy(hashed_file_path, path, link=False, mode=archive.mode)
+            # Files in a staging directory are not used by anything else,
+            # so they can share their inode (and mode) with the pool file.
+            link = directory in self.staging_directories
+            self.fs.copy(hashed_file_path, path, link=link, mode=archive.mode)
 
         return poolfile
 
@@ -196,7 +207,7 @@ class ArchiveTransaction(object):
                 setattr(db_binary, key, value)
             session.add(db_binary)
             session.flush()
-            import_metadata_into_db(db_binary, session)
+            self._add_pending_metadata(db_binary)
 
             self._add_built_using(db_binary, binary.hashed_file.filename, control, suite, extra_archives=extra_source_archives)
 
@@ -331,7 +342,7 @@ class ArchiveTransaction(object):
         session.flush()
 
         # Importing is safe as we only arrive here when we did not find the source already installed earlier.
-        import_metadata_into_db(db_source, session)
+        self._add_pending_metadata(db_source)
 
         # Uploaders are the maintainer and co-maintainers from the Uploaders field
         db_source.uploaders.append(maintainer)
@@ -527,18 +538,31 @@ class ArchiveTransaction(object):
     def commit(self):
         """commit changes"""
         try:
+            self.flush()
             self.session.commit()
             self.fs.commit()
         finally:
+            self.pending_metadata = []
             self.session.rollback()
             self.fs.rollback()
 
     def rollback(self):
         """rollback changes"""
+        self.pending_metadata = []
         self.session.rollback()
         self.fs.rollback()
 
+    def _add_pending_metadata(self, obj):
+        self.pending_metadata.append(obj)
+        if len(self.pending_metadata) >= self.metadata_batch_size:
+            self.flush()
+
     def flush(self):
+        """flush changes and import the metadata of new packages"""
+        if self.pending_metadata:
+            # all packages of an upload or import at once
+            import_metadata_into_db_many(self.pending_metadata, self.session)
+            self.pending_metadata = []
         self.session.flush()
 
     def __enter__(self):
@@ -678,6 +702,7 @@ class ArchiveUpload(object):
         group = cnf.get('Dinstall::UnprivGroup') or None
         self.directory = utils.temp_dirname(parent=cnf.get('Dir::TempPath'),
                                             mode=0o2750, group=group)
+        self.transaction.staging_directories.add(self.directory)
         with FilesystemTransaction() as fs:
             src = os.path.join(self.original_directory, self.original_changes.filename)
             dst = os.path.join(self.directory, self.original_changes.filename)
@@ -33,7 +33,6 @@ import daklib.lintian as lintian
 import daklib.utils as utils
 import daklib.upload
 
-import apt_inst
 import apt_pkg
 from apt_pkg import version_compare
 import datetime
@@ -129,6 +128,11 @@ class SignatureAndHashesCheck(Check):
         if not changes.valid_signature:
             raise Reject("Signature for .changes not valid.")
         self.check_replay(upload)
+
+        # read all files once, concurrently; the checks below and later
+        # ones take the hashes from the cache
+        workers = Config().find_i('Dinstall::HashWorkers', 4)
+        changes.file_cache.hash_files([f.input_filename for f in changes.files.itervalues()], workers)
         self._check_hashes(upload, changes.filename, changes.files.itervalues())
 
         source = None
@@ -141,6 +145,7 @@ class SignatureAndHashesCheck(Check):
                 raise Reject("Signature for .dsc not valid.")
             if source.primary_fingerprint != changes.primary_fingerprint:
                 raise Reject(".changes and .dsc not signed by the same key.")
+            changes.file_cache.hash_files([f.input_filename for f in source.files.itervalues()], workers)
             self._check_hashes(upload, source.filename, source.files.itervalues())
 
         if upload.fingerprint is None or upload.fingerprint.uid is None:
@@ -160,7 +165,7 @@ class SignatureAndHashesCheck(Check):
     def _check_hashes(self, upload, filename, files):
         try:
             for f in files:
-                f.check(upload.directory)
+                f.check(upload.directory, upload.changes.file_cache)
         except daklib.upload.FileDoesNotExist as e:
             raise Reject('{0}: {1}\n'
                          'Perhaps you need to include the file in your upload?'
@@ -405,16 +410,6 @@ class BinaryTimestampCheck(Check):
         future_cutoff = time.time() + cnf.find_i('Dinstall::FutureTimeTravelGrace', 24*3600)
         past_cutoff = time.mktime(time.strptime(cnf.find('Dinstall::PastCutoffYear', '1975'), '%Y'))
 
-        class TarTime(object):
-            def __init__(self):
-                self.future_files = dict()
-                self.past_files = dict()
-            def callback(self, member, data):
-                if member.mtime > future_cutoff:
-                    self.future_files[member.name] = member.mtime
-                elif member.mtime < past_cutoff:
-                    self.past_files[member.name] = member.mtime
-
         def format_reason(filename, direction, files):
             reason = "{0}: has {1} file(s) with a timestamp too far in the {2}:\n".format(filename, len(files), direction)
             for fn, ts in files.iteritems():
@@ -423,14 +418,13 @@ class BinaryTimestampCheck(Check):
 
         for binary in upload.changes.binaries:
             filename = binary.hashed_file.filename
-            path = os.path.join(upload.directory, filename)
-            deb = apt_inst.DebFile(path)
-            tar = TarTime()
-            deb.control.go(tar.callback)
-            if tar.future_files:
-                raise Reject(format_reason(filename, 'future', tar.future_files))
-            if tar.past_files:
-                raise Reject(format_reason(filename, 'past', tar.past_files))
+            mtimes = upload.changes.file_cache.deb_control(binary.hashed_file.input_filename).mtimes
+            future_files = dict((name, mtime) for name, mtime in mtimes.iteritems() if mtime > future_cutoff)
+            past_files = dict((name, mtime) for name, mtime in mtimes.iteritems() if mtime < past_cutoff)
+            if future_files:
+                raise Reject(format_reason(filename, 'future', future_files))
+            if past_files:
+                raise Reject(format_reason(filename, 'past', past_files))
 
 class SourceCheck(Check):
     """Check source package for syntax errors."""
@@ -19,11 +19,28 @@ Helper methods to deal with (de)compressing files
 """
 
 import daklib.config
+import daklib.daksubprocess
 
+import bz2
 import os
 import shutil
 import subprocess
 import tempfile
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 def decompress_xz(input, output):
     subprocess.check_call(["xz", "--decompress"], stdin=input, stdout=output)
@@ -50,3 +67,139 @@ def decompress(input, output, filename=None):
         decompressor(input, output)
     else:
         shutil.copyfileobj(input, output)
+
+class _StreamDecompressor(object):
+    """file object decompressing another file object incrementally
+
+    Concatenated streams (as written by pigz or pbzip2) are supported.
+    """
+    def __init__(self, fh, factory, chunk_size=65536):
+        self.fh = fh
+        self.factory = factory
+        self.chunk_size = chunk_size
+        self.decompressor = factory()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _decompress(self, data):
+        output = []
+        while data:
+            try:
+                output.append(self.decompressor.decompress(data))
+            except EOFError:
+                # previous stream ended exactly at a chunk boundary
+                self.decompressor = self.factory()
+                continue
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = self.factory()
+        return ''.join(output)
+
+    def _fill(self, size):
+        # only copy the unread rest of the buffer when more data is needed
+        pieces = [self.buffer[self.pos:]]
+        length = len(pieces[0])
+        while not self.eof and (size < 0 or length < size):
+            data = self.fh.read(self.chunk_size)
+            if not data:
+                self.eof = True
+                break
+            piece = self._decompress(data)
+            pieces.append(piece)
+            length += len(piece)
+        self.buffer = ''.join(pieces)
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size < 0 or len(self.buffer) - self.pos < size:
+            self._fill(size)
+        if size < 0:
+            data = self.buffer[self.pos:]
+        else:
+            data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.fh.close()
+
+class _PipeDecompressor(object):
+    """file object reading the output of an external decompressor"""
+    def __init__(self, fh, cmd):
+        self.cmd = cmd
+        if isinstance(fh, file):
+            self.process = daklib.daksubprocess.Popen(cmd, stdin=fh, stdout=subprocess.PIPE)
+            self.feeder = None
+            fh.close()
+        else:
+            # not backed by a file descriptor, pass the data on from a thread
+            self.process = daklib.daksubprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.feeder = threading.Thread(target=self._feed, args=(fh, self.process.stdin))
+            self.feeder.daemon = True
+            self.feeder.start()
+
+    def _feed(self, fh, stdin):
+        try:
+            shutil.copyfileobj(fh, stdin)
+        except IOError:
+            # the decompressor exited early, close() reports it
+            pass
+        finally:
+            stdin.close()
+            fh.close()
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        if self.feeder is not None:
+            self.feeder.join()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.cmd)
+
+def _gz_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def decompressed_fileobj(fh, compression):
+    """wrap a file object to read its decompressed content incrementally
+
+    @type  fh: file-like object
+    @param fh: object supporting C{read(size)} and C{close()}
+
+    @type  compression: str
+    @param compression: extension naming the compression (C{.gz}, C{.bz2},
+                        C{.xz} or C{.zst}); other values return C{fh}
+
+    @rtype:  file-like object
+    @return: object supporting C{read(size)} and C{close()}
+    """
+    if compression == '.gz':
+        return _StreamDecompressor(fh, _gz_decompressor)
+    elif compression == '.bz2':
+        return _StreamDecompressor(fh, bz2.BZ2Decompressor)
+    elif compression == '.xz':
+        if lzma is not None:
+            return _StreamDecompressor(fh, lzma.LZMADecompressor)
+        return _PipeDecompressor(fh, ["xz", "--decompress"])
+    elif compression == '.zst':
+        if zstandard is not None:
+            return zstandard.ZstdDecompressor().stream_reader(fh)
+        return _PipeDecompressor(fh, ["zstd", "--decompress", "--stdout"])
+    return fh
+
+def open_decompressed(filename, mode='r'):
+    """open a file for reading its decompressed content incrementally
+
+    The compression is determined by the extension of C{filename}; other
+    files are opened as they are. Decompression happens in-process, only
+    xz and zstd fall back to an external process when no Python module for
+    them is available.
+
+    @rtype:  file-like object
+    @return: object supporting C{read(size)} and C{close()}
+    """
+    base, ext = os.path.splitext(filename)
+    return decompressed_fileobj(open(filename, 'r'), ext)
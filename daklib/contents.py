@@ -26,14 +26,27 @@ Helper code for contents generation.
 ################################################################################
 
 from daklib.dbconn import *
+from daklib.compress import open_decompressed
 from daklib.config import Config
+from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS, PROC_STATUS_MISCFAILURE
+from daklib.debcontents import scan_contents
 from daklib.filewriter import BinaryContentsFileWriter, SourceContentsFileWriter
+from daklib.hashcache import HashCache
+from daklib.utils import copy_escape
 
+from hashlib import sha1
+from itertools import chain, groupby
 from multiprocessing import Pool
+from operator import itemgetter
 from shutil import rmtree
+from sqlalchemy.sql import text as sql_text
+from StringIO import StringIO
 from tempfile import mkdtemp
 
 import daklib.daksubprocess
+import gzip
+import heapq
+import json
 import os.path
 
 class BinaryContentsWriter(object):
@@ -47,23 +60,29 @@ class BinaryContentsWriter(object):
         self.component = component
         self.session = suite.session()
 
-    def query(self):
+    def params(self):
         '''
-        Returns a query object that is doing most of the work.
+        Returns the parameters for the queries.
         '''
         overridesuite = self.suite
         if self.suite.overridesuite is not None:
             overridesuite = get_suite(self.suite.overridesuite, self.session)
-        params = {
+        return {
             'suite':         self.suite.suite_id,
             'overridesuite': overridesuite.suite_id,
             'component':     self.component.component_id,
-            'arch_all':      get_architecture('all', self.session).arch_id,
+            'arch_all':      get_architecture_id('all', self.session),
             'arch':          self.architecture.arch_id,
             'type_id':       self.overridetype.overridetype_id,
             'type':          self.overridetype.overridetype,
         }
 
+    def query(self):
+        '''
+        Returns a query object that is doing most of the work.
+        '''
+        params = self.params()
+
         sql_create_temp = '''
 create temp table newest_binaries (
     id integer primary key,
@@ -138,9 +157,120 @@ select bc.file, string_agg(o.section || '/' || b.package, ',' order by b.package
         with open(filename) as header_file:
             return header_file.read()
 
+    def newest_binaries(self):
+        '''
+        Returns a dict mapping the ids of the binaries listed in the Contents
+        file to their (package, section).
+        '''
+        sql = '''
+select b.id, b.package, s.section
+    from (select distinct on (package) id, package from binaries
+            where type = :type and
+                (architecture = :arch_all or architecture = :arch) and
+                id in (select bin from bin_associations where suite = :suite)
+            order by package, version desc) b
+    join override o on o.package = b.package
+    join section s on s.id = o.section
+    where o.suite = :overridesuite and o.type = :type_id and
+        o.component = :component'''
+        result = self.session.execute(sql, self.params())
+        return dict((binary_id, (package, section)) for binary_id, package, section in result)
+
+    def fetch_entries(self, binaries):
+        '''
+        Yields (file, package, binary_id, section) for all files of the
+        binaries in the dict binaries (see newest_binaries()) in the order of
+        the Contents file.
+        '''
+        if len(binaries) == 0:
+            return
+        sql = '''
+select file, binary_id from bin_contents
+    where binary_id = any(:binary_ids)
+    order by file collate "C"'''
+        connection = self.session.connection().execution_options(stream_results = True)
+        result = connection.execute(sql_text(sql), binary_ids = list(binaries))
+        for filename, rows in groupby(result, key = itemgetter(0)):
+            entries = [(filename, binaries[binary_id][0], binary_id, binaries[binary_id][1]) \
+                for dummy, binary_id in rows]
+            entries.sort()
+            for entry in entries:
+                yield entry
+
+    def cache_name(self):
+        '''
+        Returns the name of the files in the ContentsCache.
+        '''
+        return '_'.join((self.suite.archive.archive_name, self.suite.suite_name, \
+            self.component.component_name, self.overridetype.overridetype, \
+            self.architecture.arch_string))
+
     def write_file(self):
         '''
-        Write the output file.
+        Write the output file. With Contents::CacheDir set, only the files of
+        binaries added since the last run are fetched from the database and
+        merged into the cached entries; nothing is written if neither the
+        binaries nor the header changed. Returns True if the file was written.
+        '''
+        cache_dir = Config().find('Contents::CacheDir')
+        if not cache_dir:
+            self.write_full()
+            return True
+
+        header = self.get_header()
+        cache = ContentsCache(cache_dir, self.cache_name())
+        binaries = self.newest_binaries()
+        removed = set(binary_id for binary_id, info in cache.binaries.iteritems() \
+            if binaries.get(binary_id) != info)
+        added = dict((binary_id, info) for binary_id, info in binaries.iteritems() \
+            if cache.binaries.get(binary_id) != info)
+
+        # binaries without any rows in bin_contents yet are tried again on
+        # the next run
+        seen = set()
+        def new_entries():
+            for entry in self.fetch_entries(added):
+                seen.add(entry[2])
+                yield entry
+        entries = new_entries()
+        first = next(entries, None)
+        if first is not None:
+            entries = chain([first], entries)
+
+        unchanged = first is None and len(removed) == 0 and \
+            cache.header == sha1(header).hexdigest() and \
+            len(cache.paths) > 0 and all(os.path.exists(path) for path in cache.paths)
+        if unchanged:
+            self.session.rollback()
+            return False
+
+        old_entries = (entry for entry in cache.entries() if entry[2] not in removed)
+        writer = self.writer()
+        file = writer.open()
+        file.write(header)
+        cache_writer = cache.open()
+        for filename, group in groupby(heapq.merge(old_entries, entries), key = itemgetter(0)):
+            group = list(group)
+            cache_writer.write(group)
+            package_list = ','.join(section + '/' + package \
+                for dummy, package, binary_id, section in group)
+            file.write(self.formatline(filename, package_list))
+        writer.close()
+
+        kept = dict((binary_id, info) for binary_id, info in cache.binaries.iteritems() \
+            if binary_id not in removed)
+        kept.update((binary_id, added[binary_id]) for binary_id in seen)
+        cache_writer.close(kept, sha1(header).hexdigest(), sorted(writer.written))
+
+        cache = HashCache(self.session)
+        cache.add_written_files(writer.hashes, writer.written)
+        cache.save()
+        self.session.commit()
+        return True
+
+    def write_full(self):
+        '''
+        Write the output file from scratch.
         '''
         writer = self.writer()
         file = writer.open()
@@ -148,7 +278,93 @@ select bc.file, string_agg(o.section || '/' || b.package, ',' order by b.package
         for item in self.fetch():
             file.write(item)
         writer.close()
+        cache = HashCache(self.session)
+        cache.add_written_files(writer.hashes, writer.written)
+        cache.save()
+        self.session.commit()
+
+
+def _read_lines(fh, chunk_size = 65536):
+    '''
+    Yields the lines of the file object fh without the newline.
+    '''
+    rest = ''
+    for chunk in iter(lambda: fh.read(chunk_size), ''):
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+class ContentsCache(object):
+    '''
+    ContentsCache keeps the entries (file, package, binary_id, section) of a
+    Contents file sorted on disk together with the binaries they belong to,
+    the hash of the header, and the paths of the written files.
+    '''
+    def __init__(self, directory, name):
+        self.entries_path = os.path.join(directory, name + '.gz')
+        self.state_path = os.path.join(directory, name + '.json')
+        self.binaries = {}
+        self.header = None
+        self.paths = []
+        if os.path.exists(self.entries_path) and os.path.exists(self.state_path):
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+            self.binaries = dict((int(binary_id), tuple(str(value) for value in info)) \
+                for binary_id, info in state['binaries'].iteritems())
+            self.header = state['header']
+            self.paths = [ str(path) for path in state['paths'] ]
+
+    def entries(self):
+        '''
+        Yields the cached entries in order.
+        '''
+        if not self.binaries:
+            return
+        fh = open_decompressed(self.entries_path)
+        try:
+            for line in _read_lines(fh):
+                filename, package, binary_id, section = line.split('\t')
+                yield (filename, package, int(binary_id), section)
+        finally:
+            fh.close()
+
+    def open(self):
+        '''
+        Returns a ContentsCacheWriter replacing the cache when it is closed.
+        '''
+        return ContentsCacheWriter(self)
 
+class ContentsCacheWriter(object):
+    '''
+    ContentsCacheWriter writes new entries of a ContentsCache.
+    '''
+    def __init__(self, cache):
+        self.cache = cache
+        directory = os.path.dirname(cache.entries_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = gzip.GzipFile(cache.entries_path + '.new', 'w', compresslevel = 1)
+
+    def write(self, entries):
+        '''
+        Appends entries which must follow the previous ones in order.
+        '''
+        self.file.write(''.join('%s\t%s\t%d\t%s\n' % entry for entry in entries))
+
+    def close(self, binaries, header, paths):
+        '''
+        Stores the binaries listed, the hash of the header, and the written
+        paths and replaces the old cache.
+        '''
+        self.file.close()
+        state = { 'binaries': binaries, 'header': header, 'paths': paths }
+        with open(self.cache.state_path + '.new', 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(self.cache.entries_path + '.new', self.cache.entries_path)
+        os.rename(self.cache.state_path + '.new', self.cache.state_path)
 
 class SourceContentsWriter(object):
     '''
@@ -232,6 +448,10 @@ select sc.file, string_agg(s.source, ',' order by s.source) as pkglist
         for item in self.fetch():
             file.write(item)
         writer.close()
+        cache = HashCache(self.session)
+        cache.add_written_files(writer.hashes, writer.written)
+        cache.save()
+        self.session.commit()
 
 
 def binary_helper(suite_id, arch_id, overridetype_id, component_id):
@@ -247,7 +467,8 @@ def binary_helper(suite_id, arch_id, overridetype_id, component_id):
     log_message = [suite.suite_name, architecture.arch_string, \
         overridetype.overridetype, component.component_name]
     contents_writer = BinaryContentsWriter(suite, architecture, overridetype, component)
-    contents_writer.write_file()
+    if not contents_writer.write_file():
+        log_message.append('unchanged')
     session.close()
     return log_message
 
@@ -296,8 +517,8 @@ class ContentsWriter(object):
             component_query = component_query.filter(Component.component_name.in_(component_names))
         if not force:
             suite_query = suite_query.filter(Suite.untouchable == False)
-        deb_id = get_override_type('deb', session).overridetype_id
-        udeb_id = get_override_type('udeb', session).overridetype_id
+        deb_id = get_override_type_id('deb', session)
+        udeb_id = get_override_type_id('udeb', session)
         pool = Pool()
         for suite in suite_query:
             suite_id = suite.suite_id
@@ -337,45 +558,86 @@ class BinaryContentsScanner(object):
         property. It commits any changes to the database. The argument dummy_arg
         is ignored but needed by our threadpool implementation.
         '''
-        session = DBConn().session()
-        binary = session.query(DBBinary).get(self.binary_id)
-        fileset = set(binary.scan_contents())
-        if len(fileset) == 0:
-            fileset.add('EMPTY_PACKAGE')
-        for filename in fileset:
-            binary.contents.append(BinContents(file = filename))
-        session.commit()
-        session.close()
+        status, message = binary_scan_helper([self.binary_id])
+        if status != PROC_STATUS_SUCCESS:
+            raise Exception(message)
 
     @classmethod
     def scan_all(class_, limit = None):
         '''
-        The class method scan_all() scans all binaries using multiple threads.
-        The number of binaries to be scanned can be limited with the limit
-        argument. Returns the number of processed and remaining packages as a
-        dict.
+        The class method scan_all() scans all binaries using multiple processes.
+        Each process scans a batch of binaries and loads their contents into the
+        database at once. The number of binaries to be scanned can be limited
+        with the limit argument. Returns the number of processed, remaining and
+        failed packages as a dict.
         '''
+        batch_size = Config().find_i('Contents::ScanBatchSize', 100)
+        pool = DakProcessPool()
         session = DBConn().session()
-        query = session.query(DBBinary).filter(DBBinary.contents == None)
+        query = session.query(DBBinary.binary_id).filter(DBBinary.contents == None) \
+            .order_by(DBBinary.binary_id)
         remaining = query.count
         if limit is not None:
             query = query.limit(limit)
-        processed = query.count()
-        pool = Pool()
-        for binary in query.yield_per(100):
-            pool.apply_async(binary_scan_helper, (binary.binary_id, ))
+        binary_ids = [ binary_id for binary_id, in query ]
+        processed = len(binary_ids)
+        for i in range(0, len(binary_ids), batch_size):
+            pool.apply_async(binary_scan_helper, (binary_ids[i:i + batch_size], ))
         pool.close()
         pool.join()
+        failed = 0
+        for status, message in pool.results:
+            if status != PROC_STATUS_SUCCESS:
+                failed += 1
+                print 'E: %s' % message
         remaining = remaining()
         session.close()
-        return { 'processed': processed, 'remaining': remaining }
+        return { 'processed': processed, 'remaining': remaining, 'failed': failed }
 
-def binary_scan_helper(binary_id):
+def binary_scan_helper(binary_ids):
     '''
-    This function runs in a subprocess.
+    This function runs in a subprocess. It scans the binaries given in the
+    list binary_ids and loads their contents into bin_contents with a single
+    COPY. Binaries that cannot be scanned or whose file is not in any archive
+    are reported in the returned error message.
     '''
-    scanner = BinaryContentsScanner(binary_id)
-    scanner.scan()
+    session = DBConn().session()
+    query = session.execute('''
+        SELECT DISTINCT ON (b.id) b.id, a.path, c.name, f.filename
+          FROM binaries b
+          JOIN files f ON f.id = b.file
+          JOIN files_archive_map af ON af.file_id = f.id
+          JOIN archive a ON a.id = af.archive_id
+          JOIN component c ON c.id = af.component_id
+         WHERE b.id = ANY(:binary_ids)
+         ORDER BY b.id, a.tainted DESC''', { 'binary_ids': binary_ids })
+    rows = StringIO()
+    errors = []
+    found = set()
+    for binary_id, archive_path, component_name, filename in query.fetchall():
+        found.add(binary_id)
+        fullpath = os.path.join(archive_path, 'pool', component_name, filename)
+        try:
+            fileset = set(scan_contents(fullpath))
+        except Exception as e:
+            errors.append('%s: %s' % (fullpath, e))
+            continue
+        if len(fileset) == 0:
+            fileset.add('EMPTY_PACKAGE')
+        for name in fileset:
+            rows.write('%d\t%s\n' % (binary_id, copy_escape(name)))
+    rows.seek(0)
+    cursor = session.connection().connection.cursor()
+    cursor.copy_from(rows, 'bin_contents', columns = ('binary_id', 'file'))
+    session.commit()
+    session.close()
+    missing = sorted(set(binary_ids) - found)
+    if missing:
+        errors.append('binaries not found in any archive: %s' % \
+            ', '.join(str(binary_id) for binary_id in missing))
+    if errors:
+        return (PROC_STATUS_MISCFAILURE, '; '.join(errors))
+    return (PROC_STATUS_SUCCESS, '%d packages scanned' % len(binary_ids))
 
 class UnpackedSource(object):
     '''
@@ -23,7 +23,6 @@ helper functions for cruft-report
 
 from daklib.dbconn import *
 
-from sqlalchemy import func
 from sqlalchemy.orm import object_session
 
 def newer_version(lowersuite_name, highersuite_name, session):
@@ -37,17 +36,27 @@ def newer_version(lowersuite_name, highersuite_name, session):
     lowersuite = get_suite(lowersuite_name, session)
     highersuite = get_suite(highersuite_name, session)
 
-    query = session.query(DBSource.source, func.max(DBSource.version)). \
-        with_parent(highersuite).group_by(DBSource.source)
-
-    list = []
-    for (source, higherversion) in query:
-        lowerversion = session.query(func.max(DBSource.version)). \
-            filter_by(source = source).filter(DBSource.version > higherversion). \
-            with_parent(lowersuite).group_by(DBSource.source).scalar()
-        if lowerversion is not None:
-            list.append((source, higherversion, lowerversion))
-
+    query = """
+    with newest_source as
+        (select s.source, sa.suite, max(s.version) as version
+            from source s
+            join src_associations sa on sa.source = s.id
+            where sa.suite in (:lowersuite_id, :highersuite_id)
+            group by s.source, sa.suite)
+    select hs.source, hs.version, ls.version
+        from newest_source hs
+        join newest_source ls
+            on ls.source = hs.source and ls.suite = :lowersuite_id
+        where hs.suite = :highersuite_id and ls.version > hs.version
+        order by hs.source"""
+    params = {
+        'lowersuite_id': lowersuite.suite_id,
+        'highersuite_id': highersuite.suite_id,
+    }
+
+    # session.execute() does not autoflush
+    session.flush()
+    list = [tuple(row) for row in session.execute(query, params)]
     list.sort()
     return list
 
@@ -116,12 +125,60 @@ def report_multiple_source(suite):
     print "Built from multiple source packages"
     print "-----------------------------------"
     print
-    for package, in get_package_names(suite):
-        binary = DejavuBinary(suite, package)
-        if binary.has_multiple_sources():
-            print binary
+    for package, sources in multiple_source_binaries(suite):
+        print "%s built by: %s" % (package, ", ".join(
+            "%s(%s)" % (source, versions) for source, versions in sources))
     print
 
+def multiple_source_binaries(suite):
+    '''
+    Generates the binary packages in suite built by source packages with
+    different names (see DejavuBinary) using a single query. Yields tuples
+    (package, sources) ordered by package name where sources is a list of
+    tuples (source, versions) ordered by source name and versions are all
+    versions of the source in suite as a comma separated string.
+    '''
+
+    session = object_session(suite)
+    query = """
+    with suite_sources as
+        (select s.id, s.source, s.version
+            from source s
+            join src_associations sa on sa.source = s.id
+            where sa.suite = :suite_id),
+    binary_sources as
+        (select distinct b.package, ss.source
+            from binaries b
+            join bin_associations ba on ba.bin = b.id
+            join suite_sources ss on b.source = ss.id
+            where ba.suite = :suite_id),
+    multiple_sources as
+        (select package, source,
+            count(*) over (partition by package) as source_count
+            from binary_sources),
+    source_versions as
+        (select source, string_agg(version::text, ', ' order by version) as versions
+            from suite_sources
+            group by source)
+    select ms.package, ms.source, sv.versions
+        from multiple_sources ms
+        join source_versions sv on sv.source = ms.source
+        where ms.source_count > 1
+        order by ms.package, ms.source"""
+
+    session.flush()
+    package = None
+    sources = []
+    for row_package, source, versions in session.execute(query, {'suite_id': suite.suite_id}):
+        if row_package != package:
+            if package is not None:
+                yield package, sources
+            package = row_package
+            sources = []
+        sources.append((source, versions))
+    if package is not None:
+        yield package, sources
+
 
 def query_without_source(suite_id, session):
     """searches for arch: all packages from suite that do no longer
@@ -75,16 +75,34 @@ def _func_wrapper(func, *args, **kwds):
         sqlalchemy.orm.session.Session.close_all()
 
 
+# sessions inherited from the parent process; see _init_worker
+_inherited_sessions = []
+
+def _init_worker(initializer, initargs):
+    # Sessions the parent opened before starting the pool are still
+    # registered with SQLAlchemy in the worker.  Closing them, as
+    # _func_wrapper does, would roll back the parent's transactions on the
+    # connections shared with it.  So they are kept referenced, but forgotten.
+    # DBConn gives the worker a connection pool of its own on first use.
+    registry = sqlalchemy.orm.session._sessions
+    _inherited_sessions.extend(registry.values())
+    registry.clear()
+
+    if initializer is not None:
+        initializer(*initargs)
+
 class DakProcessPool(Pool):
-    def __init__(self, *args, **kwds):
-        Pool.__init__(self, *args, **kwds)
+    def __init__(self, processes=None, initializer=None, initargs=(), *args, **kwds):
+        Pool.__init__(self, processes, _init_worker, (initializer, initargs), *args, **kwds)
         self.results = []
         self.int_results = []
 
     def apply_async(self, func, args=(), kwds={}, callback=None):
         wrapper_args = list(args)
         wrapper_args.insert(0, func)
-        self.int_results.append(Pool.apply_async(self, _func_wrapper, wrapper_args, kwds, callback))
+        result = Pool.apply_async(self, _func_wrapper, wrapper_args, kwds, callback)
+        self.int_results.append(result)
+        return result
 
     def join(self):
         Pool.join(self)
@@ -34,9 +34,10 @@
 ################################################################################
 
 import apt_pkg
+import cPickle
 import daklib.daksubprocess
+import daklib.debcontents
 import os
-from os.path import normpath
 import re
 import psycopg2
 import subprocess
@@ -52,7 +53,6 @@ except:
 from datetime import datetime, timedelta
 from errno import ENOENT
 from tempfile import mkstemp, mkdtemp
-from tarfile import TarFile
 
 from inspect import getargspec
 
@@ -172,6 +172,86 @@ __all__.append('session_wrapper')
 
 ################################################################################
 
+class LookupCache(object):
+    """
+    Per-process cache of the ids of rows in small tables (like architecture
+    or suite) looked up by name.
+
+    Ids and names of these rows do not change in normal operation, so a
+    cached id is used without asking the database. Mapped objects are only
+    loaded when they are asked for. Commands removing or renaming rows have
+    to call L{clear_lookup_cache}.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def get_id(self, session, cls, attributes, value):
+        """
+        Returns the primary key of the row of class C{cls} with the first of
+        C{attributes} matching C{value} (None if there is none).
+
+        A session is only opened if C{session} is None and the id is not
+        cached yet.
+        """
+        identity = self.entries.get((cls, value))
+        if identity is not None:
+            return identity
+
+        private_session = session is None
+        if private_session:
+            session = DBConn().session()
+        try:
+            obj = self._find(session, cls, attributes, value)
+            if obj is None:
+                return None
+            return object_mapper(obj).primary_key_from_instance(obj)[0]
+        finally:
+            if private_session:
+                session.close()
+
+    def get(self, session, cls, attributes, value):
+        """
+        Returns the object of class C{cls} with the first of C{attributes}
+        matching C{value} (None if there is none).
+        """
+        key = (cls, value)
+        identity = self.entries.get(key)
+        if identity is not None:
+            obj = session.query(cls).get(identity)
+            if obj is not None:
+                return obj
+            del self.entries[key]
+        return self._find(session, cls, attributes, value)
+
+    def _find(self, session, cls, attributes, value):
+        for attribute in attributes:
+            try:
+                obj = session.query(cls).filter_by(**{attribute: value}).one()
+            except NoResultFound:
+                continue
+            # a match on a later attribute stays valid only as long as no
+            # row matches an earlier one, so only cache the first
+            if attribute == attributes[0]:
+                self.entries[(cls, value)] = object_mapper(obj).primary_key_from_instance(obj)[0]
+            return obj
+
+        return None
+
+    def clear(self):
+        self.entries.clear()
+
+lookup_cache = LookupCache()
+
+def clear_lookup_cache():
+    """
+    Forgets all cached lookups, for example after renaming a suite.
+    """
+    lookup_cache.clear()
+
+__all__.append('clear_lookup_cache')
+
+################################################################################
+
 class ORMObject(object):
     """
     ORMObject is a base class for all ORM classes mapped by SQLalchemy. All
@@ -423,15 +503,31 @@ def get_architecture(architecture, session=None):
     @return: Architecture object for the given arch (None if not present)
     """
 
-    q = session.query(Architecture).filter_by(arch_string=architecture)
-
-    try:
-        return q.one()
-    except NoResultFound:
-        return None
+    return lookup_cache.get(session, Architecture, ('arch_string',), architecture)
 
 __all__.append('get_architecture')
 
+def get_architecture_id(architecture, session=None):
+    """
+    Returns database id for given C{architecture} without loading the
+    Architecture object. Only the first lookup per process needs the
+    database.
+
+    @type architecture: string
+    @param architecture: The name of the architecture
+
+    @type session: Session
+    @param session: Optional SQLA session object (a temporary one will be
+    generated if needed and not supplied)
+
+    @rtype: int
+    @return: the database id for the given architecture (None if not present)
+    """
+
+    return lookup_cache.get_id(session, Architecture, ('arch_string',), architecture)
+
+__all__.append('get_architecture_id')
+
 ################################################################################
 
 class Archive(object):
@@ -527,27 +623,11 @@ class DBBinary(ORMObject):
 
     def scan_contents(self):
         '''
-        Yields the contents of the package. Only regular files are yielded and
-        the path names are normalized after converting them from either utf-8
-        or iso8859-1 encoding. It yields the string ' <EMPTY PACKAGE>' if the
-        package does not contain any regular file.
+        Returns a generator of the names of all non-directory entries of the
+        package, see L{daklib.debcontents.scan_contents}. Nothing is
+        generated if the package does not contain any such entry.
         '''
-        fullpath = self.poolfile.fullpath
-        dpkg_cmd = ('dpkg-deb', '--fsys-tarfile', fullpath)
-        dpkg = daklib.daksubprocess.Popen(dpkg_cmd, stdout=subprocess.PIPE)
-        tar = TarFile.open(fileobj = dpkg.stdout, mode = 'r|')
-        for member in tar.getmembers():
-            if not member.isdir():
-                name = normpath(member.name)
-                # enforce proper utf-8 encoding
-                try:
-                    name.decode('utf-8')
-                except UnicodeDecodeError:
-                    name = name.decode('iso8859-1').encode('utf-8')
-                yield name
-        tar.close()
-        dpkg.stdout.close()
-        dpkg.wait()
+        return daklib.debcontents.scan_contents(self.poolfile.fullpath)
 
     def read_control(self):
         '''
@@ -682,12 +762,7 @@ def get_component(component, session=None):
     """
     component = component.lower()
 
-    q = session.query(Component).filter_by(component_name=component)
-
-    try:
-        return q.one()
-    except NoResultFound:
-        return None
+    return lookup_cache.get(session, Component, ('component_name',), component)
 
 __all__.append('get_component')
 
@@ -1392,15 +1467,31 @@ def get_override_type(override_type, session=None):
     @return: the database id for the given override type
     """
 
-    q = session.query(OverrideType).filter_by(overridetype=override_type)
-
-    try:
-        return q.one()
-    except NoResultFound:
-        return None
+    return lookup_cache.get(session, OverrideType, ('overridetype',), override_type)
 
 __all__.append('get_override_type')
 
+def get_override_type_id(override_type, session=None):
+    """
+    Returns database id for given C{override type} without loading the
+    OverrideType object. Only the first lookup per process needs the
+    database.
+
+    @type override_type: string
+    @param override_type: The name of the override type
+
+    @type session: Session
+    @param session: Optional SQLA session object (a temporary one will be
+    generated if needed and not supplied)
+
+    @rtype: int
+    @return: the database id for the given override type (None if not present)
+    """
+
+    return lookup_cache.get_id(session, OverrideType, ('overridetype',), override_type)
+
+__all__.append('get_override_type_id')
+
 ################################################################################
 
 class PolicyQueue(object):
@@ -1505,15 +1596,30 @@ def get_priority(priority, session=None):
     @return: Priority object for the given priority
     """
 
-    q = session.query(Priority).filter_by(priority=priority)
-
-    try:
-        return q.one()
-    except NoResultFound:
-        return None
+    return lookup_cache.get(session, Priority, ('priority',), priority)
 
 __all__.append('get_priority')
 
+def get_priority_id(priority, session=None):
+    """
+    Returns database id for given C{priority name} without loading the
+    Priority object. Only the first lookup per process needs the database.
+
+    @type priority: string
+    @param priority: The name of the priority
+
+    @type session: Session
+    @param session: Optional SQLA session object (a temporary one will be
+    generated if needed and not supplied)
+
+    @rtype: int
+    @return: the database id for the given priority (None if not present)
+    """
+
+    return lookup_cache.get_id(session, Priority, ('priority',), priority)
+
+__all__.append('get_priority_id')
+
 @session_wrapper
 def get_priorities(session=None):
     """
@@ -1578,12 +1684,7 @@ def get_section(section, session=None):
     @return: Section object for the given section name
     """
 
-    q = session.query(Section).filter_by(section=section)
-
-    try:
-        return q.one()
-    except NoResultFound:
-        return None
+    return lookup_cache.get(session, Section, ('section',), section)
 
 __all__.append('get_section')
 
@@ -1810,32 +1911,75 @@ def get_source_in_suite(source, suite_name, session=None):
 
 __all__.append('get_source_in_suite')
 
+def _encode_metadata_value(value):
+    try:
+        # Try raw ASCII
+        return str(value)
+    except UnicodeEncodeError:
+        # Fall back to UTF-8
+        try:
+            return value.encode('utf-8')
+        except UnicodeEncodeError:
+            # Finally try iso8859-1
+            # Otherwise we allow the exception to percolate up and we cause
+            # a reject as someone is playing silly buggers
+            return value.encode('iso8859-1')
+
 @session_wrapper
 def import_metadata_into_db(obj, session=None):
     """
     This routine works on either DBBinary or DBSource objects and imports
     their metadata into the database
     """
-    fields = obj.read_control_fields()
-    for k in fields.keys():
-        try:
-            # Try raw ASCII
-            val = str(fields[k])
-        except UnicodeEncodeError:
-            # Fall back to UTF-8
-            try:
-                val = fields[k].encode('utf-8')
-            except UnicodeEncodeError:
-                # Finally try iso8859-1
-                val = fields[k].encode('iso8859-1')
-                # Otherwise we allow the exception to percolate up and we cause
-                # a reject as someone is playing silly buggers
+    import_metadata_into_db_many([obj], session)
+
+__all__.append('import_metadata_into_db')
+
+# number of rows inserted by a single statement
+METADATA_INSERT_BATCH_SIZE = 1000
+
+@session_wrapper
+def import_metadata_into_db_many(objs, session=None):
+    """
+    Imports the metadata of several DBBinary or DBSource objects using
+    multi-row inserts. The objects must not have any metadata yet.
 
-        obj.metadata[get_or_set_metadatakey(k, session)] = val
+    @type objs: list of L{DBBinary} or L{DBSource}
+    @param objs: flushed objects to import the control fields of
+    """
+    session.flush()
+
+    rows = {'binaries_metadata': [], 'source_metadata': []}
+    for obj in objs:
+        if isinstance(obj, DBBinary):
+            table, obj_id = 'binaries_metadata', obj.binary_id
+        else:
+            table, obj_id = 'source_metadata', obj.source_id
+        fields = obj.read_control_fields()
+        for k in fields.keys():
+            rows[table].append((obj_id, get_metadatakey_id(k, session), _encode_metadata_value(fields[k])))
+
+    for table, table_rows in rows.iteritems():
+        id_column = 'bin_id' if table == 'binaries_metadata' else 'src_id'
+        for start in xrange(0, len(table_rows), METADATA_INSERT_BATCH_SIZE):
+            batch = table_rows[start:start + METADATA_INSERT_BATCH_SIZE]
+            values = []
+            params = {}
+            for i, (obj_id, key_id, value) in enumerate(batch):
+                values.append('(:id%d, :key%d, :value%d)' % (i, i, i))
+                params['id%d' % i] = obj_id
+                params['key%d' % i] = key_id
+                params['value%d' % i] = value
+            session.execute('INSERT INTO %s (%s, key_id, value) VALUES %s' % (table, id_column, ', '.join(values)),
+                            params)
+
+    # the metadata was inserted behind the back of the ORM
+    for obj in objs:
+        session.expire(obj, ['key'])
 
     session.commit_or_flush()
 
-__all__.append('import_metadata_into_db')
+__all__.append('import_metadata_into_db_many')
 
 ################################################################################
 
@@ -1976,26 +2120,9 @@ def get_suite(suite, session=None):
     @return: Suite object for the requested suite name (None if not present)
     """
 
-    # Start by looking for the dak internal name
-    q = session.query(Suite).filter_by(suite_name=suite)
-    try:
-        return q.one()
-    except NoResultFound:
-        pass
-
-    # Now try codename
-    q = session.query(Suite).filter_by(codename=suite)
-    try:
-        return q.one()
-    except NoResultFound:
-        pass
-
-    # Finally give release_suite a try
-    q = session.query(Suite).filter_by(release_suite=suite)
-    try:
-        return q.one()
-    except NoResultFound:
-        return None
+    # Start by looking for the dak internal name, then try codename and
+    # finally give release_suite a try
+    return lookup_cache.get(session, Suite, ('suite_name', 'codename', 'release_suite'), suite)
 
 __all__.append('get_suite')
 
@@ -2152,6 +2279,43 @@ def get_or_set_metadatakey(keyname, session=None):
 
 __all__.append('get_or_set_metadatakey')
 
+# ids of committed metadata keys, shared by the whole process
+_metadata_key_ids = None
+
+def get_metadatakey_id(keyname, session):
+    """
+    Returns the id of the metadata key I{keyname}, adding the key if needed.
+
+    All keys existing when this is first called are read at once and
+    remembered for the lifetime of the process, as keys are never removed.
+    Keys added later are looked up in the database every time as the
+    transaction adding them might still be rolled back.
+
+    @type keyname: string
+    @param keyname: The keyname to look up
+
+    @type session: SQLAlchemy
+    @param session: SQL session object used to add missing keys
+
+    @rtype: int
+    @return: the id of the metadatakey
+    """
+    global _metadata_key_ids
+    if _metadata_key_ids is None:
+        # use a separate session to only see committed keys
+        private_session = DBConn().session()
+        try:
+            _metadata_key_ids = dict(private_session.query(MetadataKey.key, MetadataKey.key_id))
+        finally:
+            private_session.close()
+
+    key_id = _metadata_key_ids.get(keyname)
+    if key_id is None:
+        key_id = get_or_set_metadatakey(keyname, session).key_id
+    return key_id
+
+__all__.append('get_metadatakey_id')
+
 ################################################################################
 
 class BinaryMetadata(ORMObject):
@@ -2336,14 +2500,76 @@ class DBConn(object):
             'suite_arch_by_name',
         )
 
+        if not self.__load_metadata():
+            for table_name in tables:
+                Table(table_name, self.db_meta, autoload=True, useexisting=True)
+            for view_name in views:
+                Table(view_name, self.db_meta, autoload=True)
+            self.__save_metadata()
+
         for table_name in tables:
-            table = Table(table_name, self.db_meta, \
-                autoload=True, useexisting=True)
-            setattr(self, 'tbl_%s' % table_name, table)
+            setattr(self, 'tbl_%s' % table_name, self.db_meta.tables[table_name])
 
         for view_name in views:
-            view = Table(view_name, self.db_meta, autoload=True)
-            setattr(self, 'view_%s' % view_name, view)
+            setattr(self, 'view_%s' % view_name, self.db_meta.tables[view_name])
+
+    def __metadata_filename(self):
+        """
+        Returns the name of the file caching the reflected tables of the
+        current database schema or None if no cache should be used.
+        """
+        directory = Config().get('Dir::Cache')
+        if not directory:
+            return None
+        revision = self.db_pg.execute("SELECT value FROM config WHERE name = 'db_revision'").scalar()
+        return os.path.join(directory, 'db-metadata-%s-%s.pkl' % (revision, sqlalchemy.__version__))
+
+    def __load_metadata(self):
+        """
+        Replaces db_meta by the cached reflection of the database schema.
+        Returns False if there is no usable cache.
+        """
+        from daklib.utils import open_cache_file
+        self.metadata_filename = self.__metadata_filename()
+        if self.metadata_filename is None:
+            return False
+        try:
+            fh = open_cache_file(self.metadata_filename)
+            if fh is None:
+                return False
+            with fh:
+                db_meta = cPickle.load(fh)
+        except (IOError, OSError):
+            # caching is optional
+            return False
+        except Exception:
+            # unreadable or incompatible cache, reflect again
+            return False
+        if not isinstance(db_meta, MetaData):
+            return False
+        db_meta.bind = self.db_pg
+        self.db_meta = db_meta
+        return True
+
+    def __save_metadata(self):
+        if self.metadata_filename is None:
+            return
+        directory = os.path.dirname(self.metadata_filename)
+        try:
+            fd, tmp = mkstemp(dir=directory, prefix='.db-metadata.')
+        except (IOError, OSError):
+            # caching is optional
+            return
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                cPickle.dump(self.db_meta, fh, cPickle.HIGHEST_PROTOCOL)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, self.metadata_filename)
+        except (IOError, OSError):
+            os.unlink(tmp)
+        except:
+            os.unlink(tmp)
+            raise
 
     def __setupmappers(self):
         mapper(Architecture, self.tbl_architecture,
@@ -2662,6 +2888,19 @@ class DBConn(object):
             utils.fubar("Cannot connect to database (%s)" % str(e))
 
         self.pid = os.getpid()
+        self.inherited_pools = []
+
+    def __reset_pool(self):
+        """
+        Gives the engine an empty connection pool after a fork.
+
+        The connections inherited from the parent process must neither be
+        used nor closed: closing them would also end the parent's database
+        sessions. So the old pool is kept referenced, but no longer used.
+        """
+        self.inherited_pools.append(self.db_pg.pool)
+        self.db_pg.pool = self.db_pg.pool.recreate()
+        self.pid = os.getpid()
 
     def session(self, work_mem = 0):
         '''
@@ -2670,10 +2909,10 @@ class DBConn(object):
         transaction. The work_mem parameter is measured in MB. A default value
         will be used if the parameter is not set.
         '''
-        # reinitialize DBConn in new processes
+        # new processes keep the tables and mappers, but must not share
+        # database connections with their parent
         if self.pid != os.getpid():
-            clear_mappers()
-            self.__createconn()
+            self.__reset_pool()
         session = self.db_smaker()
         if work_mem > 0:
             session.execute("SET LOCAL work_mem TO '%d MB'" % work_mem)
@@ -0,0 +1,141 @@
+# Copyright (C) 2016, Debian FTP Masters <ftpmaster@debian.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""read the list of files in binary packages
+
+The data.tar member of a .deb is located by reading the ar archive and
+decompressed while it is read, so no dpkg-deb process is needed per
+package. Packages in other formats are still passed to dpkg-deb.
+"""
+
+from daklib.compress import decompressed_fileobj
+import daklib.daksubprocess
+
+from os.path import normpath
+from tarfile import TarFile
+import subprocess
+
+class DebContentsError(Exception):
+    """the package cannot be read by this module"""
+    pass
+
+AR_MAGIC = '!<arch>\n'
+AR_HEADER_SIZE = 60
+
+#: supported compressions of the data.tar member
+DATA_MEMBERS = {
+    'data.tar': '',
+    'data.tar.gz': '.gz',
+    'data.tar.bz2': '.bz2',
+    'data.tar.xz': '.xz',
+    'data.tar.zst': '.zst',
+}
+
+class _MemberReader(object):
+    """file object limited to the data of a single ar member"""
+    def __init__(self, fh, size):
+        self.fh = fh
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fh.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.fh.close()
+
+def open_data_tar(filename):
+    """open the uncompressed data.tar member of a .deb
+
+    @rtype:  file-like object
+    @return: object supporting C{read(size)} and C{close()}
+
+    @raise DebContentsError: the file is no .deb or uses an unsupported
+                             compression
+    """
+    fh = open(filename, 'r')
+    try:
+        if fh.read(len(AR_MAGIC)) != AR_MAGIC:
+            raise DebContentsError('{0}: not an ar archive'.format(filename))
+        while True:
+            header = fh.read(AR_HEADER_SIZE)
+            if len(header) == 0:
+                raise DebContentsError('{0}: no data.tar member'.format(filename))
+            if len(header) != AR_HEADER_SIZE or header[58:60] != '`\n':
+                raise DebContentsError('{0}: invalid ar header'.format(filename))
+            name = header[0:16].rstrip(' ').rstrip('/')
+            size = int(header[48:58])
+            if name.startswith('data.tar'):
+                if name not in DATA_MEMBERS:
+                    raise DebContentsError('{0}: unsupported member {1}'.format(filename, name))
+                return decompressed_fileobj(_MemberReader(fh, size), DATA_MEMBERS[name])
+            # members are padded to an even size
+            fh.seek(size + size % 2, 1)
+    except:
+        fh.close()
+        raise
+
+def scan_data_tar(data):
+    """yield the names of all non-directory entries of a tar stream
+
+    The names are normalized and converted to utf-8 if they are not
+    valid utf-8 (assuming iso8859-1).
+
+    @type  data: file-like object
+    @param data: uncompressed tar archive as returned by L{open_data_tar}
+    """
+    tar = TarFile.open(fileobj=data, mode='r|')
+    for member in tar:
+        if not member.isdir():
+            name = normpath(member.name)
+            # enforce proper utf-8 encoding
+            try:
+                name.decode('utf-8')
+            except UnicodeDecodeError:
+                name = name.decode('iso8859-1').encode('utf-8')
+            yield name
+    tar.close()
+
+def scan_contents(filename):
+    """yield the names of all non-directory entries of a .deb
+
+    See L{scan_data_tar}. Packages L{open_data_tar} cannot handle are read
+    using C{dpkg-deb --fsys-tarfile}.
+    """
+    try:
+        data = open_data_tar(filename)
+    except DebContentsError:
+        data = None
+
+    if data is not None:
+        try:
+            for name in scan_data_tar(data):
+                yield name
+        finally:
+            data.close()
+        return
+
+    dpkg_cmd = ('dpkg-deb', '--fsys-tarfile', filename)
+    dpkg = daklib.daksubprocess.Popen(dpkg_cmd, stdout=subprocess.PIPE)
+    try:
+        for name in scan_data_tar(dpkg.stdout):
+            yield name
+    finally:
+        dpkg.stdout.close()
+        dpkg.wait()
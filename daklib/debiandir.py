@@ -0,0 +1,174 @@
+# Copyright (C) 2016, Debian FTP Masters <ftpmaster@debian.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""read files from the debian/ directory of source packages
+
+Only the part of the source package providing debian/ is read: the
+.debian.tar of a 3.0 (quilt) package, the .diff.gz of a 1.0 package or the
+tarball of a native package. Nothing is unpacked to disk.
+"""
+
+from daklib.compress import decompressed_fileobj
+
+from os.path import normpath
+from tarfile import TarFile
+import gzip
+import re
+
+class DebianDirError(Exception):
+    """the debian/ directory cannot be read without unpacking the source"""
+    pass
+
+re_debian_tar = re.compile(r'\.debian\.tar(\.gz|\.bz2|\.xz)?$')
+re_diff_gz = re.compile(r'\.diff\.gz$')
+re_tar = re.compile(r'\.tar(\.gz|\.bz2|\.xz)?$')
+re_orig_tar = re.compile(r'\.orig(-[a-zA-Z0-9-]+)?\.tar(\.gz|\.bz2|\.xz)?(\.asc)?$')
+re_hunk = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+def _wanted(name, suffixes):
+    return not name.startswith('.') and '/' not in name \
+        and any(name.endswith(suffix) for suffix in suffixes)
+
+def _read_tar(filename, compression, suffixes, strip):
+    """read wanted files in debian/ from a tarball
+
+    @type  strip: bool
+    @param strip: the tarball has a top-level directory in front of debian/
+    """
+    result = {}
+    fh = decompressed_fileobj(open(filename, 'r'), compression)
+    try:
+        tar = TarFile.open(fileobj=fh, mode='r|')
+        for member in tar:
+            name = normpath(member.name)
+            if strip:
+                parts = name.split('/', 1)
+                if len(parts) != 2:
+                    continue
+                name = parts[1]
+            if not name.startswith('debian/'):
+                continue
+            name = name[len('debian/'):]
+            if not _wanted(name, suffixes):
+                continue
+            if not member.isfile():
+                raise DebianDirError('{0}: debian/{1} is not a regular file'.format(filename, name))
+            result[name] = tar.extractfile(member).read()
+        tar.close()
+    finally:
+        fh.close()
+    return result
+
+def _read_diff(filename, suffixes):
+    """read wanted files in debian/ created by a .diff.gz
+
+    Files the diff modifies instead of creating would need the original
+    tarball and cause a L{DebianDirError}.
+    """
+    result = {}
+    name = None
+    lines = None
+    old_remaining = new_remaining = 0
+
+    fh = gzip.GzipFile(filename, 'r')
+    try:
+        for line in fh:
+            if line.startswith('\\'):
+                # "\ No newline at end of file" refers to the previous line
+                if name is not None and lines:
+                    lines[-1] = lines[-1].rstrip('\n')
+                continue
+            if old_remaining > 0 or new_remaining > 0:
+                if line.startswith('+'):
+                    new_remaining -= 1
+                elif line.startswith('-'):
+                    old_remaining -= 1
+                else:
+                    old_remaining -= 1
+                    new_remaining -= 1
+                if name is not None:
+                    lines.append(line[1:])
+                continue
+
+            if line.startswith('+++ '):
+                if name is not None:
+                    result[name] = ''.join(lines)
+                path = normpath(line[4:].rstrip('\n').split('\t')[0])
+                parts = path.split('/', 1)
+                name = None
+                if len(parts) == 2 and parts[1].startswith('debian/') \
+                        and _wanted(parts[1][len('debian/'):], suffixes):
+                    name = parts[1][len('debian/'):]
+                    lines = None
+            elif line.startswith('@@'):
+                match = re_hunk.match(line)
+                if match is None:
+                    raise DebianDirError('{0}: invalid hunk header'.format(filename))
+                old_remaining = int(match.group(2)) if match.group(2) is not None else 1
+                new_remaining = int(match.group(4)) if match.group(4) is not None else 1
+                if name is not None:
+                    if lines is not None or old_remaining != 0:
+                        raise DebianDirError('{0}: debian/{1} is modified, not created'.format(filename, name))
+                    lines = []
+        if name is not None:
+            result[name] = ''.join(lines or [])
+    finally:
+        fh.close()
+
+    if 'changelog' not in result:
+        # the original tarball might ship debian/
+        raise DebianDirError('{0}: does not create debian/changelog'.format(filename))
+    return result
+
+def read_debian_files(directory, filenames, suffixes):
+    """read files from the debian/ directory of a source package
+
+    Only files directly in debian/ whose name ends with one of C{suffixes}
+    are returned, like C{glob('debian/*' + suffix)} on the unpacked source.
+
+    @type  directory: str
+    @param directory: directory containing the files of the source package
+
+    @type  filenames: list of str
+    @param filenames: names of the files of the source package (from the .dsc)
+
+    @type  suffixes: list of str
+    @param suffixes: file name suffixes to look for
+
+    @rtype:  dict
+    @return: mapping of file name (relative to debian/) to content
+
+    @raise DebianDirError: the source package has to be unpacked to get the
+                           files, for example because it uses a format not
+                           handled here
+    """
+    debian_tars = [ f for f in filenames if re_debian_tar.search(f) ]
+    diffs = [ f for f in filenames if re_diff_gz.search(f) ]
+    tars = [ f for f in filenames if re_tar.search(f) and not re_orig_tar.search(f) ]
+
+    if len(debian_tars) == 1:
+        name = debian_tars[0]
+        compression = re_debian_tar.search(name).group(1) or ''
+        return _read_tar('{0}/{1}'.format(directory, name), compression, suffixes, strip=False)
+    elif len(diffs) == 1 and len(tars) == 0:
+        return _read_diff('{0}/{1}'.format(directory, diffs[0]), suffixes)
+    elif len(tars) == 1 and len(diffs) == 0 and len(debian_tars) == 0 \
+            and not any(re_orig_tar.search(f) for f in filenames):
+        name = tars[0]
+        compression = re_tar.search(name).group(1) or ''
+        return _read_tar('{0}/{1}'.format(directory, name), compression, suffixes, strip=True)
+
+    raise DebianDirError('{0}: unsupported source format'.format(directory))
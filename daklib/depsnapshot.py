@@ -0,0 +1,396 @@
+# Copyright (C) 2016, Debian FTP Masters <ftpmaster@debian.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""pre-parsed dependency information of a suite
+
+A L{DependencySnapshot} holds the Depends and Provides of all binaries and
+the Build-Depends(-Indep) of all sources in a suite, already parsed. Names
+are interned to integer ids and relations are stored in arrays, so the
+snapshot is small and fast to load. Snapshots are saved below
+C{Dir::Cache} and reused as long as the associations of the suite do not
+change.
+"""
+
+import apt_pkg
+import cPickle
+import errno
+import os
+import tempfile
+from array import array
+
+from daklib.config import Config
+from daklib.dbconn import get_or_set_metadatakey
+from daklib.regexes import re_build_dep_arch
+
+#: bumped whenever the format of the snapshot changes
+SNAPSHOT_FORMAT = 1
+
+class _Relations(object):
+    """relations of the packages of one architecture (or of all sources)
+
+    Package i is named C{package[i]}; its clauses are
+    C{clauses[clause_offsets[i]:clause_offsets[i+1]]} and the virtual
+    packages it provides
+    C{provides[provides_offsets[i]:provides_offsets[i+1]]}.
+    """
+    __slots__ = ('package', 'source', 'component', 'clause_offsets', 'clauses',
+                 'provides_offsets', 'provides')
+
+    def __init__(self):
+        self.package = array('i')
+        self.source = array('i')
+        self.component = array('i')
+        self.clause_offsets = array('i', [0])
+        self.clauses = array('i')
+        self.provides_offsets = array('i', [0])
+        self.provides = array('i')
+
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot in self.__slots__:
+            setattr(self, slot, state[slot])
+
+    def __len__(self):
+        return len(self.package)
+
+class DependencySnapshot(object):
+    """dependencies of all packages in a suite
+
+    Use L{load_snapshot} to get an up-to-date snapshot.
+    """
+    def __init__(self, suite_name, key):
+        self.suite_name = suite_name
+        self.key = key
+        self.format = SNAPSHOT_FORMAT
+        #: interned strings (package, source, component names)
+        self.names = []
+        #: (name id, version, constraint) of each dependency atom
+        self.atoms = []
+        #: atoms of clause i are atom_ids[atom_offsets[i]:atom_offsets[i+1]]
+        self.atom_offsets = array('i', [0])
+        self.atom_ids = array('i')
+        #: L{_Relations} for each architecture (including "all")
+        self.binaries = {}
+        #: L{_Relations} of the build dependencies of all sources
+        self.sources = _Relations()
+        self._init_caches()
+
+    def _init_caches(self):
+        self._name_ids = None
+        self._atom_index = None
+        self._clause_index = None
+        self._clause_cache = {}
+        self._clause_names_cache = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('_name_ids', '_atom_index', '_clause_index', '_clause_cache', '_clause_names_cache'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_caches()
+
+    def _intern(self, name):
+        if self._name_ids is None:
+            self._name_ids = dict((n, i) for i, n in enumerate(self.names))
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def _clause_id(self, dep):
+        if self._clause_index is None:
+            self._atom_index = dict((atom, i) for i, atom in enumerate(self.atoms))
+            self._clause_index = dict((tuple(self.atom_ids[self.atom_offsets[i]:self.atom_offsets[i + 1]]), i)
+                                      for i in xrange(len(self.atom_offsets) - 1))
+        atom_ids = []
+        for package, version, constraint in dep:
+            atom = (self._intern(package), version, constraint)
+            atom_id = self._atom_index.get(atom)
+            if atom_id is None:
+                atom_id = self._atom_index[atom] = len(self.atoms)
+                self.atoms.append(atom)
+            atom_ids.append(atom_id)
+        atom_ids = tuple(atom_ids)
+        clause_id = self._clause_index.get(atom_ids)
+        if clause_id is None:
+            clause_id = self._clause_index[atom_ids] = len(self.atom_offsets) - 1
+            self.atom_ids.extend(atom_ids)
+            self.atom_offsets.append(len(self.atom_ids))
+        return clause_id
+
+    def _add(self, relations, package, source, component, parsed_depends, provides):
+        relations.package.append(self._intern(package))
+        relations.source.append(self._intern(source) if source is not None else -1)
+        relations.component.append(self._intern(component) if component is not None else -1)
+        relations.clauses.extend(self._clause_id(dep) for dep in parsed_depends)
+        relations.clause_offsets.append(len(relations.clauses))
+        relations.provides.extend(self._intern(p) for p in provides)
+        relations.provides_offsets.append(len(relations.provides))
+
+    def clause(self, clause_id):
+        """dependency clause in the format returned by C{apt_pkg.parse_depends}
+
+        @rtype:  list of (str, str, str)
+        @return: alternatives of the clause as (package, version, constraint)
+        """
+        result = self._clause_cache.get(clause_id)
+        if result is None:
+            names = self.names
+            atoms = self.atoms
+            result = self._clause_cache[clause_id] = [
+                (names[atoms[a][0]], atoms[a][1], atoms[a][2])
+                for a in self.atom_ids[self.atom_offsets[clause_id]:self.atom_offsets[clause_id + 1]]]
+        return result
+
+    def clause_names(self, clause_id):
+        """names of the packages satisfying a clause
+
+        @rtype:  frozenset of str
+        """
+        result = self._clause_names_cache.get(clause_id)
+        if result is None:
+            result = self._clause_names_cache[clause_id] = frozenset(d[0] for d in self.clause(clause_id))
+        return result
+
+    def architectures(self):
+        """architectures with binaries in the snapshot (including "all")"""
+        return self.binaries.keys()
+
+    def binary_packages(self, architecture):
+        """iterate over the binaries of an architecture
+
+        Arch: all packages are only returned for architecture "all".
+
+        @rtype:  generator of (str, str, str, list of int, list of str)
+        @return: (package, source, component, clause ids, provides)
+        """
+        relations = self.binaries.get(architecture)
+        if relations is None:
+            return
+        names = self.names
+        for i in xrange(len(relations)):
+            yield (names[relations.package[i]],
+                   names[relations.source[i]],
+                   names[relations.component[i]],
+                   relations.clauses[relations.clause_offsets[i]:relations.clause_offsets[i + 1]],
+                   [names[p] for p in relations.provides[relations.provides_offsets[i]:relations.provides_offsets[i + 1]]])
+
+    def source_packages(self):
+        """iterate over the build dependencies of all sources
+
+        Architecture restrictions are removed from the build dependencies.
+
+        @rtype:  generator of (str, list of int)
+        @return: (source, clause ids)
+        """
+        relations = self.sources
+        names = self.names
+        for i in xrange(len(relations)):
+            yield (names[relations.package[i]],
+                   relations.clauses[relations.clause_offsets[i]:relations.clause_offsets[i + 1]])
+
+def snapshot_key(session, suite):
+    """key identifying the current state of a suite
+
+    Every change of the associations of the suite changes the number of
+    associations or the sum of their ids (ids are never reused).
+
+    @type  suite: L{daklib.dbconn.Suite}
+    @rtype: str
+    """
+    statement = '''
+        SELECT
+          (SELECT count(*) || '/' || coalesce(sum(id), 0) FROM bin_associations WHERE suite = :suite_id),
+          (SELECT count(*) || '/' || coalesce(sum(id), 0) FROM src_associations WHERE suite = :suite_id),
+          (SELECT string_agg(a.arch_string, ' ' ORDER BY a.arch_string)
+             FROM suite_architectures sa JOIN architecture a ON sa.architecture = a.id
+            WHERE sa.suite = :suite_id)'''
+    row = session.execute(statement, {'suite_id': suite.suite_id}).fetchone()
+    return ' '.join('{0}'.format(value) for value in row)
+
+def build_snapshot(session, suite, key=None):
+    """read the dependencies of a suite from the database
+
+    @type  suite: L{daklib.dbconn.Suite}
+
+    @type  key: str
+    @param key: result of L{snapshot_key}, computed if not given
+
+    @rtype: L{DependencySnapshot}
+    """
+    if key is None:
+        key = snapshot_key(session, suite)
+    snapshot = DependencySnapshot(suite.suite_name, key)
+
+    metakey_d = get_or_set_metadatakey("Depends", session)
+    metakey_p = get_or_set_metadatakey("Provides", session)
+    params = {
+        'suite_id':     suite.suite_id,
+        'archive_id':   suite.archive_id,
+        'metakey_d_id': metakey_d.key_id,
+        'metakey_p_id': metakey_p.key_id,
+    }
+    statement = '''
+        SELECT b.package, a.arch_string, s.source, c.name as component,
+            (SELECT bmd.value FROM binaries_metadata bmd WHERE bmd.bin_id = b.id AND bmd.key_id = :metakey_d_id) AS depends,
+            (SELECT bmp.value FROM binaries_metadata bmp WHERE bmp.bin_id = b.id AND bmp.key_id = :metakey_p_id) AS provides
+            FROM binaries b
+            JOIN bin_associations ba ON b.id = ba.bin AND ba.suite = :suite_id
+            JOIN architecture a ON b.architecture = a.id
+            JOIN source s ON b.source = s.id
+            JOIN files_archive_map af ON b.file = af.file_id AND af.archive_id = :archive_id
+            JOIN component c ON af.component_id = c.id'''
+    parsed = {}
+    for package, architecture, source, component, depends, provides in session.execute(statement, params):
+        relations = snapshot.binaries.get(architecture)
+        if relations is None:
+            relations = snapshot.binaries[architecture] = _Relations()
+
+        parsed_depends = []
+        if depends is not None:
+            parsed_depends = parsed.get(depends)
+            if parsed_depends is None:
+                try:
+                    parsed_depends = apt_pkg.parse_depends(depends)
+                except ValueError as e:
+                    print "Error for package %s: %s" % (package, e)
+                    parsed_depends = []
+                parsed[depends] = parsed_depends
+
+        virtual_packages = []
+        if provides is not None:
+            for virtual_pkg in provides.split(","):
+                virtual_pkg = virtual_pkg.strip()
+                if virtual_pkg != package:
+                    virtual_packages.append(virtual_pkg)
+
+        snapshot._add(relations, package, source, component, parsed_depends, virtual_packages)
+
+    metakey_bd = get_or_set_metadatakey("Build-Depends", session)
+    metakey_bdi = get_or_set_metadatakey("Build-Depends-Indep", session)
+    params = {
+        'suite_id':    suite.suite_id,
+        'metakey_ids': (metakey_bd.key_id, metakey_bdi.key_id),
+    }
+    statement = '''
+        SELECT s.source, string_agg(sm.value, ', ') as build_dep
+           FROM source s
+           JOIN source_metadata sm ON s.id = sm.src_id
+           WHERE s.id in
+               (SELECT source FROM src_associations
+                   WHERE suite = :suite_id)
+               AND sm.key_id in :metakey_ids
+           GROUP BY s.id, s.source'''
+    for source, build_dep in session.execute(statement, params):
+        parsed_depends = []
+        if build_dep is not None:
+            # Remove [arch] information since we want to see breakage on all arches
+            build_dep = re_build_dep_arch.sub("", build_dep)
+            try:
+                parsed_depends = apt_pkg.parse_src_depends(build_dep)
+            except ValueError as e:
+                print "Error for source %s: %s" % (source, e)
+        snapshot._add(snapshot.sources, source, None, None, parsed_depends, [])
+
+    return snapshot
+
+def _snapshot_filename(suite_name):
+    directory = Config().get('Dir::Cache')
+    if not directory:
+        return None
+    return os.path.join(directory, 'depsnapshot', '{0}.pickle'.format(suite_name))
+
+def read_snapshot(filename):
+    """read a snapshot saved by L{write_snapshot}
+
+    Snapshots that someone else could have written are ignored, see
+    L{daklib.utils.open_cache_file}.
+
+    @rtype:  L{DependencySnapshot} or None
+    @return: the snapshot or None if it does not exist, is unreadable or
+             is not trusted
+    """
+    from daklib.utils import open_cache_file
+    try:
+        fh = open_cache_file(filename)
+        if fh is None:
+            return None
+        with fh:
+            snapshot = cPickle.load(fh)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    except (EOFError, cPickle.UnpicklingError, AttributeError, ImportError, ValueError, TypeError):
+        return None
+    if not isinstance(snapshot, DependencySnapshot) or snapshot.format != SNAPSHOT_FORMAT:
+        return None
+    return snapshot
+
+def write_snapshot(snapshot, filename):
+    """atomically save a snapshot to a file"""
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.{0}.'.format(os.path.basename(filename)))
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            cPickle.dump(snapshot, fh, cPickle.HIGHEST_PROTOCOL)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+
+_snapshots = {}
+
+def load_snapshot(session, suite):
+    """get an up-to-date dependency snapshot of a suite
+
+    The snapshot is taken from memory or from C{Dir::Cache} if the suite has
+    not changed since it was built. Otherwise it is rebuilt and saved.
+
+    @type  suite: L{daklib.dbconn.Suite}
+    @rtype: L{DependencySnapshot}
+    """
+    key = snapshot_key(session, suite)
+    snapshot = _snapshots.get(suite.suite_name)
+    if snapshot is not None and snapshot.key == key:
+        return snapshot
+
+    filename = _snapshot_filename(suite.suite_name)
+    if filename is not None:
+        snapshot = read_snapshot(filename)
+    if snapshot is None or snapshot.key != key:
+        snapshot = build_snapshot(session, suite, key)
+        if filename is not None:
+            try:
+                write_snapshot(snapshot, filename)
+            except (IOError, OSError) as e:
+                print "W: could not save dependency snapshot %s: %s" % (filename, e)
+
+    _snapshots[suite.suite_name] = snapshot
+    return snapshot
@@ -25,16 +25,128 @@ Helper code for file writing with optional compression.
 
 ################################################################################
 
-from daklib.config import Config
-
-from daklib.daksubprocess import check_call
+import daklib.daksubprocess
 
+from collections import namedtuple
+import hashlib
 import os, os.path
+import subprocess
+import threading
+
+#: size and hashes of a file written by L{BaseFileWriter}
+FileHashes = namedtuple('FileHashes', ['size', 'md5sum', 'sha1sum', 'sha256sum'])
+
+#: amount of data collected before it is passed on to the outputs
+BUFFER_SIZE = 65536
+
+class _HashedOutput(object):
+    '''
+    Output file keeping track of the size and hashes of the data written.
+    If filename is None the data is only hashed.
+    '''
+    def __init__(self, filename):
+        self.file = open(filename, 'w') if filename is not None else None
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        if self.file is not None:
+            self.file.write(data)
+        self.size += len(data)
+        self.md5.update(data)
+        self.sha1.update(data)
+        self.sha256.update(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    @property
+    def hashes(self):
+        return FileHashes(self.size, self.md5.hexdigest(), self.sha1.hexdigest(), self.sha256.hexdigest())
+
+class _CompressorOutput(object):
+    '''
+    Output passing the data through an external compressor. The compressor
+    runs concurrently; its output is written and hashed by a helper thread.
+    '''
+    def __init__(self, cmd, filename):
+        self.cmd = cmd
+        self.output = _HashedOutput(filename)
+        self.error = None
+        self.process = daklib.daksubprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _drain(self):
+        try:
+            for chunk in iter(lambda: self.process.stdout.read(BUFFER_SIZE), ''):
+                self.output.write(chunk)
+        except Exception as e:
+            self.error = e
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        self.thread.join()
+        self.output.close()
+        returncode = self.process.wait()
+        if self.error is not None:
+            raise self.error
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.cmd)
+
+    @property
+    def hashes(self):
+        return self.output.hashes
+
+class _TeeFile(object):
+    '''
+    File object passing everything written to it on to several outputs.
+    '''
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= BUFFER_SIZE:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        for output in self.outputs:
+            output.write(data)
+
+    def close(self):
+        self.flush()
+        for output in self.outputs:
+            output.close()
 
 class BaseFileWriter(object):
     '''
     Base class for compressed and uncompressed file writing.
     '''
+    #: suffix and command for each supported compression
+    compressors = (
+        ('gzip',  'gz',  ['gzip', '-9cn', '--rsyncable']),
+        ('bzip2', 'bz2', ['bzip2', '-9']),
+        ('xz',    'xz',  ['xz', '-c']),
+    )
+
     def __init__(self, template, **keywords):
         '''
         The template argument is a string template like
@@ -49,17 +161,26 @@ class BaseFileWriter(object):
         self.bzip2 = 'bzip2' in compression
         self.xz = 'xz' in compression
         self.path = template % keywords
+        self.hashes = None
+        self.written = None
 
     def open(self):
         '''
-        Returns a file object for writing.
+        Returns a file object for writing. All requested variants of the
+        file are produced at the same time as data is written.
         '''
         # create missing directories
         try:
             os.makedirs(os.path.dirname(self.path))
         except:
             pass
-        self.file = open(self.path + '.new', 'w')
+        uncompressed = _HashedOutput(self.path + '.new' if self.uncompressed else None)
+        self.outputs = [(self.path, uncompressed)]
+        for name, suffix, cmd in self.compressors:
+            if getattr(self, name):
+                filename = "{0}.{1}".format(self.path, suffix)
+                self.outputs.append((filename, _CompressorOutput(cmd, filename + '.new')))
+        self.file = _TeeFile([output for filename, output in self.outputs])
         return self.file
 
     # internal helper function
@@ -68,29 +189,24 @@ class BaseFileWriter(object):
         os.chmod(tempfilename, 0o644)
         os.rename(tempfilename, filename)
 
-    # internal helper function to compress output
-    def compress(self, cmd, suffix, path):
-        in_filename = "{0}.new".format(path)
-        out_filename = "{0}.{1}.new".format(path, suffix)
-        with open(in_filename, 'r') as in_fh, open(out_filename, 'w') as out_fh:
-            check_call(cmd, stdin=in_fh, stdout=out_fh)
-        self.rename("{0}.{1}".format(path, suffix))
-
     def close(self):
         '''
-        Closes the file object and does the compression and rename work.
+        Closes the file object and renames the output files into place.
+
+        Afterwards C{self.hashes} maps the filename of every variant to its
+        L{FileHashes}. The entry for the uncompressed file is present even
+        if it is not written to disk. C{self.written} lists the filenames
+        that were renamed into place.
         '''
         self.file.close()
-        if self.gzip:
-            self.compress(['gzip', '-9cn', '--rsyncable'], 'gz', self.path)
-        if self.bzip2:
-            self.compress(['bzip2', '-9'], 'bz2', self.path)
-        if self.xz:
-            self.compress(['xz', '-c'], 'xz', self.path)
-        if self.uncompressed:
-            self.rename(self.path)
-        else:
-            os.unlink(self.path + '.new')
+        self.hashes = {}
+        self.written = []
+        # rename the uncompressed file last as before
+        for filename, output in reversed(self.outputs):
+            self.hashes[filename] = output.hashes
+            if filename != self.path or self.uncompressed:
+                self.rename(filename)
+                self.written.append(filename)
 
 class BinaryContentsFileWriter(BaseFileWriter):
     def __init__(self, **keywords):
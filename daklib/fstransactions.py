@@ -17,9 +17,151 @@
 """Transactions for filesystem actions
 """
 
+import ctypes
 import errno
+import fcntl
 import os
 import shutil
+import stat
+
+#: ioctl to share the data of a file on the same filesystem (Linux)
+FICLONE = 0x40049409
+
+#: errors meaning a transfer method is not available for the filesystems
+_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+                       errno.EINVAL, errno.EPERM)
+
+try:
+    _copy_file_range = ctypes.CDLL(None, use_errno=True).copy_file_range
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t, ctypes.c_uint]
+    _copy_file_range.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    _copy_file_range = None
+
+#: (method, source device, destination device) known not to work
+_unsupported = set()
+
+class _TransferNotSupported(Exception):
+    pass
+
+def _reflink(source_fd, destination_fd, size):
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+    except IOError as e:
+        if e.errno in _UNSUPPORTED_ERRORS:
+            raise _TransferNotSupported()
+        raise
+
+def _copy_range(source_fd, destination_fd, size):
+    if _copy_file_range is None:
+        raise _TransferNotSupported()
+    copied = 0
+    while copied < size:
+        n = _copy_file_range(source_fd, None, destination_fd, None, min(size - copied, 1 << 30), 0)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in _UNSUPPORTED_ERRORS:
+                raise _TransferNotSupported()
+            raise OSError(err, os.strerror(err))
+        if n == 0:
+            break
+        copied += n
+    # some filesystems return 0 without copying anything
+    if copied < size:
+        raise _TransferNotSupported()
+
+def _copy_data(source_fd, destination_fd, size):
+    with os.fdopen(os.dup(source_fd), 'r') as src:
+        with os.fdopen(os.dup(destination_fd), 'w') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+_COPY_METHODS = (('reflink', _reflink), ('copy_file_range', _copy_range), ('copy', _copy_data))
+
+def _new_file_gid(directory):
+    """group a file created in C{directory} gets"""
+    st = os.stat(directory)
+    if st.st_mode & stat.S_ISGID:
+        return st.st_gid
+    return os.getegid()
+
+def transfer_file(source, destination, link=False):
+    """put a copy of C{source} at C{destination}
+
+    If C{link} is set, C{destination} is hardlinked to C{source} if both
+    are on the same filesystem. The shared inode then gets the group a new
+    file in the destination directory would get, as for a copy. Otherwise C{destination} gets its own
+    inode: its data is shared with C{source} using a reflink where the
+    filesystem supports this, copied in the kernel using
+    C{copy_file_range} or copied by reading and writing the file, in this
+    order. Methods that fail for a pair of filesystems are not tried
+    again for it. Like C{shutil.copy2} the permission bits and times of
+    C{source} are copied.
+
+    @type  source: str
+    @param source: source file
+
+    @type  destination: str
+    @param destination: destination file, must not exist
+
+    @type  link: bool
+    @param link: allow C{source} and C{destination} to share their inode
+
+    @rtype:  str
+    @return: the method used ("link", "reflink", "copy_file_range" or "copy")
+    """
+    try:
+        source_fd = os.open(source, os.O_RDONLY)
+    except OSError as e:
+        raise IOError(e.errno, e.strerror, source)
+    try:
+        st = os.fstat(source_fd)
+        destination_directory = os.path.dirname(destination) or '.'
+        destination_dev = os.stat(destination_directory).st_dev
+
+        if link and st.st_dev == destination_dev and ('link', st.st_dev, destination_dev) not in _unsupported:
+            try:
+                os.link(source, destination)
+            except OSError as e:
+                # fall back to copying in any case, e.g. for too many links
+                if e.errno in _UNSUPPORTED_ERRORS:
+                    _unsupported.add(('link', st.st_dev, destination_dev))
+            else:
+                # give the file the group a copy would get so the group of
+                # the source does not gain access to the destination
+                gid = _new_file_gid(destination_directory)
+                try:
+                    if st.st_gid != gid:
+                        os.chown(destination, -1, gid)
+                    return 'link'
+                except OSError:
+                    os.unlink(destination)
+
+        destination_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            for name, method in _COPY_METHODS:
+                if (name, st.st_dev, destination_dev) in _unsupported:
+                    continue
+                try:
+                    method(source_fd, destination_fd, st.st_size)
+                    break
+                except _TransferNotSupported:
+                    _unsupported.add((name, st.st_dev, destination_dev))
+                    # discard anything copied before the method failed
+                    os.ftruncate(destination_fd, 0)
+                    os.lseek(destination_fd, 0, os.SEEK_SET)
+                    os.lseek(source_fd, 0, os.SEEK_SET)
+        except:
+            os.close(destination_fd)
+            os.unlink(destination)
+            raise
+        os.close(destination_fd)
+        shutil.copystat(source, destination)
+        return name
+    finally:
+        os.close(source_fd)
 
 class _FilesystemAction(object):
     @property
@@ -53,13 +195,8 @@ class _FilesystemCopyAction(_FilesystemAction):
             os.makedirs(destdir, dirmode)
         if symlink:
             os.symlink(source, self.destination)
-        elif link:
-            try:
-                os.link(source, self.destination)
-            except OSError:
-                shutil.copy2(source, self.destination)
         else:
-            shutil.copy2(source, self.destination)
+            transfer_file(source, self.destination, link=link)
 
         self.need_cleanup = True
         if mode is not None:
@@ -132,7 +269,9 @@ class FilesystemTransaction(object):
         @param destination: destination file
 
         @type  link: bool
-        @param link: try hardlinking, falling back to copying
+        @param link: try hardlinking, falling back to copying. Only use
+                     this if C{source} is not changed later and may get
+                     C{mode} as well.
 
         @type  symlink: bool
         @param symlink: create a symlink instead of copying
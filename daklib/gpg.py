@@ -24,7 +24,14 @@ import datetime
 import errno
 import fcntl
 import os
+import Queue
 import select
+import struct
+import subprocess
+import sys
+from multiprocessing.pool import ThreadPool
+
+import daklib.daksubprocess
 
 try:
     _MAXFD = os.sysconf("SC_OPEN_MAX")
@@ -58,6 +65,108 @@ class _Pipe(object):
             os.close(self.w)
             self.w = None
 
+def _do_io(read, write):
+    for fd in write.keys():
+        old = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, old | os.O_NONBLOCK)
+
+    read_lines = dict( (fd, []) for fd in read )
+    write_pos = dict( (fd, 0) for fd in write )
+
+    read_set = list(read)
+    write_set = write.keys()
+    while len(read_set) > 0 or len(write_set) > 0:
+        r, w, x_ = select.select(read_set, write_set, ())
+        for fd in r:
+            data = os.read(fd, 4096)
+            if data == "":
+                read_set.remove(fd)
+            read_lines[fd].append(data)
+        for fd in w:
+            data = write[fd][write_pos[fd]:]
+            if data == "":
+                os.close(fd)
+                write_set.remove(fd)
+            else:
+                bytes_written = os.write(fd, data)
+                write_pos[fd] += bytes_written
+
+    return dict( (fd, "".join(read_lines[fd])) for fd in read_lines.keys() )
+
+def _exec_gpg(gpg, keyrings, stdin, stdout, stderr, statusfd):
+    try:
+        if stdin != 0:
+            os.dup2(stdin, 0)
+        if stdout != 1:
+            os.dup2(stdout, 1)
+        if stderr != 2:
+            os.dup2(stderr, 2)
+        if statusfd != 3:
+            os.dup2(statusfd, 3)
+        for fd in range(4):
+            old = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, old & ~fcntl.FD_CLOEXEC)
+        os.closerange(4, _MAXFD)
+
+        args = [gpg,
+                "--status-fd=3",
+                "--no-default-keyring",
+                "--batch",
+                "--no-tty",
+                "--trust-model", "always",
+                "--fixed-list-mode"]
+        for k in keyrings:
+            args.append("--keyring=%s" % k)
+        args.extend(["--decrypt", "-"])
+
+        os.execvp(gpg, args)
+    finally:
+        os._exit(1)
+
+def _run_gpg(gpg, keyrings, data):
+    """run gpg to verify a signed message
+
+    @rtype:  tuple
+    @return: (contents, status, stderr, exit status as returned by wait4)
+    """
+    with _Pipe() as stdin:
+     with _Pipe() as contents:
+      with _Pipe() as status:
+       with _Pipe() as stderr:
+        pid = os.fork()
+        if pid == 0:
+            _exec_gpg(gpg, keyrings, stdin.r, contents.w, stderr.w, status.w)
+        else:
+            stdin.close_r()
+            contents.close_w()
+            stderr.close_w()
+            status.close_w()
+
+            read = _do_io([contents.r, stderr.r, status.r], {stdin.w: data})
+            stdin.w = None # was closed by _do_io
+
+            (pid_, exit_code, usage_) = os.wait4(pid, 0)
+
+            return (read[contents.r], read[status.r], read[stderr.r], exit_code)
+
+def _write_field(fh, data):
+    fh.write(struct.pack('!I', len(data)))
+    fh.write(data)
+
+def _read_field(fh):
+    """read a field written by L{_write_field}
+
+    @return: the data or C{None} at end of file
+    """
+    header = fh.read(4)
+    if len(header) < 4:
+        return None
+    (length,) = struct.unpack('!I', header)
+    data = fh.read(length)
+    if len(data) < length:
+        return None
+    return data
+
 class SignedFile(object):
     """handle files signed with PGP
 
@@ -67,15 +176,23 @@ class SignedFile(object):
       fingerprint         - fingerprint of the key used for signing
       primary_fingerprint - fingerprint of the primary key associated to the key used for signing
     """
-    def __init__(self, data, keyrings, require_signature=True, gpg="/usr/bin/gpg"):
+    def __init__(self, data, keyrings, require_signature=True, gpg="/usr/bin/gpg", verifier=None):
         """
         @param data: string containing the message
         @param keyrings: sequence of keyrings
         @param require_signature: if True (the default), will raise an exception if no valid signature was found
         @param gpg: location of the gpg binary
+        @param verifier: L{SignedFileVerifier} to run gpg with (optional);
+                         it must use the same keyrings
+
+        @raise ValueError: the verifier uses different keyrings
         """
         self.gpg = gpg
-        self.keyrings = keyrings
+        self.keyrings = list(keyrings)
+        self.verifier = verifier
+
+        if verifier is not None and self.keyrings != verifier.keyrings:
+            raise ValueError("keyrings {0} differ from the keyrings of the verifier {1}".format(self.keyrings, verifier.keyrings))
 
         self.valid = False
         self.expired = False
@@ -102,71 +219,27 @@ class SignedFile(object):
         return self.signature_ids[0]
 
     def _verify(self, data, require_signature):
-        with _Pipe() as stdin:
-         with _Pipe() as contents:
-          with _Pipe() as status:
-           with _Pipe() as stderr:
-            pid = os.fork()
-            if pid == 0:
-                self._exec_gpg(stdin.r, contents.w, stderr.w, status.w)
-            else:
-                stdin.close_r()
-                contents.close_w()
-                stderr.close_w()
-                status.close_w()
-
-                read = self._do_io([contents.r, stderr.r, status.r], {stdin.w: data})
-                stdin.w = None # was closed by _do_io
-
-                (pid_, exit_code, usage_) = os.wait4(pid, 0)
-
-                self.contents = read[contents.r]
-                self.status   = read[status.r]
-                self.stderr   = read[stderr.r]
+        if self.verifier is not None:
+            result = self.verifier.run(data)
+        else:
+            result = _run_gpg(self.gpg, self.keyrings, data)
+        (self.contents, self.status, self.stderr, exit_code) = result
 
-                if self.status == "":
-                    raise GpgException("No status output from GPG. (GPG exited with status code %s)\n%s" % (exit_code, self.stderr))
+        if self.status == "":
+            raise GpgException("No status output from GPG. (GPG exited with status code %s)\n%s" % (exit_code, self.stderr))
 
-                for line in self.status.splitlines():
-                    self._parse_status(line)
+        for line in self.status.splitlines():
+            self._parse_status(line)
 
-                if self.invalid:
-                    self.valid = False
+        if self.invalid:
+            self.valid = False
 
-                if require_signature and not self.valid:
-                    raise GpgException("No valid signature found. (GPG exited with status code %s)\n%s" % (exit_code, self.stderr))
+        if require_signature and not self.valid:
+            raise GpgException("No valid signature found. (GPG exited with status code %s)\n%s" % (exit_code, self.stderr))
 
         assert len(self.fingerprints) == len(self.primary_fingerprints)
         assert len(self.fingerprints) == len(self.signature_ids)
 
-    def _do_io(self, read, write):
-        for fd in write.keys():
-            old = fcntl.fcntl(fd, fcntl.F_GETFL)
-            fcntl.fcntl(fd, fcntl.F_SETFL, old | os.O_NONBLOCK)
-
-        read_lines = dict( (fd, []) for fd in read )
-        write_pos = dict( (fd, 0) for fd in write )
-
-        read_set = list(read)
-        write_set = write.keys()
-        while len(read_set) > 0 or len(write_set) > 0:
-            r, w, x_ = select.select(read_set, write_set, ())
-            for fd in r:
-                data = os.read(fd, 4096)
-                if data == "":
-                    read_set.remove(fd)
-                read_lines[fd].append(data)
-            for fd in w:
-                data = write[fd][write_pos[fd]:]
-                if data == "":
-                    os.close(fd)
-                    write_set.remove(fd)
-                else:
-                    bytes_written = os.write(fd, data)
-                    write_pos[fd] += bytes_written
-
-        return dict( (fd, "".join(read_lines[fd])) for fd in read_lines.keys() )
-
     def _parse_timestamp(self, timestamp, datestring=None):
         """parse timestamp in GnuPG's format
 
@@ -229,37 +302,108 @@ class SignedFile(object):
         else:
             raise GpgException("Keyword '{0}' from GnuPG was not expected.".format(fields[1]))
 
-    def _exec_gpg(self, stdin, stdout, stderr, statusfd):
+    def contents_sha1(self):
+        return apt_pkg.sha1sum(self.contents)
+
+class SignedFileVerifier(object):
+    """verify signed files using helper processes
+
+    gpg has to be started for every signature. Forking a large process,
+    like dak with its database mappers loaded, is expensive, so the
+    verifier starts C{workers} small helper processes (see
+    L{daklib.gpgworker}) once and lets them start gpg. They are reused for
+    all files verified with this verifier, and L{verify_many} verifies up
+    to C{workers} files at the same time.
+
+    The output of gpg is parsed by L{SignedFile} as usual, so results are
+    the same as without a verifier.
+    """
+    def __init__(self, keyrings, workers=1, gpg="/usr/bin/gpg"):
+        """
+        @param keyrings: sequence of keyrings
+        @param workers: number of helper processes
+        @param gpg: location of the gpg binary
+        """
+        self.keyrings = list(keyrings)
+        self.gpg = gpg
+        self.workers = workers
+        self._helpers = []
+        self._idle = Queue.Queue()
+        for i in range(workers):
+            self._idle.put(self._start_helper())
+
+    def _start_helper(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gpgworker.py')
+        helper = daklib.daksubprocess.Popen([sys.executable, script, self.gpg] + self.keyrings,
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            close_fds=True)
+        self._helpers.append(helper)
+        return helper
+
+    def run(self, data):
+        """run gpg to verify a signed message in a helper process
+
+        @rtype:  tuple
+        @return: (contents, status, stderr, exit status as returned by wait4)
+        """
+        helper = self._idle.get()
         try:
-            if stdin != 0:
-                os.dup2(stdin, 0)
-            if stdout != 1:
-                os.dup2(stdout, 1)
-            if stderr != 2:
-                os.dup2(stderr, 2)
-            if statusfd != 3:
-                os.dup2(statusfd, 3)
-            for fd in range(4):
-                old = fcntl.fcntl(fd, fcntl.F_GETFD)
-                fcntl.fcntl(fd, fcntl.F_SETFD, old & ~fcntl.FD_CLOEXEC)
-            os.closerange(4, _MAXFD)
-
-            args = [self.gpg,
-                    "--status-fd=3",
-                    "--no-default-keyring",
-                    "--batch",
-                    "--no-tty",
-                    "--trust-model", "always",
-                    "--fixed-list-mode"]
-            for k in self.keyrings:
-                args.append("--keyring=%s" % k)
-            args.extend(["--decrypt", "-"])
-
-            os.execvp(self.gpg, args)
+            try:
+                _write_field(helper.stdin, data)
+                helper.stdin.flush()
+                fields = [ _read_field(helper.stdout) for i in range(4) ]
+            except (IOError, OSError):
+                fields = [None]
+            if None in fields:
+                self._helpers.remove(helper)
+                helper.wait()
+                helper = self._start_helper()
+                raise GpgException("gpg helper process exited unexpectedly")
         finally:
-            os._exit(1)
+            self._idle.put(helper)
+        return (fields[0], fields[1], fields[2], int(fields[3]))
 
-    def contents_sha1(self):
-        return apt_pkg.sha1sum(self.contents)
+    def verify(self, data, require_signature=True):
+        """verify a single signed message
+
+        @rtype:  L{SignedFile}
+        """
+        return SignedFile(data, self.keyrings, require_signature, self.gpg, verifier=self)
+
+    def verify_many(self, datas, require_signature=True):
+        """verify several signed messages concurrently
+
+        @rtype:  list
+        @return: L{SignedFile} for each message, or the L{GpgException}
+                 raised when verifying it
+        """
+        def verify_one(data):
+            try:
+                return self.verify(data, require_signature)
+            except GpgException as e:
+                return e
+
+        if self.workers <= 1 or len(datas) <= 1:
+            return [ verify_one(data) for data in datas ]
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(verify_one, datas, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        """stop the helper processes"""
+        for helper in self._helpers:
+            helper.stdin.close()
+            helper.wait()
+        self._helpers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
 
 # vim: set sw=4 et:
@@ -0,0 +1,50 @@
+#! /usr/bin/env python
+"""helper process starting gpg for L{daklib.gpg.SignedFileVerifier}
+
+The helper is started as a new Python interpreter, so it stays small and
+starting gpg from it is cheap. It reads messages to verify from stdin and
+writes gpg's output to stdout, each field prefixed by its length.
+
+Usage: gpgworker.py GPG [KEYRING...]
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@copyright: 2016, Debian FTP Masters
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from daklib.gpg import _run_gpg, _read_field, _write_field
+
+def main():
+    gpg = sys.argv[1]
+    keyrings = sys.argv[2:]
+
+    while True:
+        data = _read_field(sys.stdin)
+        if data is None:
+            break
+        contents, status, stderr, exit_code = _run_gpg(gpg, keyrings, data)
+        for field in (contents, status, stderr, str(exit_code)):
+            _write_field(sys.stdout, field)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+Persistent cache of sizes and hashes of files below dists/
+
+@contact: Debian FTPMaster <ftpmaster@debian.org>
+@copyright: 2016 Debian FTP Masters
+@license: GNU General Public License version 2 or later
+"""
+
+################################################################################
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+from daklib.filewriter import FileHashes, BUFFER_SIZE
+
+from multiprocessing.pool import ThreadPool
+
+import hashlib
+import os
+
+def hash_fh(fh, chunk_size=BUFFER_SIZE):
+    """hash the remaining content of a file object in a single pass
+
+    Only C{chunk_size} bytes are kept in memory at any time.
+
+    @type  fh: file
+    @param fh: file object to read from
+
+    @rtype:  L{daklib.filewriter.FileHashes}
+    """
+    size = 0
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: fh.read(chunk_size), ''):
+        size += len(chunk)
+        md5.update(chunk)
+        sha1.update(chunk)
+        sha256.update(chunk)
+    return FileHashes(size, md5.hexdigest(), sha1.hexdigest(), sha256.hexdigest())
+
+def _identity(st):
+    # (inode, size, mtime in ns) identifying a version of a file
+    return (st.st_ino, st.st_size, int(st.st_mtime * 10**9))
+
+class HashCache(object):
+    """cache of file hashes stored in the file_hash_cache table
+
+    Entries are keyed by the path of the file and only used while the file
+    they were computed from (the source) still has the same inode, size and
+    modification time. The source differs from the path when the hashes
+    describe the uncompressed content of a compressed file.
+    """
+    def __init__(self, session, prefix=None):
+        """
+        @type  session: SQLA Session
+        @param session: database session
+
+        @type  prefix: str
+        @param prefix: if given, load all entries for paths below this
+                       directory
+        """
+        self.session = session
+        self.prefix = os.path.normpath(prefix) if prefix is not None else None
+        self.entries = {}
+        self.changed = set()
+        self.seen = set()
+        if prefix is not None:
+            self._load(self.prefix)
+
+    def _load(self, prefix):
+        pattern = os.path.join(prefix, '').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        r = self.session.execute(
+            """SELECT path, source, source_inode, source_size, source_mtime_ns,
+                      size, md5sum, sha1sum, sha256sum
+                 FROM file_hash_cache WHERE path LIKE :pattern""",
+            {'pattern': pattern})
+        for row in r:
+            self.entries[row[0]] = (row[1], tuple(row[2:5]), FileHashes(*row[5:]))
+
+    def get(self, path):
+        """get cached hashes for C{path}
+
+        @rtype:  L{daklib.filewriter.FileHashes} or C{None}
+        @return: cached hashes or C{None} if there is no valid entry
+        """
+        path = os.path.normpath(path)
+        if path not in self.entries:
+            if self.prefix is not None and path.startswith(os.path.join(self.prefix, '')):
+                return None
+            row = self.session.execute(
+                """SELECT source, source_inode, source_size, source_mtime_ns,
+                          size, md5sum, sha1sum, sha256sum
+                     FROM file_hash_cache WHERE path = :path""",
+                {'path': path}).fetchone()
+            if row is None:
+                return None
+            self.entries[path] = (row[0], tuple(row[1:4]), FileHashes(*row[4:]))
+
+        source, identity, hashes = self.entries[path]
+        try:
+            if _identity(os.stat(source)) != identity:
+                return None
+        except OSError:
+            return None
+        self.seen.add(path)
+        return hashes
+
+    def set(self, path, hashes, source=None):
+        """remember C{hashes} for C{path}
+
+        @type  source: str
+        @param source: file the hashes were computed from, defaults to C{path}
+        """
+        path = os.path.normpath(path)
+        if source is None:
+            source = path
+        self.entries[path] = (source, _identity(os.stat(source)), hashes)
+        self.changed.add(path)
+        self.seen.add(path)
+
+    def hash_file(self, path, source=None, opener=open):
+        """get hashes for C{path}, computing them if necessary
+
+        @type  source: str
+        @param source: file to read, defaults to C{path}
+
+        @type  opener: callable
+        @param opener: function returning a file object for C{source}, for
+                       example a decompressing one
+
+        @rtype:  L{daklib.filewriter.FileHashes}
+        """
+        hashes = self.get(path)
+        if hashes is None:
+            if source is None:
+                source = path
+            fh = opener(source, 'r')
+            try:
+                hashes = hash_fh(fh)
+            finally:
+                fh.close()
+            self.set(path, hashes, source)
+        return hashes
+
+    def hash_files(self, requests, workers=1):
+        """get hashes for several files, computing missing ones concurrently
+
+        Hashing and decompression release the GIL, so threads are used. At
+        most C{workers} files are read at the same time, so memory usage is
+        bounded by the read buffer size times C{workers}.
+
+        @type  requests: list of tuples
+        @param requests: (path, source, opener) for each file, see
+                         L{hash_file}
+
+        @type  workers: int
+        @param workers: number of files to hash at the same time
+
+        @rtype:  dict
+        @return: mapping of path to L{daklib.filewriter.FileHashes}
+        """
+        result = {}
+        todo = []
+        for path, source, opener in requests:
+            path = os.path.normpath(path)
+            hashes = self.get(path)
+            if hashes is None:
+                todo.append((path, source if source is not None else path, opener))
+            else:
+                result[path] = hashes
+
+        def compute(request):
+            path, source, opener = request
+            fh = opener(source, 'r')
+            try:
+                return hash_fh(fh)
+            finally:
+                fh.close()
+
+        if workers > 1 and len(todo) > 1:
+            pool = ThreadPool(workers)
+            try:
+                computed = pool.map(compute, todo, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            computed = [ compute(request) for request in todo ]
+
+        for (path, source, opener), hashes in zip(todo, computed):
+            self.set(path, hashes, source)
+            result[path] = hashes
+        return result
+
+    def add_written_files(self, hashes, written):
+        """remember the hashes collected by a file writer
+
+        Variants that were not written, like the uncompressed file of a
+        compressed index, are cached depending on the first written file,
+        even if an older version of them is still on disk.
+
+        @type  hashes: dict
+        @param hashes: L{daklib.filewriter.BaseFileWriter.hashes}
+
+        @type  written: list of str
+        @param written: L{daklib.filewriter.BaseFileWriter.written}
+        """
+        written = sorted(written)
+        for path, file_hashes in hashes.iteritems():
+            if path in written:
+                self.set(path, file_hashes)
+            elif written:
+                self.set(path, file_hashes, written[0])
+
+    def save(self, prune=False):
+        """write changed entries to the database
+
+        @type  prune: bool
+        @param prune: also remove entries below the prefix that were not
+                      used since the cache was loaded
+        """
+        changed = sorted(self.changed)
+        if changed:
+            rows = []
+            for path in changed:
+                source, identity, hashes = self.entries[path]
+                row = dict(path=path, source=source, source_inode=identity[0],
+                           source_size=identity[1], source_mtime_ns=identity[2])
+                row.update(hashes._asdict())
+                rows.append(row)
+            self.session.execute("DELETE FROM file_hash_cache WHERE path = ANY(:paths)", {'paths': changed})
+            self.session.execute(
+                """INSERT INTO file_hash_cache
+                     (path, source, source_inode, source_size, source_mtime_ns,
+                      size, md5sum, sha1sum, sha256sum)
+                   VALUES (:path, :source, :source_inode, :source_size, :source_mtime_ns,
+                           :size, :md5sum, :sha1sum, :sha256sum)""",
+                rows)
+        if prune and self.prefix is not None:
+            stale = sorted(set(self.entries) - self.seen)
+            if stale:
+                self.session.execute("DELETE FROM file_hash_cache WHERE path = ANY(:paths)", {'paths': stale})
+        self.changed = set()
@@ -188,7 +188,7 @@ def import_package_to_suite(base, entry, transaction, suite, component):
     # Inject file into archive
     binary = daklib.upload.Binary(directory, hashedfile)
     db_binary = transaction.install_binary(directory, binary, suite, component)
-    transaction.flush()
+    transaction.session.flush()
 
     return db_binary
 
@@ -203,7 +203,7 @@ def import_source_to_suite(base, entry, transaction, suite, component):
     """
     source = import_source_to_archive(base, entry, transaction, suite.archive, component)
     source.suites.append(suite)
-    transaction.flush()
+    transaction.session.flush()
 
 def source_in_archive(source, version, archive, component=None):
     """Check that source package 'source' with version 'version' exists in 'archive',
@@ -0,0 +1,508 @@
+# Copyright (C) 2016, Debian FTP Masters <ftpmaster@debian.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""generate ed-style diffs (pdiffs) between versions of index files
+
+Index files are compared record by record instead of line by line: a
+record is a deb822 stanza (including the blank lines following it) or,
+for line based files like Contents, a group of lines. Stanzas are
+aligned on their first field (the package name) in the way of patience
+diff, falling back to their content where names are ambiguous. Only
+keys, digests and positions of the records are kept in memory; the
+changed parts of the new file are read again when the patch is written.
+"""
+
+from daklib.compress import open_decompressed
+import daklib.daksubprocess
+
+from collections import deque, namedtuple
+from bisect import bisect_left
+import gzip
+import hashlib
+import os
+import re
+import subprocess
+import tempfile
+import zlib
+
+class PdiffError(Exception):
+    """the files cannot be represented by a patch from this module"""
+    pass
+
+#: size and hashes of a file, as used in pdiff Index files
+PdiffHashes = namedtuple('PdiffHashes', ['size', 'sha1sum', 'sha256sum'])
+
+#: hashes of the old and new file, the patch and the compressed patch
+PatchResult = namedtuple('PatchResult', ['old', 'new', 'patch', 'patch_download'])
+
+#: end of a stanza including the following blank lines
+re_stanza_end = re.compile(r'\n\n+(?=[^\n])')
+
+#: ed commands written by this module
+re_ed_command = re.compile(r'^(\d+)(?:,(\d+))?([acd])\n$')
+
+#: line based files are split into records after lines whose CRC matches
+#: this mask, which gives records of 16 lines on average
+LINE_CHUNK_MASK = 0xf
+
+#: amount of data read at once
+CHUNK_SIZE = 65536
+
+# indices into record tuples
+_KEY, _DIGEST, _LINE, _NLINES, _OFFSET, _LENGTH = range(6)
+
+class _Hasher(object):
+    """collect size and hashes of data, optionally passing it on"""
+    def __init__(self, fh=None):
+        self.fh = fh
+        self.size = 0
+        self.sha1 = hashlib.sha1()
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        if self.fh is not None:
+            self.fh.write(data)
+        self.size += len(data)
+        self.sha1.update(data)
+        self.sha256.update(data)
+
+    def flush(self):
+        if self.fh is not None:
+            self.fh.flush()
+
+    @property
+    def hashes(self):
+        return PdiffHashes(self.size, self.sha1.hexdigest(), self.sha256.hexdigest())
+
+def _read_chunks(filename):
+    """yield the (decompressed) content of a file in chunks"""
+    fh = open_decompressed(filename)
+    try:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), ''):
+            yield chunk
+    finally:
+        fh.close()
+
+def _split_stanzas(data):
+    """split data into stanzas, returning them and the incomplete rest"""
+    pos = 0
+    records = []
+    for match in re_stanza_end.finditer(data):
+        records.append(data[pos:match.end()])
+        pos = match.end()
+    return records, data[pos:]
+
+def _split_lines(data):
+    """split data into groups of lines, returning them and the incomplete rest
+
+    Groups end after lines selected by their content, so a change only
+    affects the boundaries of the groups around it.
+    """
+    pos = 0
+    start = 0
+    records = []
+    while True:
+        end = data.find('\n', pos)
+        if end == -1:
+            break
+        end += 1
+        if zlib.crc32(data[pos:end]) & LINE_CHUNK_MASK == 0:
+            records.append(data[start:end])
+            start = end
+        pos = end
+    return records, data[start:]
+
+def _scan(filename, by_line):
+    """split a file into records
+
+    @return: tuple of the list of records (key, digest, first line, number
+             of lines, offset, length) and the hashes of the whole file
+    """
+    split = _split_lines if by_line else _split_stanzas
+    hasher = _Hasher()
+    records = []
+    state = [0, 0]   # line, offset
+
+    def add(record):
+        digest = hashlib.md5(record).digest()
+        key = digest
+        if not by_line:
+            # the first field of a stanza is the package name
+            key = record[:record.find('\n')]
+        nlines = record.count('\n')
+        records.append((key, digest, state[0], nlines, state[1], len(record)))
+        state[0] += nlines
+        state[1] += len(record)
+
+    rest = ''
+    for chunk in _read_chunks(filename):
+        hasher.write(chunk)
+        complete, rest = split(rest + chunk)
+        for record in complete:
+            add(record)
+    if rest:
+        if not rest.endswith('\n'):
+            raise PdiffError('{0}: no newline at end of file'.format(filename))
+        add(rest)
+
+    return records, hasher.hashes
+
+def _unique_anchors(old, new, o_lo, o_hi, n_lo, n_hi, field):
+    """find records with a key unique in both ranges and align them
+
+    C{field} selects the key (L{_KEY} or L{_DIGEST}) to use.
+
+    @return: list of (old index, new index) pairs, increasing in both
+    """
+    counts = {}
+    for i in xrange(o_lo, o_hi):
+        key = old[i][field]
+        entry = counts.get(key)
+        counts[key] = [i, None] if entry is None else [None, None]
+    for j in xrange(n_lo, n_hi):
+        entry = counts.get(new[j][field])
+        if entry is None or entry[0] is None:
+            continue
+        # a second match makes the key ambiguous
+        entry[1] = j if entry[1] is None else -1
+    pairs = sorted((i, j) for i, j in counts.itervalues() if i is not None and j is not None and j >= 0)
+
+    # longest increasing subsequence of the new indices (patience sorting)
+    tails = []
+    tail_pairs = []
+    back = {}
+    for pair in pairs:
+        pos = bisect_left(tails, pair[1])
+        back[pair] = tail_pairs[pos - 1] if pos > 0 else None
+        if pos == len(tails):
+            tails.append(pair[1])
+            tail_pairs.append(pair)
+        else:
+            tails[pos] = pair[1]
+            tail_pairs[pos] = pair
+
+    anchors = []
+    pair = tail_pairs[-1] if tail_pairs else None
+    while pair is not None:
+        anchors.append(pair)
+        pair = back[pair]
+    anchors.reverse()
+    return anchors
+
+def _diff_records(old, new):
+    """compute the differences between two lists of records
+
+    @return: sorted list of hunks (old start, old end, new start, new end)
+             given as record indices
+    """
+    hunks = []
+    todo = [(0, len(old), 0, len(new))]
+    while todo:
+        o_lo, o_hi, n_lo, n_hi = todo.pop()
+
+        while o_lo < o_hi and n_lo < n_hi and old[o_lo][_DIGEST] == new[n_lo][_DIGEST]:
+            o_lo += 1
+            n_lo += 1
+        while o_lo < o_hi and n_lo < n_hi and old[o_hi - 1][_DIGEST] == new[n_hi - 1][_DIGEST]:
+            o_hi -= 1
+            n_hi -= 1
+
+        if o_lo == o_hi or n_lo == n_hi:
+            if o_lo != o_hi or n_lo != n_hi:
+                hunks.append((o_lo, o_hi, n_lo, n_hi))
+            continue
+
+        anchors = _unique_anchors(old, new, o_lo, o_hi, n_lo, n_hi, _KEY)
+        if not anchors:
+            anchors = _unique_anchors(old, new, o_lo, o_hi, n_lo, n_hi, _DIGEST)
+        if not anchors:
+            hunks.append((o_lo, o_hi, n_lo, n_hi))
+            continue
+
+        prev_o, prev_n = o_lo, n_lo
+        for o, n in anchors:
+            todo.append((prev_o, o, prev_n, n))
+            if old[o][_DIGEST] != new[n][_DIGEST]:
+                hunks.append((o, o + 1, n, n + 1))
+            prev_o, prev_n = o + 1, n + 1
+        todo.append((prev_o, o_hi, prev_n, n_hi))
+
+    hunks.sort()
+
+    # merge adjacent hunks
+    merged = []
+    for hunk in hunks:
+        if merged and merged[-1][1] == hunk[0] and merged[-1][3] == hunk[2]:
+            merged[-1] = (merged[-1][0], hunk[1], merged[-1][2], hunk[3])
+        else:
+            merged.append(hunk)
+    return merged
+
+def _range(records, lo, hi, total, start_field, length_field):
+    """start and end (in lines or bytes) of the records lo to hi"""
+    start = records[lo][start_field] if lo < len(records) else total
+    if lo == hi:
+        return start, start
+    return start, records[hi - 1][start_field] + records[hi - 1][length_field]
+
+def _new_texts(filename, ranges):
+    """collect the data of the new file in the given sorted byte ranges"""
+    texts = [ [] for r in ranges ]
+    index = 0
+    offset = 0
+    for chunk in _read_chunks(filename):
+        chunk_end = offset + len(chunk)
+        while index < len(ranges) and ranges[index][1] <= chunk_end:
+            start, end = ranges[index]
+            texts[index].append(chunk[max(start - offset, 0):end - offset])
+            index += 1
+        if index < len(ranges) and ranges[index][0] < chunk_end:
+            texts[index].append(chunk[max(ranges[index][0] - offset, 0):])
+        offset = chunk_end
+        if index == len(ranges):
+            break
+    texts = [ ''.join(text) for text in texts ]
+    for text in texts:
+        if text.startswith('.\n') or '\n.\n' in text:
+            raise PdiffError('{0}: cannot represent lines consisting of a single dot'.format(filename))
+    return texts
+
+def write_patch(old_filename, new_filename, patch_filename, by_line=False):
+    """write a gzip compressed ed script turning the old into the new file
+
+    Both files may be compressed. The patch is written to
+    C{patch_filename} (which should end in C{.gz}) unless the files have
+    the same content. Files that cannot be handled here (lines consisting
+    of a single dot, no newline at the end of the file) are passed to
+    C{diff --ed} instead.
+
+    @type  by_line: bool
+    @param by_line: compare single lines instead of deb822 stanzas
+
+    @rtype:  L{PatchResult}
+    @return: hashes of the files involved or C{None} if the files are the
+             same
+    """
+    try:
+        return _write_patch(old_filename, new_filename, patch_filename, by_line)
+    except PdiffError:
+        return _write_patch_diff(old_filename, new_filename, patch_filename)
+
+def _open_patch(patch_filename):
+    """open the output file for a patch, creating missing directories"""
+    dirname = os.path.dirname(patch_filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return open(patch_filename, 'w')
+
+def _write_patch(old_filename, new_filename, patch_filename, by_line):
+    old, old_hashes = _scan(old_filename, by_line)
+    new, new_hashes = _scan(new_filename, by_line)
+    if old_hashes == new_hashes:
+        return None
+
+    old_lines = old[-1][_LINE] + old[-1][_NLINES] if old else 0
+    new_size = new_hashes.size
+
+    hunks = _diff_records(old, new)
+    old_ranges = [ _range(old, o_lo, o_hi, old_lines, _LINE, _NLINES) for o_lo, o_hi, n_lo, n_hi in hunks ]
+    new_ranges = [ _range(new, n_lo, n_hi, new_size, _OFFSET, _LENGTH) for o_lo, o_hi, n_lo, n_hi in hunks ]
+    texts = _new_texts(new_filename, new_ranges)
+
+    patch, download = _write_script(patch_filename, [ (start, end, text) for (start, end), text in zip(old_ranges, texts) ])
+    return PatchResult(old_hashes, new_hashes, patch, download)
+
+def _write_script(patch_filename, hunks):
+    """write hunks (start, end, text) as a gzip compressed ed script
+
+    @return: hashes of the script and of the compressed file
+    """
+    with _open_patch(patch_filename) as fh:
+        download = _Hasher(fh)
+        compressor = gzip.GzipFile(filename='', mode='w', compresslevel=9, fileobj=download, mtime=0)
+        patch = _Hasher(compressor)
+        # ed scripts are applied from the end of the file to its start
+        for start, end, text in reversed(hunks):
+            if start == end:
+                patch.write('{0}a\n'.format(start))
+            elif not text:
+                if end - start == 1:
+                    patch.write('{0}d\n'.format(end))
+                else:
+                    patch.write('{0},{1}d\n'.format(start + 1, end))
+                continue
+            elif end - start == 1:
+                patch.write('{0}c\n'.format(end))
+            else:
+                patch.write('{0},{1}c\n'.format(start + 1, end))
+            patch.write(text)
+            patch.write('.\n')
+        compressor.close()
+    return patch.hashes, download.hashes
+
+def _write_patch_diff(old_filename, new_filename, patch_filename):
+    """like L{write_patch}, but let GNU diff do the work"""
+    with tempfile.NamedTemporaryFile() as old_fh, tempfile.NamedTemporaryFile() as new_fh:
+        hashes = []
+        for filename, fh in ((old_filename, old_fh), (new_filename, new_fh)):
+            hasher = _Hasher(fh)
+            for chunk in _read_chunks(filename):
+                hasher.write(chunk)
+            fh.flush()
+            hashes.append(hasher.hashes)
+        if hashes[0] == hashes[1]:
+            return None
+
+        with _open_patch(patch_filename) as fh:
+            download = _Hasher(fh)
+            compressor = gzip.GzipFile(filename='', mode='w', compresslevel=9, fileobj=download, mtime=0)
+            patch = _Hasher(compressor)
+            cmd = ['diff', '--ed', old_fh.name, new_fh.name]
+            process = daklib.daksubprocess.Popen(cmd, stdout=subprocess.PIPE)
+            for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), ''):
+                patch.write(chunk)
+            # diff exits with 1 if the files differ
+            returncode = process.wait()
+            if returncode not in (0, 1):
+                raise subprocess.CalledProcessError(returncode, cmd)
+            compressor.close()
+
+    return PatchResult(hashes[0], hashes[1], patch.hashes, download.hashes)
+
+def read_patch(filename):
+    """read a (compressed) ed script as written by L{write_patch}
+
+    @rtype:  list of tuples
+    @return: hunks (start, end, lines) replacing the lines from C{start}
+             to C{end} (counted from zero, C{end} excluded) of the old
+             file by C{lines}, ordered by position
+
+    @raise PdiffError: the script uses commands not written by this module
+    """
+    fh = open_decompressed(filename)
+    try:
+        lines = iter(fh.read().splitlines(True))
+    finally:
+        fh.close()
+    hunks = []
+    for line in lines:
+        match = re_ed_command.match(line)
+        if match is None:
+            raise PdiffError('{0}: unsupported command: {1!r}'.format(filename, line))
+        first = int(match.group(1))
+        last = int(match.group(2)) if match.group(2) is not None else first
+        text = []
+        if match.group(3) in 'ac':
+            for line in lines:
+                if line == '.\n':
+                    break
+                text.append(line)
+            else:
+                raise PdiffError('{0}: unterminated text'.format(filename))
+        if match.group(3) == 'a':
+            hunks.append((first, first, text))
+        else:
+            hunks.append((first - 1, last, text))
+    hunks.reverse()
+    for previous, hunk in zip(hunks, hunks[1:]):
+        if previous[1] > hunk[0]:
+            raise PdiffError('{0}: commands are not in reverse order'.format(filename))
+    return hunks
+
+def _piece_length(piece):
+    # pieces are either lists of lines or (start, end) ranges of the old file;
+    # the last range is open and has no length
+    if isinstance(piece, list):
+        return len(piece)
+    start, end = piece
+    return end - start if end is not None else None
+
+def _split_piece(piece, length):
+    if isinstance(piece, list):
+        return piece[:length], piece[length:]
+    start, end = piece
+    return (start, start + length), (start + length, end)
+
+def merge_patches(first, second):
+    """combine two patches into one
+
+    Only the hunks of both patches are needed, not the files they apply
+    to, so patches can be merged in time proportional to their size.
+
+    @type  first: list of tuples
+    @param first: hunks as returned by L{read_patch}
+
+    @type  second: list of tuples
+    @param second: hunks of a patch for the file produced by C{first}
+
+    @rtype:  list of tuples
+    @return: hunks having the same effect as applying C{first} and then
+             C{second}
+    """
+    # describe the intermediate file in terms of the old file
+    pieces = deque()
+    pos = 0
+    for start, end, text in first:
+        if start > pos:
+            pieces.append((pos, start))
+        if text:
+            pieces.append(list(text))
+        pos = end
+    pieces.append((pos, None))
+
+    # apply the second patch to that description
+    merged = []
+    position = 0
+    for start, end, text in second + [(None, None, [])]:
+        for target, keep in ((start, True), (end, False)):
+            while pieces and (target is None or position < target):
+                piece = pieces.popleft()
+                length = _piece_length(piece)
+                if target is not None and (length is None or position + length > target):
+                    piece, rest = _split_piece(piece, target - position)
+                    pieces.appendleft(rest)
+                    length = target - position
+                if keep:
+                    merged.append(piece)
+                if length is not None:
+                    position += length
+        if text:
+            merged.append(list(text))
+
+    # and turn the result into hunks again
+    hunks = []
+    pos = 0
+    pending = []
+    for piece in merged:
+        if isinstance(piece, list):
+            pending.extend(piece)
+            continue
+        start, end = piece
+        if start > pos or pending:
+            hunks.append((pos, start, pending))
+            pending = []
+        pos = end
+        if end is None:
+            break
+    return hunks
+
+def write_hunks(hunks, patch_filename):
+    """write hunks as returned by L{read_patch} or L{merge_patches}
+
+    @rtype:  tuple
+    @return: L{PdiffHashes} of the patch and of the compressed patch
+    """
+    return _write_script(patch_filename, [ (start, end, ''.join(lines)) for start, end, lines in hunks ])
@@ -44,9 +44,9 @@ import apt_pkg
 import fcntl
 from re import sub
 from collections import defaultdict
-from regexes import re_build_dep_arch
 
 from daklib.dbconn import *
+from daklib.depsnapshot import load_snapshot
 from daklib import utils
 from daklib.regexes import re_bin_only_nmu
 import debianbts as bts
@@ -78,107 +78,76 @@ class ReverseDependencyChecker(object):
         self._session = session
         dbsuite = get_suite(suite, session)
         suite_archs2id = dict((x.arch_string, x.arch_id) for x in get_suite_architectures(suite))
-        package_dependencies, arch_providers_of, arch_provided_by = self._load_package_information(session,
-                                                                                                   dbsuite.suite_id,
-                                                                                                   suite_archs2id)
-        self._package_dependencies = package_dependencies
+        snapshot = load_snapshot(session, dbsuite)
+        arch_reverse_depends, arch_providers_of, arch_provided_by = self._load_package_information(snapshot,
+                                                                                                  suite_archs2id)
+        self._arch_reverse_depends = arch_reverse_depends
         self._arch_providers_of = arch_providers_of
         self._arch_provided_by = arch_provided_by
         self._archs_in_suite = set(suite_archs2id)
 
     @staticmethod
-    def _load_package_information(session, suite_id, suite_archs2id):
-        package_dependencies = defaultdict(lambda: defaultdict(set))
+    def _add_reverse_depends(reverse_depends, package, clauses):
+        # index every clause by all package names it mentions
+        for clause in clauses:
+            entry = (package, clause)
+            for dep_package in clause:
+                reverse_depends[dep_package].add(entry)
+
+    @staticmethod
+    def _load_package_information(snapshot, suite_archs2id):
+        """Build reverse indexes from the dependency snapshot of the suite
+
+        @type snapshot: L{daklib.depsnapshot.DependencySnapshot}
+        @param snapshot: The dependencies of the suite
+
+        @rtype: tuple
+        @return: (arch_reverse_depends, arch_providers_of, arch_provided_by).
+          arch_reverse_depends maps each architecture (and "source" for
+          build-dependencies) to a mapping of a package name to the
+          (package, clause) pairs mentioning it.
+        """
+        arch_reverse_depends = defaultdict(lambda: defaultdict(set))
         arch_providers_of = defaultdict(lambda: defaultdict(set))
         arch_provided_by = defaultdict(lambda: defaultdict(set))
-        source_deps = defaultdict(set)
-        metakey_d = get_or_set_metadatakey("Depends", session)
-        metakey_p = get_or_set_metadatakey("Provides", session)
-        params = {
-            'suite_id':     suite_id,
-            'arch_all_id':  suite_archs2id['all'],
-            'metakey_d_id': metakey_d.key_id,
-            'metakey_p_id': metakey_p.key_id,
-        }
         all_arches = set(suite_archs2id)
         all_arches.discard('source')
 
-        package_dependencies['source'] = source_deps
+        for architecture in all_arches:
+            # make sure every architecture is known even without packages
+            arch_reverse_depends[architecture]
+            arch_providers_of[architecture]
+            arch_provided_by[architecture]
 
         for architecture in all_arches:
-            deps = defaultdict(set)
-            providers_of = defaultdict(set)
-            provided_by = defaultdict(set)
-            arch_providers_of[architecture] = providers_of
-            arch_provided_by[architecture] = provided_by
-            package_dependencies[architecture] = deps
-
-            params['arch_id'] = suite_archs2id[architecture]
-
-            statement = '''
-                    SELECT b.package,
-                        (SELECT bmd.value FROM binaries_metadata bmd WHERE bmd.bin_id = b.id AND bmd.key_id = :metakey_d_id) AS depends,
-                        (SELECT bmp.value FROM binaries_metadata bmp WHERE bmp.bin_id = b.id AND bmp.key_id = :metakey_p_id) AS provides
-                        FROM binaries b
-                        JOIN bin_associations ba ON b.id = ba.bin AND ba.suite = :suite_id
-                        WHERE b.architecture = :arch_id OR b.architecture = :arch_all_id'''
-            query = session.query('package', 'depends', 'provides'). \
-                from_statement(statement).params(params)
-            for package, depends, provides in query:
-
-                if depends is not None:
-                    try:
-                        parsed_dep = []
-                        for dep in apt_pkg.parse_depends(depends):
-                            parsed_dep.append(frozenset(d[0] for d in dep))
-                        deps[package].update(parsed_dep)
-                    except ValueError as e:
-                        print "Error for package %s: %s" % (package, e)
+            # Arch: all packages are seen on all architectures
+            if architecture == 'all':
+                architectures = all_arches
+            else:
+                architectures = (architecture,)
+
+            for package, _, _, clause_ids, provides in snapshot.binary_packages(architecture):
+                clauses = [snapshot.clause_names(c) for c in clause_ids]
+                for arch in architectures:
+                    ReverseDependencyChecker._add_reverse_depends(arch_reverse_depends[arch], package, clauses)
                 # Maintain a counter for each virtual package.  If a
                 # Provides: exists, set the counter to 0 and count all
                 # provides by a package not in the list for removal.
                 # If the counter stays 0 at the end, we know that only
                 # the to-be-removed packages provided this virtual
                 # package.
-                if provides is not None:
-                    for virtual_pkg in provides.split(","):
-                        virtual_pkg = virtual_pkg.strip()
-                        if virtual_pkg == package:
-                            continue
-                        provided_by[virtual_pkg].add(package)
-                        providers_of[package].add(virtual_pkg)
+                for virtual_pkg in provides:
+                    for arch in architectures:
+                        arch_provided_by[arch][virtual_pkg].add(package)
+                        arch_providers_of[arch][package].add(virtual_pkg)
 
         # Check source dependencies (Build-Depends and Build-Depends-Indep)
-        metakey_bd = get_or_set_metadatakey("Build-Depends", session)
-        metakey_bdi = get_or_set_metadatakey("Build-Depends-Indep", session)
-        params = {
-            'suite_id':    suite_id,
-            'metakey_ids': (metakey_bd.key_id, metakey_bdi.key_id),
-        }
-        statement = '''
-            SELECT s.source, string_agg(sm.value, ', ') as build_dep
-               FROM source s
-               JOIN source_metadata sm ON s.id = sm.src_id
-               WHERE s.id in
-                   (SELECT source FROM src_associations
-                       WHERE suite = :suite_id)
-                   AND sm.key_id in :metakey_ids
-               GROUP BY s.id, s.source'''
-        query = session.query('source', 'build_dep').from_statement(statement). \
-            params(params)
-        for source, build_dep in query:
-            if build_dep is not None:
-                # Remove [arch] information since we want to see breakage on all arches
-                build_dep = re_build_dep_arch.sub("", build_dep)
-                try:
-                    parsed_dep = []
-                    for dep in apt_pkg.parse_src_depends(build_dep):
-                        parsed_dep.append(frozenset(d[0] for d in dep))
-                    source_deps[source].update(parsed_dep)
-                except ValueError as e:
-                    print "Error for package %s: %s" % (source, e)
-
-        return package_dependencies, arch_providers_of, arch_provided_by
+        source_reverse_depends = arch_reverse_depends['source']
+        for source, clause_ids in snapshot.source_packages():
+            clauses = [snapshot.clause_names(c) for c in clause_ids]
+            ReverseDependencyChecker._add_reverse_depends(source_reverse_depends, source, clauses)
+
+        return arch_reverse_depends, arch_providers_of, arch_provided_by
 
     def check_reverse_depends(self, removal_requests):
         """Bulk check reverse dependencies
@@ -205,12 +174,12 @@ class ReverseDependencyChecker(object):
         archs_in_suite = self._archs_in_suite
         removals_by_arch = defaultdict(set)
         affected_virtual_by_arch = defaultdict(set)
-        package_dependencies = self._package_dependencies
+        arch_reverse_depends = self._arch_reverse_depends
         arch_providers_of = self._arch_providers_of
         arch_provided_by = self._arch_provided_by
         arch_provides2removal = defaultdict(lambda: defaultdict(set))
         dep_problems = defaultdict(set)
-        src_deps = package_dependencies['source']
+        src_reverse_depends = arch_reverse_depends['source']
         src_removals = set()
         arch_all_removals = set()
 
@@ -247,7 +216,14 @@ class ReverseDependencyChecker(object):
         for arch, removed_providers in affected_virtual_by_arch.iteritems():
             provides2removal = arch_provides2removal[arch]
             removals = removals_by_arch[arch]
-            for virtual_pkg, virtual_providers in arch_provided_by[arch].iteritems():
+            providers_of = arch_providers_of[arch]
+            provided_by = arch_provided_by[arch]
+            # only virtual packages provided by a removed package can lose all providers
+            affected_virtual = set()
+            for pkg in removed_providers:
+                affected_virtual.update(providers_of[pkg])
+            for virtual_pkg in affected_virtual:
+                virtual_providers = provided_by[virtual_pkg]
                 v = virtual_providers & removed_providers
                 if len(v) == len(virtual_providers):
                     # We removed all the providers of virtual_pkg
@@ -258,39 +234,46 @@ class ReverseDependencyChecker(object):
                     provides2removal[virtual_pkg] = sorted(v)[0]
 
         for arch, removals in removals_by_arch.iteritems():
-            deps = package_dependencies[arch]
+            reverse_depends = arch_reverse_depends[arch]
             provides2removal = arch_provides2removal[arch]
 
+            # Only clauses mentioning a removed package can be broken
+            clauses = set()
+            src_clauses = set()
+            for removal in removals:
+                if removal in reverse_depends:
+                    clauses.update(reverse_depends[removal])
+                if removal in src_reverse_depends:
+                    src_clauses.update(src_reverse_depends[removal])
+
             # Check binary dependencies (Depends)
-            for package, dependencies in deps.iteritems():
+            for package, clause in clauses:
                 if package in removals:
                     continue
-                for clause in dependencies:
-                    if not (clause <= removals):
-                        # Something probably still satisfies this relation
-                        continue
-                    # whoops, we seemed to have removed all packages that could possibly satisfy
-                    # this relation.  Lets blame something for it
-                    for dep_package in clause:
-                        removal = dep_package
-                        if dep_package in provides2removal:
-                            removal = provides2removal[dep_package]
-                        dep_problems[(removal, arch)].add((package, arch))
-
-            for source, build_dependencies in src_deps.iteritems():
+                if not (clause <= removals):
+                    # Something probably still satisfies this relation
+                    continue
+                # whoops, we seemed to have removed all packages that could possibly satisfy
+                # this relation.  Lets blame something for it
+                for dep_package in clause:
+                    removal = dep_package
+                    if dep_package in provides2removal:
+                        removal = provides2removal[dep_package]
+                    dep_problems[(removal, arch)].add((package, arch))
+
+            for source, clause in src_clauses:
                 if source in src_removals:
                     continue
-                for clause in build_dependencies:
-                    if not (clause <= removals):
-                        # Something probably still satisfies this relation
-                        continue
-                    # whoops, we seemed to have removed all packages that could possibly satisfy
-                    # this relation.  Lets blame something for it
-                    for dep_package in clause:
-                        removal = dep_package
-                        if dep_package in provides2removal:
-                            removal = provides2removal[dep_package]
-                        dep_problems[(removal, arch)].add((source, 'source'))
+                if not (clause <= removals):
+                    # Something probably still satisfies this relation
+                    continue
+                # whoops, we seemed to have removed all packages that could possibly satisfy
+                # this relation.  Lets blame something for it
+                for dep_package in clause:
+                    removal = dep_package
+                    if dep_package in provides2removal:
+                        removal = provides2removal[dep_package]
+                    dep_problems[(removal, arch)].add((source, 'source'))
 
         return dep_problems
 
@@ -411,8 +394,8 @@ def remove(session, reason, suites, removals,
                 if element[2]:
                     binaries.append("%s_%s [%s]" % tuple(elem.strip(" ") for elem in element))
 
-    dsc_type_id = get_override_type('dsc', session).overridetype_id
-    deb_type_id = get_override_type('deb', session).overridetype_id
+    dsc_type_id = get_override_type_id('dsc', session)
+    deb_type_id = get_override_type_id('deb', session)
 
     for suite in suites:
         s = get_suite(suite, session=session)
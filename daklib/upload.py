@@ -26,8 +26,12 @@ import apt_pkg
 import errno
 import os
 import re
+import threading
 
+from collections import namedtuple
+from daklib.filewriter import FileHashes
 from daklib.gpg import SignedFile
+from multiprocessing.pool import ThreadPool
 from daklib.regexes import *
 import daklib.packagelist
 
@@ -145,7 +149,7 @@ class HashedFile(object):
             hashes = apt_pkg.Hashes(fh)
         return cls(filename, size, hashes.md5, hashes.sha1, hashes.sha256, section, priority)
 
-    def check(self, directory):
+    def check(self, directory, file_cache=None):
         """Validate hashes
 
         Check if size and hashes match the expected value.
@@ -153,8 +157,19 @@ class HashedFile(object):
         @type  directory: str
         @param directory: directory the file is located in
 
+        @type  file_cache: L{UploadFileCache}
+        @param file_cache: optional cache to take the hashes from; it must
+                           be for C{directory}
+
         @raise InvalidHashException: hash mismatch
+        @raise ValueError: C{file_cache} is for another directory
         """
+        if file_cache is not None:
+            if os.path.abspath(file_cache.directory) != os.path.abspath(directory):
+                raise ValueError('file cache is for {0}, not {1}'.format(file_cache.directory, directory))
+            self.check_hashes(file_cache.hashes(self.input_filename))
+            return
+
         path = os.path.join(directory, self.input_filename)
         try:
             with open(path) as fh:
@@ -165,21 +180,135 @@ class HashedFile(object):
             raise
 
     def check_fh(self, fh):
-        size = os.fstat(fh.fileno()).st_size
-        fh.seek(0)
-        hashes = apt_pkg.Hashes(fh)
+        self.check_hashes(_hash_fh(fh))
+
+    def check_hashes(self, hashes):
+        """Validate hashes
+
+        @type  hashes: L{daklib.filewriter.FileHashes}
+        @param hashes: actual size and hashes of the file
+
+        @raise InvalidHashException: hash mismatch
+        """
+        if hashes.size != self.size:
+            raise InvalidHashException(self.filename, 'size', self.size, hashes.size)
+
+        if hashes.md5sum != self.md5sum:
+            raise InvalidHashException(self.filename, 'md5sum', self.md5sum, hashes.md5sum)
+
+        if hashes.sha1sum != self.sha1sum:
+            raise InvalidHashException(self.filename, 'sha1sum', self.sha1sum, hashes.sha1sum)
+
+        if hashes.sha256sum != self.sha256sum:
+            raise InvalidHashException(self.filename, 'sha256sum', self.sha256sum, hashes.sha256sum)
+
+DebControl = namedtuple('DebControl', ['control', 'mtimes'])
+"""contents of the control file and modification times of all members of
+control.tar of a binary package"""
+
+def _hash_fh(fh):
+    size = os.fstat(fh.fileno()).st_size
+    fh.seek(0)
+    hashes = apt_pkg.Hashes(fh)
+    return FileHashes(size, hashes.md5, hashes.sha1, hashes.sha256)
+
+def _hash_file(path):
+    with open(path, 'r') as fh:
+        return _hash_fh(fh)
+
+def _read_deb_control(path):
+    deb = apt_inst.DebFile(path)
+    mtimes = dict()
+    def callback(member, data):
+        mtimes[member.name] = member.mtime
+    deb.control.go(callback)
+    return DebControl(deb.control.extractdata("control"), mtimes)
+
+class UploadFileCache(object):
+    """information read from the files of an upload
+
+    Every file is hashed at most once and the control information of binary
+    packages is extracted at most once, no matter how many checks need it.
+    Entries are only used while the file on disk is unchanged.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        """directory the files are located in
+        @type: str
+        """
 
-        if size != self.size:
-            raise InvalidHashException(self.filename, 'size', self.size, size)
+        self._entries = dict()
+        self._lock = threading.Lock()
 
-        if hashes.md5 != self.md5sum:
-            raise InvalidHashException(self.filename, 'md5sum', self.md5sum, hashes.md5)
+    def _get(self, filename, kind, compute):
+        path = os.path.join(self.directory, filename)
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise FileDoesNotExist(filename)
+            raise
+        identity = (st.st_ino, st.st_size, st.st_mtime)
+        with self._lock:
+            entry = self._entries.get((filename, kind))
+        if entry is not None and entry[0] == identity:
+            return entry[1]
+        value = compute(path)
+        with self._lock:
+            self._entries[(filename, kind)] = (identity, value)
+        return value
+
+    def hashes(self, filename):
+        """get size and hashes of a file
 
-        if hashes.sha1 != self.sha1sum:
-            raise InvalidHashException(self.filename, 'sha1sum', self.sha1sum, hashes.sha1)
+        @type  filename: str
+        @param filename: name of the file in the upload directory
+
+        @rtype:  L{daklib.filewriter.FileHashes}
 
-        if hashes.sha256 != self.sha256sum:
-            raise InvalidHashException(self.filename, 'sha256sum', self.sha256sum, hashes.sha256)
+        @raise FileDoesNotExist: the file does not exist
+        """
+        return self._get(filename, 'hashes', _hash_file)
+
+    def hash_files(self, filenames, workers=1):
+        """hash several files concurrently
+
+        Files that do not exist are skipped; L{hashes} reports them when
+        they are asked for.
+
+        @type  filenames: list of str
+        @param filenames: names of files in the upload directory
+
+        @type  workers: int
+        @param workers: number of files to read at the same time
+        """
+        def compute(filename):
+            try:
+                self.hashes(filename)
+            except FileDoesNotExist:
+                pass
+
+        filenames = list(filenames)
+        if workers > 1 and len(filenames) > 1:
+            pool = ThreadPool(min(workers, len(filenames)))
+            try:
+                pool.map(compute, filenames, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for filename in filenames:
+                compute(filename)
+
+    def deb_control(self, filename):
+        """get control information of a binary package
+
+        @type  filename: str
+        @param filename: name of the .deb in the upload directory
+
+        @rtype:  L{DebControl}
+        """
+        return self._get(filename, 'deb_control', _read_deb_control)
 
 def parse_file_list(control, has_priority_and_section, safe_file_regexp = re_file_safe, fields = ('Files', 'Checksums-Sha1', 'Checksums-Sha256')):
     """Parse Files and Checksums-* fields
@@ -253,7 +382,7 @@ def parse_file_list(control, has_priority_and_section, safe_file_regexp = re_fil
 class Changes(object):
     """Representation of a .changes file
     """
-    def __init__(self, directory, filename, keyrings, require_signature=True):
+    def __init__(self, directory, filename, keyrings, require_signature=True, verifier=None):
         if not re_file_safe.match(filename):
             raise InvalidChangesException('{0}: unsafe filename'.format(filename))
 
@@ -268,7 +397,7 @@ class Changes(object):
         """
 
         data = open(self.path).read()
-        self._signed_file = SignedFile(data, keyrings, require_signature)
+        self._signed_file = SignedFile(data, keyrings, require_signature, verifier=verifier)
         self.changes = apt_pkg.TagSection(self._signed_file.contents)
         """dict to access fields of the .changes file
         @type: dict-like
@@ -278,8 +407,14 @@ class Changes(object):
         self._source = None
         self._files = None
         self._keyrings = keyrings
+        self._verifier = verifier
         self._require_signature = require_signature
 
+        self.file_cache = UploadFileCache(directory)
+        """cache for hashes and control information of the included files
+        @type: L{UploadFileCache}
+        """
+
     @property
     def path(self):
         """path to the .changes file
@@ -334,7 +469,7 @@ class Changes(object):
                 if re_file_dsc.match(f.filename) or re_file_source.match(f.filename):
                     source_files.append(f)
             if len(source_files) > 0:
-                self._source = Source(self.directory, source_files, self._keyrings, self._require_signature)
+                self._source = Source(self.directory, source_files, self._keyrings, self._require_signature, self.file_cache, self._verifier)
         return self._source
 
     @property
@@ -360,7 +495,7 @@ class Changes(object):
             binaries = []
             for f in self.files.itervalues():
                 if re_file_binary.match(f.filename):
-                    binaries.append(Binary(self.directory, f))
+                    binaries.append(Binary(self.directory, f, self.file_cache))
             self._binaries = binaries
         return self._binaries
 
@@ -448,14 +583,17 @@ class Changes(object):
 class Binary(object):
     """Representation of a binary package
     """
-    def __init__(self, directory, hashed_file):
+    def __init__(self, directory, hashed_file, file_cache=None):
         self.hashed_file = hashed_file
         """file object for the .deb
         @type: HashedFile
         """
 
-        path = os.path.join(directory, hashed_file.input_filename)
-        data = apt_inst.DebFile(path).control.extractdata("control")
+        if file_cache is not None:
+            data = file_cache.deb_control(hashed_file.input_filename).control
+        else:
+            path = os.path.join(directory, hashed_file.input_filename)
+            data = apt_inst.DebFile(path).control.extractdata("control")
 
         self.control = apt_pkg.TagSection(data)
         """dict to access fields in DEBIAN/control
@@ -510,7 +648,7 @@ class Binary(object):
 class Source(object):
     """Representation of a source package
     """
-    def __init__(self, directory, hashed_files, keyrings, require_signature=True):
+    def __init__(self, directory, hashed_files, keyrings, require_signature=True, file_cache=None, verifier=None):
         self.hashed_files = hashed_files
         """list of source files (including the .dsc itself)
         @type: list of L{HashedFile}
@@ -525,11 +663,11 @@ class Source(object):
                     self._dsc_file = f
 
         # make sure the hash for the dsc is valid before we use it
-        self._dsc_file.check(directory)
+        self._dsc_file.check(directory, file_cache)
 
         dsc_file_path = os.path.join(directory, self._dsc_file.input_filename)
         data = open(dsc_file_path, 'r').read()
-        self._signed_file = SignedFile(data, keyrings, require_signature)
+        self._signed_file = SignedFile(data, keyrings, require_signature, verifier=verifier)
         self.dsc = apt_pkg.TagSection(self._signed_file.contents)
         """dict to access fields in the .dsc file
         @type: dict-like
@@ -61,6 +61,7 @@ from regexes import re_html_escaping, html_escaping, re_single_line_field, \
                     re_re_mark, re_whitespace_comment, re_issource, \
                     re_build_dep_arch, re_parse_maintainer
 
+from depsnapshot import load_snapshot
 from formats import parse_format, validate_changes_format
 from srcformats import get_format_from_string
 from collections import defaultdict
@@ -1137,50 +1138,27 @@ def check_reverse_depends(removals, suite, arches=None, session=None, cruft=Fals
         all_arches = set(x.arch_string for x in get_suite_architectures(suite))
     all_arches -= set(["source", "all"])
     removal_set = set(removals)
-    metakey_d = get_or_set_metadatakey("Depends", session)
-    metakey_p = get_or_set_metadatakey("Provides", session)
-    params = {
-        'suite_id':     dbsuite.suite_id,
-        'metakey_d_id': metakey_d.key_id,
-        'metakey_p_id': metakey_p.key_id,
-    }
+    snapshot = load_snapshot(session, dbsuite)
     for architecture in all_arches | set(['all']):
         deps = {}
         sources = {}
         virtual_packages = {}
-        params['arch_id'] = get_architecture(architecture, session).arch_id
-
-        statement = '''
-            SELECT b.package, s.source, c.name as component,
-                (SELECT bmd.value FROM binaries_metadata bmd WHERE bmd.bin_id = b.id AND bmd.key_id = :metakey_d_id) AS depends,
-                (SELECT bmp.value FROM binaries_metadata bmp WHERE bmp.bin_id = b.id AND bmp.key_id = :metakey_p_id) AS provides
-                FROM binaries b
-                JOIN bin_associations ba ON b.id = ba.bin AND ba.suite = :suite_id
-                JOIN source s ON b.source = s.id
-                JOIN files_archive_map af ON b.file = af.file_id
-                JOIN component c ON af.component_id = c.id
-                WHERE b.architecture = :arch_id'''
-        query = session.query('package', 'source', 'component', 'depends', 'provides'). \
-            from_statement(statement).params(params)
-        for package, source, component, depends, provides in query:
+        for package, source, component, clause_ids, provides in snapshot.binary_packages(architecture):
             sources[package] = source
             p2c[package] = component
-            if depends is not None:
-                deps[package] = depends
+            if clause_ids:
+                deps[package] = clause_ids
             # Maintain a counter for each virtual package.  If a
             # Provides: exists, set the counter to 0 and count all
             # provides by a package not in the list for removal.
             # If the counter stays 0 at the end, we know that only
             # the to-be-removed packages provided this virtual
             # package.
-            if provides is not None:
-                for virtual_pkg in provides.split(","):
-                    virtual_pkg = virtual_pkg.strip()
-                    if virtual_pkg == package: continue
-                    if not virtual_packages.has_key(virtual_pkg):
-                        virtual_packages[virtual_pkg] = 0
-                    if package not in removals:
-                        virtual_packages[virtual_pkg] += 1
+            for virtual_pkg in provides:
+                if not virtual_packages.has_key(virtual_pkg):
+                    virtual_packages[virtual_pkg] = 0
+                if package not in removals:
+                    virtual_packages[virtual_pkg] += 1
 
         # If a virtual package is only provided by the to-be-removed
         # packages, treat the virtual package as to-be-removed too.
@@ -1189,12 +1167,8 @@ def check_reverse_depends(removals, suite, arches=None, session=None, cruft=Fals
         # Check binary dependencies (Depends)
         for package in deps:
             if package in removals: continue
-            try:
-                parsed_dep = apt_pkg.parse_depends(deps[package])
-            except ValueError as e:
-                print "Error for package %s: %s" % (package, e)
-                parsed_dep = []
-            for dep in parsed_dep:
+            for clause_id in deps[package]:
+                dep = snapshot.clause(clause_id)
                 # Check for partial breakage.  If a package has a ORed
                 # dependency, there is only a dependency problem if all
                 # packages in the ORed depends will be removed.
@@ -1236,34 +1210,10 @@ def check_reverse_depends(removals, suite, arches=None, session=None, cruft=Fals
 
     # Check source dependencies (Build-Depends and Build-Depends-Indep)
     all_broken = defaultdict(set)
-    metakey_bd = get_or_set_metadatakey("Build-Depends", session)
-    metakey_bdi = get_or_set_metadatakey("Build-Depends-Indep", session)
-    params = {
-        'suite_id':    dbsuite.suite_id,
-        'metakey_ids': (metakey_bd.key_id, metakey_bdi.key_id),
-    }
-    statement = '''
-        SELECT s.source, string_agg(sm.value, ', ') as build_dep
-           FROM source s
-           JOIN source_metadata sm ON s.id = sm.src_id
-           WHERE s.id in
-               (SELECT source FROM src_associations
-                   WHERE suite = :suite_id)
-               AND sm.key_id in :metakey_ids
-           GROUP BY s.id, s.source'''
-    query = session.query('source', 'build_dep').from_statement(statement). \
-        params(params)
-    for source, build_dep in query:
+    for source, clause_ids in snapshot.source_packages():
         if source in removals: continue
-        parsed_dep = []
-        if build_dep is not None:
-            # Remove [arch] information since we want to see breakage on all arches
-            build_dep = re_build_dep_arch.sub("", build_dep)
-            try:
-                parsed_dep = apt_pkg.parse_src_depends(build_dep)
-            except ValueError as e:
-                print "Error for source %s: %s" % (source, e)
-        for dep in parsed_dep:
+        for clause_id in clause_ids:
+            dep = snapshot.clause(clause_id)
             unsat = 0
             for dep_package, _, _ in dep:
                 if dep_package in removals:
@@ -1339,3 +1289,41 @@ def is_in_debug_section(control):
     """
     section = control['Section'].split('/', 1)[-1]
     return section == "debug"
+
+################################################################################
+
+def copy_escape(value):
+    """escape a value for the text format of PostgreSQL's COPY
+
+    @type  value: str
+    @param value: value to escape
+
+    @rtype: str
+    @return: escaped value
+    """
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+################################################################################
+
+def open_cache_file(filename):
+    """open a cache file that nobody else could have written
+
+    Some caches below Dir::Cache are pickled, and unpickling can run
+    arbitrary code. So they are only used if they are owned by the current
+    user or root and are neither group nor world writable.
+
+    @type  filename: str
+    @param filename: name of the cache file
+
+    @rtype:  file or None
+    @return: file object for reading or C{None} if the file is not trusted
+
+    @raise IOError: the file cannot be opened
+    """
+    fh = open(filename, 'r')
+    st = os.fstat(fh.fileno())
+    if st.st_uid not in (0, os.geteuid()) or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        fh.close()
+        return None
+    return fh
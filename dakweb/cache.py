@@ -0,0 +1,182 @@
+""" Response cache for dakweb
+
+Answers to queries only change when dak modifies the archive. Every
+transaction doing so increments the generation counter in the
+cache_generation table, so responses are kept in the process until the
+generation changes, they expire or they are evicted to keep the cache below
+its size limit.
+
+@contact: Debian FTPMaster <ftpmaster@debian.org>
+@copyright: 2016  Debian FTP Masters
+@license: GNU General Public License version 2 or later
+"""
+
+import bottle
+import functools
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+from daklib.dbconn import DBConn, clear_lookup_cache
+from dakweb.jsonstream import not_modified
+
+#: seconds after which responses expire even if the generation is unchanged
+CACHE_TTL = 300
+
+#: seconds the generation is trusted before it is read from the database again
+GENERATION_TTL = 2
+
+#: total size of all cached responses in bytes
+CACHE_SIZE = 64 * 1024 * 1024
+
+#: responses larger than this are not cached, but streamed
+MAX_ENTRY_SIZE = 4 * 1024 * 1024
+
+#: response headers that are cached along with the body
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Link')
+
+
+class ResponseCache(object):
+    """
+    LRU cache of responses with a maximum age which is cleared whenever the
+    generation changes.
+
+    Entries are only stored if the generation did not change while they
+    were computed, so a response read before a change can never be served
+    after the cache noticed it.
+    """
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL, generation_ttl=GENERATION_TTL):
+        self.max_size = size
+        self.ttl = ttl
+        self.generation_ttl = generation_ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = None
+        self.generation_checked = None
+        self.lock = threading.Lock()
+
+    def read_generation(self):
+        session = DBConn().session()
+        try:
+            return session.execute("SELECT generation FROM cache_generation").scalar()
+        finally:
+            session.close()
+
+    def check_generation(self, now):
+        """
+        Clears the cache if the generation changed. The lookup cache of
+        L{daklib.dbconn} is cleared as well, as suites, architectures or
+        components might have been renamed or removed.
+
+        @rtype: int
+        @return: current generation
+        """
+        checked = self.generation_checked
+        if checked is not None and checked <= now < checked + self.generation_ttl:
+            return self.generation
+
+        generation = self.read_generation()
+        with self.lock:
+            self.generation_checked = now
+            if generation != self.generation:
+                self.entries.clear()
+                self.size = 0
+                self.generation = generation
+                clear_lookup_cache()
+        return generation
+
+    def get(self, key, now):
+        """
+        @rtype: tuple or None
+        @return: (headers, body) of the cached response
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, headers, body = entry
+            if expires <= now:
+                self.size -= len(body)
+                return None
+            # move to the end: most recently used
+            self.entries[key] = entry
+            return headers, body
+
+    def put(self, key, generation, headers, body, now):
+        if len(body) > self.max_size:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[2])
+            self.entries[key] = (now + self.ttl, headers, body)
+            self.size += len(body)
+            while self.size > self.max_size:
+                _, (expires, old_headers, old_body) = self.entries.popitem(last=False)
+                self.size -= len(old_body)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.generation = None
+            self.generation_checked = None
+
+response_cache = ResponseCache()
+
+
+def cached(func):
+    """
+    Decorator serving a query from L{response_cache}.
+
+    Responses are cached by path and query string. Only successful
+    responses up to L{MAX_ENTRY_SIZE} bytes are stored; larger ones are
+    streamed as usual.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        now = time.time()
+        generation = response_cache.check_generation(now)
+        key = (bottle.request.path, tuple(sorted(bottle.request.query.allitems())))
+
+        entry = response_cache.get(key, now)
+        if entry is not None:
+            headers, body = entry
+            for name, value in headers:
+                bottle.response.set_header(name, value)
+            etag = bottle.response.get_header('ETag')
+            if etag is not None:
+                response = not_modified(etag)
+                if response is not None:
+                    return response
+            return body
+
+        result = func(*args, **kwargs)
+        if isinstance(result, bottle.HTTPResponse):
+            return result
+
+        if isinstance(result, basestring):
+            parts = [result]
+        else:
+            parts = []
+            size = 0
+            result = iter(result)
+            for part in result:
+                parts.append(part)
+                size += len(part)
+                if size > MAX_ENTRY_SIZE:
+                    return itertools.chain(parts, result)
+
+        if bottle.response.status_code != 200:
+            return parts
+
+        body = ''.join(parts)
+        headers = [(name, bottle.response.get_header(name)) for name in CACHED_HEADERS
+                   if bottle.response.get_header(name) is not None]
+        response_cache.put(key, generation, headers, body, now)
+        return body
+
+    return wrapper
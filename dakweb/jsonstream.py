@@ -0,0 +1,132 @@
+""" Helpers for large JSON responses
+
+Rows are streamed to the client as a JSON list while they are read from
+the database. Responses carry an ETag computed from a cheap summary of the
+tables involved, so clients polling an unchanged result get a 304, and
+list queries can be paginated by a key ("keyset pagination") instead of an
+offset.
+
+@contact: Debian FTPMaster <ftpmaster@debian.org>
+@copyright: 2016  Debian FTP Masters
+@license: GNU General Public License version 2 or later
+"""
+
+import bottle
+import hashlib
+import json
+import urllib
+
+#: rows put into a single chunk of the response
+CHUNK_SIZE = 1000
+
+#: largest page size clients may ask for
+MAX_PAGE_SIZE = 50000
+
+
+def json_list(rows, session=None):
+    """
+    Generates a JSON list of C{rows} in chunks.
+
+    @type rows: iterable of dictionaries
+    @param rows: the items of the list
+
+    @type session: SQLA Session
+    @param session: closed once all rows were read (or the client went away)
+    """
+    try:
+        yield '['
+        chunk = []
+        first = True
+        for row in rows:
+            chunk.append(json.dumps(row))
+            if len(chunk) >= CHUNK_SIZE:
+                yield ('' if first else ', ') + ', '.join(chunk)
+                first = False
+                chunk = []
+        if chunk:
+            yield ('' if first else ', ') + ', '.join(chunk)
+        yield ']'
+    finally:
+        if session is not None:
+            session.close()
+
+
+def etag_response(session, statement, params={}):
+    """
+    Sets the ETag of the response to a digest of the row returned by
+    C{statement} (which should summarise everything the response depends
+    on). Returns a 304 response if the client already has this version,
+    None otherwise.
+    """
+    row = session.execute(statement, params).fetchone()
+    key = '/'.join(str(value) for value in row)
+    etag = 'W/"{0}"'.format(hashlib.sha1(key).hexdigest())
+    bottle.response.set_header('ETag', etag)
+    return not_modified(etag)
+
+
+def not_modified(etag):
+    """
+    Returns a 304 response if the If-None-Match header of the request
+    matches C{etag}, None otherwise.
+    """
+    if_none_match = bottle.request.get_header('If-None-Match')
+    if if_none_match is not None:
+        # weak comparison: W/"x" and "x" match
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        if '*' in tags or (etag[2:] if etag.startswith('W/') else etag) in tags:
+            return bottle.HTTPResponse(status=304, headers={'ETag': etag})
+    return None
+
+
+def page_parameters():
+    """
+    Returns (limit, after) from the query string.
+
+    C{limit} is the page size, C{after} the key of the last item of the
+    previous page as a list of strings (split at "_"). Both are None if not
+    given.
+
+    @raise bottle.HTTPError: the parameters are invalid
+    """
+    query = bottle.request.query
+    limit = query.get('limit')
+    after = query.get('after')
+
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise bottle.HTTPError(503, 'Invalid limit.')
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise bottle.HTTPError(503, 'Limit must be between 1 and {0}.'.format(MAX_PAGE_SIZE))
+    if after is not None:
+        after = after.split('_')
+
+    return limit, after
+
+
+def paginate(query, limit, key):
+    """
+    Reads one page of C{query} and sets a Link header pointing to the next
+    page if there is one.
+
+    @type query: SQLA Query
+    @param query: query already ordered by and filtered on the key
+
+    @type key: function
+    @param key: returns the key of a row as list of strings
+
+    @rtype: list
+    @return: rows of the page
+    """
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        params = dict(bottle.request.query)
+        params['limit'] = str(limit)
+        params['after'] = '_'.join(key(rows[-1]))
+        url = '{0}?{1}'.format(bottle.request.path, urllib.urlencode(sorted(params.items())))
+        bottle.response.set_header('Link', '<{0}>; rel="next"'.format(url))
+    return rows
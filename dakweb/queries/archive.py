@@ -11,10 +11,12 @@ import bottle
 import json
 
 from daklib.dbconn import DBConn, Archive
+from dakweb.cache import cached
 from dakweb.webregister import QueryRegister
 
 
 @bottle.route('/archives')
+@cached
 def archives():
     """
     Give information about all known archives (sets of suites)
@@ -10,9 +10,11 @@ import bottle
 import json
 
 from daklib.ls import list_packages
+from dakweb.cache import cached
 from dakweb.webregister import QueryRegister
 
 @bottle.route('/madison')
+@cached
 def madison():
     """
     Display information about B{package(s)}.
@@ -6,15 +6,55 @@
 @license: GNU General Public License version 2 or later
 """
 
-from sqlalchemy import or_
+from sqlalchemy import or_, tuple_
 import bottle
-import json
 
-from daklib.dbconn import DBConn, DBSource, Suite, DSCFile, PoolFile
+from daklib.dbconn import DBConn, DBSource, Suite, DSCFile, PoolFile, ArchiveFile, Component
+from dakweb.cache import cached
 from dakweb.webregister import QueryRegister
+from dakweb.jsonstream import json_list, etag_response, page_parameters, paginate
+
+
+def _suite_etag(session, suite):
+    # every change of the sources in the suite changes the number of
+    # associations or the sum of their ids (ids are never reused)
+    statement = """
+        SELECT count(*), coalesce(sum(sa.id), 0)
+          FROM src_associations sa
+          JOIN suite su ON su.id = sa.suite
+         WHERE su.suite_name = :suite OR su.codename = :suite"""
+    return etag_response(session, statement, {'suite': suite})
+
+
+def _source_version_list(session, q):
+    """
+    Returns the JSON response for a query of (source, version) pairs,
+    paginated if requested.
+    """
+    try:
+        limit, after = page_parameters()
+    except bottle.HTTPError:
+        session.close()
+        raise
+
+    q = q.order_by(DBSource.source, DBSource.version)
+    if after is not None:
+        if len(after) != 2:
+            session.close()
+            return bottle.HTTPError(503, 'Invalid key to continue after.')
+        q = q.filter(tuple_(DBSource.source, DBSource.version) > tuple_(*after))
+
+    if limit is not None:
+        rows = paginate(q, limit, lambda row: [row.source, row.version])
+        session.close()
+        return json_list({'source': source, 'version': version} for source, version in rows)
+
+    rows = q.yield_per(1000)
+    return json_list(({'source': source, 'version': version} for source, version in rows), session)
 
 
 @bottle.route('/dsc_in_suite/<suite>/<source>')
+@cached
 def dsc_in_suite(suite=None, source=None):
     """
     Find all dsc files for a given source package name in a given suite.
@@ -28,6 +68,9 @@ def dsc_in_suite(suite=None, source=None):
     @type source: string
     @param source: Source package to query for.
 
+    The response carries an ETag; a request with a matching If-None-Match
+    header is answered with 304 Not Modified.
+
     @rtype: list of dictionaries
     @return: Dictionaries made out of
              - version
@@ -42,27 +85,35 @@ def dsc_in_suite(suite=None, source=None):
         return bottle.HTTPError(503, 'Source package not specified.')
 
     s = DBConn().session()
-    q = s.query(DSCFile).join(PoolFile)
-    q = q.join(DBSource).join(Suite, DBSource.suites)
+    not_modified = _suite_etag(s, suite)
+    if not_modified is not None:
+        s.close()
+        return not_modified
+
+    q = s.query(DBSource.version, Component.component_name, PoolFile.filename,
+                PoolFile.filesize, PoolFile.sha256sum)
+    q = q.join(DSCFile, DSCFile.source_id == DBSource.source_id)
+    q = q.join(PoolFile, DSCFile.poolfile_id == PoolFile.file_id)
+    q = q.join(Suite, DBSource.suites)
+    q = q.join(ArchiveFile, (ArchiveFile.file_id == PoolFile.file_id) & (ArchiveFile.archive_id == Suite.archive_id))
+    q = q.join(Component, ArchiveFile.component_id == Component.component_id)
     q = q.filter(or_(Suite.suite_name == suite, Suite.codename == suite))
     q = q.filter(DBSource.source == source)
     q = q.filter(PoolFile.filename.endswith('.dsc'))
-    ret = []
-    for p in q:
-        ret.append({'version':   p.source.version,
-                    'component': p.poolfile.component.component_name,
-                    'filename':  p.poolfile.filename,
-                    'filesize':  p.poolfile.filesize,
-                    'sha256sum': p.poolfile.sha256sum})
-
-    s.close()
 
-    return json.dumps(ret)
+    rows = ({'version':   version,
+             'component': component,
+             'filename':  filename,
+             'filesize':  filesize,
+             'sha256sum': sha256sum}
+            for version, component, filename, filesize, sha256sum in q.yield_per(1000))
+    return json_list(rows, s)
 
 QueryRegister().register_path('/dsc_in_suite', dsc_in_suite)
 
 
 @bottle.route('/sources_in_suite/<suite>')
+@cached
 def sources_in_suite(suite=None):
     """
     Returns all source packages and their versions in a given suite.
@@ -73,6 +124,14 @@ def sources_in_suite(suite=None):
     @param suite: Name of the suite.
     @see: L{I{suites}<dakweb.queries.suite.suites>} on how to receive a list of valid suites.
 
+    @keyword limit: return at most this many sources; a Link header with
+                    rel="next" points to the next page.
+    @keyword after: only return sources after this I{source_version} (as used
+                    in the Link header).
+
+    The response carries an ETag; a request with a matching If-None-Match
+    header is answered with 304 Not Modified.
+
     @rtype: list of dictionaries
     @return: Dictionaries made out of
              - source
@@ -82,26 +141,34 @@ def sources_in_suite(suite=None):
         return bottle.HTTPError(503, 'Suite not specified.')
 
     s = DBConn().session()
-    q = s.query(DBSource).join(Suite, DBSource.suites)
-    q = q.filter(or_(Suite.suite_name == suite, Suite.codename == suite))
-    ret = []
-    for p in q:
-        ret.append({'source':    p.source,
-                    'version':   p.version})
+    not_modified = _suite_etag(s, suite)
+    if not_modified is not None:
+        s.close()
+        return not_modified
 
-    s.close()
+    q = s.query(DBSource.source, DBSource.version).join(Suite, DBSource.suites)
+    q = q.filter(or_(Suite.suite_name == suite, Suite.codename == suite))
 
-    return json.dumps(ret)
+    return _source_version_list(s, q)
 
 QueryRegister().register_path('/sources_in_suite', sources_in_suite)
 
 
 @bottle.route('/all_sources')
+@cached
 def all_sources():
     """
     Returns all source packages and their versions known to the archive
     (this includes NEW).
 
+    @keyword limit: return at most this many sources; a Link header with
+                    rel="next" points to the next page.
+    @keyword after: only return sources after this I{source_version} (as used
+                    in the Link header).
+
+    The response carries an ETag; a request with a matching If-None-Match
+    header is answered with 304 Not Modified.
+
     @rtype: list of dictionaries
     @return: Dictionaries made out of
              - source
@@ -109,14 +176,13 @@ def all_sources():
     """
 
     s = DBConn().session()
-    q = s.query(DBSource)
-    ret = []
-    for p in q:
-        ret.append({'source':    p.source,
-                    'version':   p.version})
+    not_modified = etag_response(s, "SELECT count(*), coalesce(sum(id), 0) FROM source")
+    if not_modified is not None:
+        s.close()
+        return not_modified
 
-    s.close()
+    q = s.query(DBSource.source, DBSource.version)
 
-    return json.dumps(ret)
+    return _source_version_list(s, q)
 
 QueryRegister().register_path('/all_sources', all_sources)
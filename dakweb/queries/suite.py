@@ -11,10 +11,12 @@ import bottle
 import json
 
 from daklib.dbconn import DBConn, Suite
+from dakweb.cache import cached
 from dakweb.webregister import QueryRegister
 
 
 @bottle.route('/suites')
+@cached
 def suites():
     """
     Give information about all known suites.
@@ -53,6 +55,7 @@ def suites():
 QueryRegister().register_path('/suites', suites)
 
 @bottle.route('/suite/<suite>')
+@cached
 def suite(suite=None):
     """
     Gives information about a single suite.  Note that this routine will look
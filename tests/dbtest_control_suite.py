@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+from db_test import DBDakTestCase
+
+from daklib.dbconn import *
+import daklib.utils
+import dak.control_suite
+
+from StringIO import StringIO
+import unittest
+
+class FakeFilesystemTransaction(object):
+    def __init__(self):
+        self.copied = []
+
+    def copy(self, source, destination, link=True, symlink=False, mode=None):
+        self.copied.append((source, destination))
+
+class FakeTransaction(object):
+    def __init__(self, session):
+        self.session = session
+        self.fs = FakeFilesystemTransaction()
+
+class FakeLogger(object):
+    def __init__(self):
+        self.entries = []
+
+    def log(self, details):
+        self.entries.append(details)
+
+class Aborted(Exception):
+    pass
+
+class ControlSuiteTestCase(DBDakTestCase):
+    """
+    This TestCase checks setting the content of a suite with
+    C{dak control-suite --set}.
+    """
+
+    def setUp(self):
+        super(ControlSuiteTestCase, self).setUp()
+        self.warnings = []
+        self.old_warn = daklib.utils.warn
+        self.old_fubar = daklib.utils.fubar
+        daklib.utils.warn = self.warnings.append
+        def fubar(message):
+            raise Aborted(message)
+        daklib.utils.fubar = fubar
+        self.old_logger = dak.control_suite.Logger
+        dak.control_suite.Logger = FakeLogger()
+        self.setup_hello()
+
+    def tearDown(self):
+        daklib.utils.warn = self.old_warn
+        daklib.utils.fubar = self.old_fubar
+        dak.control_suite.Logger = self.old_logger
+        super(ControlSuiteTestCase, self).tearDown()
+
+    def setup_hello(self):
+        '''
+        Sets up hello 1.0-1 in testing and hello 1.0-2 in unstable, which
+        are in different archives. hello 1.0-3 is in no suite. testing
+        must be older than unstable.
+        '''
+        self.archive = {}
+        for name in ('ftp-master', 'testing'):
+            archive = Archive()
+            archive.archive_name = name
+            archive.description = name
+            archive.path = '/srv/{0}'.format(name)
+            archive.mode = '0644'
+            archive.tainted = False
+            archive.use_morgue = False
+            self.archive[name] = archive
+        self.unstable = Suite('unstable', '-')
+        self.unstable.archive = self.archive['ftp-master']
+        self.testing = Suite('testing', '-')
+        self.testing.archive = self.archive['testing']
+        check = VersionCheck()
+        check.suite = self.testing
+        check.check = 'MustBeOlderThan'
+        check.reference = self.unstable
+        self.arch = Architecture('amd64')
+        self.main = Component('main')
+        maintainer = Maintainer('Mr. Maintainer')
+        self.session.add_all(self.archive.values() +
+            [self.unstable, self.testing, check, self.arch, self.main, maintainer])
+
+        install_date = self.now()
+        self.source = {}
+        self.binary = {}
+        for version in ('1.0-1', '1.0-2', '1.0-3'):
+            dsc = PoolFile('h/hello/hello_{0}.dsc'.format(version), 0, '')
+            deb = PoolFile('h/hello/hello_{0}_amd64.deb'.format(version), 0, '')
+            source = DBSource('hello', version, maintainer, maintainer, dsc, install_date)
+            dsc_file = DSCFile()
+            dsc_file.source = source
+            dsc_file.poolfile = dsc
+            binary = DBBinary('hello', source, version, maintainer, self.arch, deb)
+            self.session.add_all([dsc, deb, source, dsc_file, binary,
+                ArchiveFile(self.archive['ftp-master'], self.main, dsc),
+                ArchiveFile(self.archive['ftp-master'], self.main, deb)])
+            self.source[version] = source
+            self.binary[version] = binary
+        self.source['1.0-1'].suites.append(self.testing)
+        self.binary['1.0-1'].suites.append(self.testing)
+        self.session.add_all([
+            ArchiveFile(self.archive['testing'], self.main, self.source['1.0-1'].poolfile),
+            ArchiveFile(self.archive['testing'], self.main, self.binary['1.0-1'].poolfile)])
+        self.source['1.0-2'].suites.append(self.unstable)
+        self.binary['1.0-2'].suites.append(self.unstable)
+        self.session.flush()
+
+    def set_testing(self, version, force=False):
+        content = "hello {0} source\nhello {0} amd64\n".format(version)
+        transaction = FakeTransaction(self.session)
+        dak.control_suite.set_suite(StringIO(content), self.testing, transaction, force=force)
+        return transaction
+
+    def contents(self, suite):
+        q = self.session.execute("""
+            SELECT s.source, s.version, 'source'
+              FROM source s JOIN src_associations sa ON sa.source = s.id
+             WHERE sa.suite = :suite_id
+            UNION ALL
+            SELECT b.package, b.version, a.arch_string
+              FROM binaries b JOIN bin_associations ba ON ba.bin = b.id
+              JOIN architecture a ON b.architecture = a.id
+             WHERE ba.suite = :suite_id""", {'suite_id': suite.suite_id})
+        return sorted(tuple(row) for row in q)
+
+    def test_set_unchanged(self):
+        transaction = self.set_testing('1.0-1')
+        self.assertEqual([('hello', '1.0-1', 'amd64'), ('hello', '1.0-1', 'source')],
+            self.contents(self.testing))
+        self.assertEqual([], transaction.fs.copied)
+        self.assertEqual([], dak.control_suite.Logger.entries)
+        self.assertEqual([], self.warnings)
+
+    def test_set_add_and_remove(self):
+        # 1.0-2 is as old as the version in unstable, which is allowed
+        transaction = self.set_testing('1.0-2')
+        self.assertEqual([('hello', '1.0-2', 'amd64'), ('hello', '1.0-2', 'source')],
+            self.contents(self.testing))
+        self.assertEqual([('hello', '1.0-2', 'amd64'), ('hello', '1.0-2', 'source')],
+            self.contents(self.unstable))
+        self.assertEqual([], self.warnings)
+
+        # files of the added packages were copied to the testing archive
+        self.assertEqual(sorted([
+            ('/srv/ftp-master/pool/main/h/hello/hello_1.0-2.dsc',
+             '/srv/testing/pool/main/h/hello/hello_1.0-2.dsc'),
+            ('/srv/ftp-master/pool/main/h/hello/hello_1.0-2_amd64.deb',
+             '/srv/testing/pool/main/h/hello/hello_1.0-2_amd64.deb')]),
+            sorted(transaction.fs.copied))
+        archive_id = self.archive['testing'].archive_id
+        for pkg in (self.source['1.0-2'], self.binary['1.0-2']):
+            self.assertEqual(1, self.session.query(ArchiveFile)
+                .filter_by(archive_id=archive_id, file_id=pkg.poolfile.file_id).count())
+
+        entries = dak.control_suite.Logger.entries
+        self.assertEqual(["added", "hello 1.0-2 source"], entries[0])
+        self.assertEqual(["added", "hello 1.0-2 amd64"], entries[1])
+        self.assertEqual(sorted(["hello 1.0-1 source", "hello 1.0-1 amd64"]),
+            sorted(entry[1] for entry in entries[2:] if entry[0] == "removed"))
+
+        # setting the same content again changes nothing
+        transaction = self.set_testing('1.0-2')
+        self.assertEqual([('hello', '1.0-2', 'amd64'), ('hello', '1.0-2', 'source')],
+            self.contents(self.testing))
+        self.assertEqual([], transaction.fs.copied)
+        self.assertEqual(4, len(dak.control_suite.Logger.entries))
+
+    def test_set_must_be_older_than(self):
+        # 1.0-3 is newer than 1.0-2 in unstable
+        self.assertRaises(Aborted, self.set_testing, '1.0-3')
+        self.assertEqual(2, len(self.warnings))
+        for warning in self.warnings:
+            self.assertTrue('1.0-3 targeted at testing is *not* older than 1.0-2 in unstable' in warning)
+
+    def test_set_must_be_older_than_forced(self):
+        self.set_testing('1.0-3', force=True)
+        self.assertEqual([('hello', '1.0-3', 'amd64'), ('hello', '1.0-3', 'source')],
+            self.contents(self.testing))
+        self.assertEqual("Continuing anyway (forced)...", self.warnings[-1])
+
+    def classes_to_clean(self):
+        return [DBBinary, DSCFile, DBSource, ArchiveFile, PoolFile, VersionCheck,
+            Suite, Archive, Architecture, Component, Maintainer]
+
+if __name__ == '__main__':
+    unittest.main()
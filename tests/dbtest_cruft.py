@@ -66,6 +66,9 @@ class CruftTestCase(DBDakTestCase):
         self.assertEqual(True, bin.has_multiple_sources())
         self.assertEqual('hello built by: hello(2.2-1, 2.2-2), sl(3.03-16)', \
             str(bin))
+        # test multiple_source_binaries()
+        self.assertEqual([('hello', [('hello', '2.2-1, 2.2-2'), ('sl', '3.03-16')])], \
+            list(multiple_source_binaries(suite)))
 
 if __name__ == '__main__':
     unittest.main()
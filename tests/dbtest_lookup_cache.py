@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+from db_test import DBDakTestCase
+
+from daklib.dbconn import Architecture, clear_lookup_cache, get_architecture, \
+    get_architecture_id
+
+import unittest
+
+class LookupCacheTestCase(DBDakTestCase):
+    """
+    This TestCase checks the per-process cache of name lookups.
+    """
+
+    def setUp(self):
+        super(LookupCacheTestCase, self).setUp()
+        clear_lookup_cache()
+        self.arch = Architecture('mips64el')
+        self.session.add(self.arch)
+        self.session.flush()
+
+    def tearDown(self):
+        clear_lookup_cache()
+        super(LookupCacheTestCase, self).tearDown()
+
+    def test_get_id(self):
+        self.assertEqual(None, get_architecture_id('nonexistent', self.session))
+        arch_id = get_architecture_id('mips64el', self.session)
+        self.assertEqual(self.arch.arch_id, arch_id)
+        self.assertEqual(self.arch, get_architecture('mips64el', self.session))
+
+        # cached ids are used without asking the database
+        self.session.execute("UPDATE architecture SET arch_string = 'renamed' WHERE id = :id",
+                             {'id': arch_id})
+        self.assertEqual(arch_id, get_architecture_id('mips64el', self.session))
+
+        clear_lookup_cache()
+        self.assertEqual(None, get_architecture_id('mips64el', self.session))
+
+if __name__ == '__main__':
+    unittest.main()
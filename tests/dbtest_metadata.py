@@ -2,7 +2,9 @@
 
 from db_test import DBDakTestCase
 
-from daklib.dbconn import DBConn, MetadataKey, BinaryMetadata, SourceMetadata
+from daklib.dbconn import DBConn, MetadataKey, BinaryMetadata, SourceMetadata, \
+    import_metadata_into_db_many
+import daklib.dbconn
 
 import unittest
 
@@ -89,5 +91,21 @@ class MetadataTestCase(DBDakTestCase):
         self.session.delete(self.src_hello)
         self.session.flush()
 
+    def test_import_many(self):
+        '''
+        Tests importing the metadata of several packages at once.
+        '''
+        self.setup_binaries()
+        daklib.dbconn._metadata_key_ids = None
+        hello = self.binary['hello_2.2-1_i386']
+        gnome_hello = self.binary['gnome-hello_2.2-1_i386']
+        hello.read_control_fields = lambda: {'Package': 'hello', 'Depends': 'libc6'}
+        gnome_hello.read_control_fields = lambda: {'Package': 'gnome-hello', 'Depends': 'hello'}
+        import_metadata_into_db_many([hello, gnome_hello], self.session)
+        depends = self.session.query(MetadataKey).filter_by(key='Depends').one()
+        self.assertEqual('libc6', hello.metadata[depends])
+        self.assertEqual('hello', gnome_hello.metadata[depends])
+        self.assertEqual(2, len(gnome_hello.metadata))
+
 if __name__ == '__main__':
     unittest.main()
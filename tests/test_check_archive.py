@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import dak.check_archive
+from dak.check_archive import _walk_sorted, check_pool_prefix
+from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
+
+class FakeConnection(object):
+    def __init__(self, filenames):
+        self.filenames = filenames
+
+    def execution_options(self, **kwargs):
+        return self
+
+    def execute(self, sql, **params):
+        # ORDER BY filename COLLATE "C" compares bytes
+        return [ (filename,) for filename in sorted(self.filenames) ]
+
+class FakeSession(object):
+    def __init__(self, filenames):
+        self.filenames = filenames
+
+    def connection(self):
+        return FakeConnection(self.filenames)
+
+    def close(self):
+        pass
+
+class FakeDBConn(object):
+    filenames = []
+
+    def session(self):
+        return FakeSession(self.filenames)
+
+class CheckPoolTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_dbconn = dak.check_archive.DBConn
+        dak.check_archive.DBConn = FakeDBConn
+
+    def tearDown(self):
+        dak.check_archive.DBConn = self.old_dbconn
+        shutil.rmtree(self.directory)
+
+    def create(self, *paths):
+        for path in paths:
+            path = os.path.join(self.directory, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def testWalkSorted(self):
+        self.create('main/h/hello/hello_1.0.dsc',
+                    'main/h/hello-foo/hello-foo_1.0.dsc',
+                    'main/h/hello.orig',
+                    'main/h/hello0')
+        os.symlink('hello', os.path.join(self.directory, 'main/h/hello-link'))
+        os.symlink('hello.orig', os.path.join(self.directory, 'main/h/hello.link'))
+
+        entries = list(_walk_sorted(os.path.join(self.directory, 'main'), 'h'))
+        # "hello/" sorts after "hello-foo/" and "hello.orig", but before
+        # "hello0"; symlinks to directories are skipped
+        self.assertEqual(entries, [
+            ('h/hello-foo/hello-foo_1.0.dsc', False),
+            ('h/hello.link', True),
+            ('h/hello.orig', False),
+            ('h/hello/hello_1.0.dsc', False),
+            ('h/hello0', False),
+        ])
+        self.assertEqual([path for path, is_symlink in entries],
+                         sorted(path for path, is_symlink in entries))
+
+    def testCheckPoolPrefix(self):
+        self.create('main/h/hello/hello_1.0.dsc',
+                    'main/h/hello-foo/hello-foo_1.0.dsc',
+                    'main/h/hello.orig')
+        os.symlink('nonexistent', os.path.join(self.directory, 'main/h/hello/hello_1.0.tar.gz'))
+        FakeDBConn.filenames = ['h/hello/hello_1.0.dsc',
+                                'h/hello/hello_1.0.tar.gz',
+                                'h/hello/hello_1.0.diff.gz',
+                                'h/hello-foo/hello-foo_1.0.dsc']
+
+        status, messages = check_pool_prefix(1, 'ftp-master', self.directory, 'main', 'h')
+        self.assertEqual(status, PROC_STATUS_SUCCESS)
+        component_dir = os.path.join(self.directory, 'main')
+        self.assertEqual(messages, [
+            "UNEXPECTED-FILE ftp-master {0}/h/hello.orig".format(component_dir),
+            "MISSING-FILE ftp-master h/hello/hello_1.0.diff.gz {0}/h/hello/hello_1.0.diff.gz".format(component_dir),
+            "MISSING-FILE ftp-master h/hello/hello_1.0.tar.gz {0}/h/hello/hello_1.0.tar.gz".format(component_dir),
+        ])
+
+    def testCheckPoolWithoutPrefix(self):
+        self.create('main/README', 'main/h/hello/hello_1.0.dsc')
+        FakeDBConn.filenames = ['INDEX']
+
+        status, messages = check_pool_prefix(1, 'ftp-master', self.directory, 'main', None)
+        component_dir = os.path.join(self.directory, 'main')
+        self.assertEqual(messages, [
+            "MISSING-FILE ftp-master INDEX {0}/INDEX".format(component_dir),
+            "UNEXPECTED-FILE ftp-master {0}/README".format(component_dir),
+        ])
+
+if __name__ == '__main__':
+    unittest.main()
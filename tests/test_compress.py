@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import bz2
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from daklib.compress import open_decompressed
+
+class OpenDecompressedTestCase(DakTestCase):
+    data = ''.join('Package: dak{0}\n\n'.format(i) for i in range(20000))
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertContent(self, filename, data, chunk_size=4096):
+        fh = open_decompressed(filename)
+        chunks = []
+        for chunk in iter(lambda: fh.read(chunk_size), ''):
+            self.assertTrue(len(chunk) <= chunk_size)
+            chunks.append(chunk)
+        fh.close()
+        self.assertEqual(''.join(chunks), data)
+
+    def compress(self, cmd, suffix, parts):
+        filename = os.path.join(self.directory, 'Packages' + suffix)
+        with open(filename, 'w') as fh:
+            for part in parts:
+                p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=fh)
+                p.communicate(part)
+        return filename
+
+    def testUncompressed(self):
+        filename = os.path.join(self.directory, 'Packages')
+        with open(filename, 'w') as fh:
+            fh.write(self.data)
+        self.assertContent(filename, self.data)
+
+    def testGzip(self):
+        self.assertContent(self.compress(['gzip', '-c'], '.gz', [self.data]), self.data)
+
+    def testBzip2(self):
+        self.assertContent(self.compress(['bzip2', '-c'], '.bz2', [self.data]), self.data)
+
+    def testXz(self):
+        self.assertContent(self.compress(['xz', '-c'], '.xz', [self.data]), self.data)
+
+    def testConcatenatedStreams(self):
+        parts = [self.data[:1000], self.data[1000:]]
+        for cmd, suffix in ((['gzip', '-c'], '.gz'), (['bzip2', '-c'], '.bz2'), (['xz', '-c'], '.xz')):
+            self.assertContent(self.compress(cmd, suffix, parts), self.data)
+
+    def testReadAll(self):
+        fh = open_decompressed(self.compress(['gzip', '-c'], '.gz', [self.data]))
+        self.assertEqual(fh.read(10), self.data[:10])
+        self.assertEqual(fh.read(), self.data[10:])
+        self.assertEqual(fh.read(), '')
+        fh.close()
+
+if __name__ == '__main__':
+    unittest.main()
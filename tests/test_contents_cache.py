@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import daklib.contents
+from daklib.config import Config
+from daklib.contents import BinaryContentsWriter
+from daklib.filewriter import BinaryContentsFileWriter
+
+class FakeSession(object):
+    def rollback(self):
+        pass
+
+    def commit(self):
+        pass
+
+class FakeHashCache(object):
+    def __init__(self, session):
+        pass
+
+    def add_written_files(self, hashes, written):
+        pass
+
+    def save(self):
+        pass
+
+class FakeContentsWriter(BinaryContentsWriter):
+    '''
+    BinaryContentsWriter reading binaries and their files from a dict
+    instead of the database.
+    '''
+    def __init__(self, directory, binaries):
+        self.directory = directory
+        self.binaries = binaries
+        self.session = FakeSession()
+
+    def get_header(self):
+        return 'header\n'
+
+    def cache_name(self):
+        return 'sid_main_deb_amd64'
+
+    def newest_binaries(self):
+        return dict((binary_id, (package, section)) \
+            for binary_id, (package, section, files) in self.binaries.iteritems())
+
+    def fetch_entries(self, binaries):
+        entries = []
+        for binary_id, (package, section) in binaries.iteritems():
+            for filename in self.binaries[binary_id][2]:
+                entries.append((filename, package, binary_id, section))
+        return iter(sorted(entries))
+
+    def writer(self):
+        return BinaryContentsFileWriter(archive=self.directory, suite='sid',
+            component='main', debtype='deb', architecture='amd64')
+
+class ContentsCacheTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_cache_dir = Config().find('Contents::CacheDir')
+        Config()['Contents::CacheDir'] = os.path.join(self.directory, 'cache')
+        self.old_hashcache = daklib.contents.HashCache
+        daklib.contents.HashCache = FakeHashCache
+
+    def tearDown(self):
+        daklib.contents.HashCache = self.old_hashcache
+        Config()['Contents::CacheDir'] = self.old_cache_dir
+        shutil.rmtree(self.directory)
+
+    def contents(self):
+        path = os.path.join(self.directory, 'dists', 'sid', 'main', 'Contents-amd64.gz')
+        fh = daklib.contents.open_decompressed(path)
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+    def testIncremental(self):
+        binaries = {
+            1: ('hello', 'devel', ['usr/bin/hello']),
+            2: ('exim4', 'mail', ['usr/sbin/exim4']),
+        }
+        self.assertTrue(FakeContentsWriter(self.directory, binaries).write_file())
+        # nothing changed
+        self.assertFalse(FakeContentsWriter(self.directory, binaries).write_file())
+
+        binaries[3] = ('hello-dbg', 'debug', ['usr/bin/hello'])
+        del binaries[2]
+        self.assertTrue(FakeContentsWriter(self.directory, binaries).write_file())
+        contents = self.contents()
+        self.assertTrue(contents.startswith('header\n'))
+        self.assertTrue('devel/hello,debug/hello-dbg\n' in contents)
+        self.assertFalse('exim4' in contents)
+        self.assertFalse(FakeContentsWriter(self.directory, binaries).write_file())
+
+if __name__ == '__main__':
+    unittest.main()
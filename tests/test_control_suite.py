@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import unittest
+
+import dak.control_suite
+
+class Reference(object):
+    def __init__(self, suite_name):
+        self.suite_name = suite_name
+
+class VersionCheck(object):
+    def __init__(self, suite_name):
+        self.reference = Reference(suite_name)
+
+class Aborted(Exception):
+    pass
+
+class FakeUtils(object):
+    def __init__(self):
+        self.warnings = []
+
+    def warn(self, message):
+        self.warnings.append(message)
+
+    def fubar(self, message):
+        raise Aborted(message)
+
+class VersionChecksTestCase(DakTestCase):
+    def setUp(self):
+        self.module = dak.control_suite
+        self.old = dict((name, getattr(self.module, name)) for name in
+                        ('get_version_checks', 'get_suite_version_by_package', 'utils'))
+        self.module.get_version_checks = lambda suite, check: \
+            [VersionCheck('unstable')] if check == 'MustBeOlderThan' else []
+        self.module.get_suite_version_by_package = lambda package, architecture, session: \
+            [('testing', '1.0-1'), ('unstable', '1.0-2')]
+        self.module.utils = FakeUtils()
+
+    def tearDown(self):
+        for name, value in self.old.iteritems():
+            setattr(self.module, name, value)
+
+    def check(self, version):
+        self.module.version_checks('hello', 'amd64', 'testing', version, None)
+
+    def testOlder(self):
+        self.check('1.0-2')
+        self.assertEqual(self.module.utils.warnings, [])
+
+    def testNewerThanMustBeOlderThan(self):
+        self.assertRaises(Aborted, self.check, '1.0-3')
+        self.assertTrue('*not* older than 1.0-2 in unstable' in self.module.utils.warnings[0])
+
+    def testNotNewer(self):
+        self.assertRaises(Aborted, self.check, '1.0-1')
+        self.assertTrue('*not* newer than 1.0-1 in testing' in self.module.utils.warnings[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,7 +17,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 from base_test import DakTestCase
-from daklib.fstransactions import FilesystemTransaction
+from daklib.fstransactions import FilesystemTransaction, transfer_file
+import daklib.fstransactions
 
 from unittest import main
 
@@ -115,5 +116,73 @@ class FilesystemTransactionTestCase(DakTestCase):
                 pass
             self.assert_(os.path.exists(a))
 
+    def test_copy_mode_and_independent_inode(self):
+        with TemporaryDirectory() as t:
+            self._write_to_a(t)
+            os.chmod(t.filename('a'), 0o600)
+            with FilesystemTransaction() as fs:
+                self._copy_a_b(t, fs, mode=0o644)
+            st_a = os.stat(t.filename('a'))
+            st_b = os.stat(t.filename('b'))
+            self.assertNotEqual(st_a.st_ino, st_b.st_ino)
+            self.assertEqual(st_a.st_mode & 0o7777, 0o600)
+            self.assertEqual(st_b.st_mode & 0o7777, 0o644)
+            self.assertEqual(open(t.filename('b')).read(), 'a\n')
+
+    def test_copy_link(self):
+        with TemporaryDirectory() as t:
+            self._write_to_a(t)
+            with FilesystemTransaction() as fs:
+                self._copy_a_b(t, fs, link=True)
+            self.assertEqual(os.stat(t.filename('a')).st_ino, os.stat(t.filename('b')).st_ino)
+
+    def test_transfer_fallback(self):
+        def unsupported(source_fd, destination_fd, size):
+            os.write(destination_fd, 'garbage')
+            raise daklib.fstransactions._TransferNotSupported()
+        methods = daklib.fstransactions._COPY_METHODS
+        daklib.fstransactions._COPY_METHODS = (('unsupported', unsupported),) + methods[-1:]
+        try:
+            with TemporaryDirectory() as t:
+                with open(t.filename('a'), 'w') as fh:
+                    fh.write('x' * 100000)
+                self.assertEqual(transfer_file(t.filename('a'), t.filename('b')), 'copy')
+                self.assertEqual(open(t.filename('b')).read(), 'x' * 100000)
+                # a method that failed is not tried again
+                self.assertEqual(transfer_file(t.filename('a'), t.filename('c')), 'copy')
+                self.assertEqual(open(t.filename('c')).read(), 'x' * 100000)
+        finally:
+            daklib.fstransactions._COPY_METHODS = methods
+            daklib.fstransactions._unsupported.clear()
+
+    def test_copy_range_short(self):
+        def copy_nothing(source_fd, source_offset, destination_fd, destination_offset, size, flags):
+            return 0
+        copy_file_range = daklib.fstransactions._copy_file_range
+        daklib.fstransactions._copy_file_range = copy_nothing
+        try:
+            with TemporaryDirectory() as t:
+                self._write_to_a(t)
+                with open(t.filename('a')) as a, open(t.filename('b'), 'w') as b:
+                    self.assertRaises(daklib.fstransactions._TransferNotSupported,
+                                      daklib.fstransactions._copy_range, a.fileno(), b.fileno(), 2)
+        finally:
+            daklib.fstransactions._copy_file_range = copy_file_range
+
+    def test_copy_link_group(self):
+        groups = [gid for gid in os.getgroups() if gid != os.getegid()]
+        if os.geteuid() == 0:
+            groups.append(os.getegid() + 1)
+        if not groups:
+            return
+        with TemporaryDirectory() as t:
+            self._write_to_a(t)
+            os.mkdir(t.filename('pool'))
+            os.chown(t.filename('pool'), -1, groups[0])
+            os.chmod(t.filename('pool'), 0o2755)
+            self.assertEqual(transfer_file(t.filename('a'), t.filename('pool/b'), link=True), 'link')
+            # the linked file gets the group a copy would get
+            self.assertEqual(os.stat(t.filename('pool/b')).st_gid, groups[0])
+
 if __name__ == '__main__':
     main()
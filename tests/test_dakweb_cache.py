@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import unittest
+
+from dakweb.cache import ResponseCache
+
+class FakeGenerationCache(ResponseCache):
+    def __init__(self, *args, **kwargs):
+        super(FakeGenerationCache, self).__init__(*args, **kwargs)
+        self.current_generation = 1
+        self.reads = 0
+
+    def read_generation(self):
+        self.reads += 1
+        return self.current_generation
+
+class ResponseCacheTestCase(DakTestCase):
+    def setUp(self):
+        self.cache = FakeGenerationCache(size=10, ttl=100, generation_ttl=5)
+
+    def put(self, key, body, now=0):
+        generation = self.cache.check_generation(now)
+        self.cache.put(key, generation, [], body, now)
+
+    def testGetPut(self):
+        self.assertEqual(self.cache.get('a', 0), None)
+        self.put('a', 'abc')
+        self.assertEqual(self.cache.get('a', 1), ([], 'abc'))
+        self.assertEqual(self.cache.get('a', 100), None)
+        self.assertEqual(self.cache.size, 0)
+
+    def testEviction(self):
+        self.put('a', 'aaaa')
+        self.put('b', 'bbbb')
+        # 'a' becomes most recently used, so 'b' is evicted
+        self.cache.get('a', 1)
+        self.put('c', 'cccc')
+        self.assertEqual(self.cache.get('b', 1), None)
+        self.assertEqual(self.cache.get('a', 1), ([], 'aaaa'))
+        self.assertEqual(self.cache.get('c', 1), ([], 'cccc'))
+        self.assertEqual(self.cache.size, 8)
+
+        # too large
+        self.put('d', 'd' * 11)
+        self.assertEqual(self.cache.get('d', 1), None)
+
+    def testGeneration(self):
+        self.put('a', 'abc')
+        self.cache.current_generation = 2
+
+        # the generation is only read again after generation_ttl
+        self.assertEqual(self.cache.check_generation(4), 1)
+        self.assertEqual(self.cache.get('a', 4), ([], 'abc'))
+        self.assertEqual(self.cache.reads, 1)
+
+        self.assertEqual(self.cache.check_generation(5), 2)
+        self.assertEqual(self.cache.get('a', 5), None)
+
+    def testStaleResponse(self):
+        # a response computed before the generation changed is not stored
+        generation = self.cache.check_generation(0)
+        self.cache.current_generation = 2
+        self.cache.check_generation(5)
+        self.cache.put('a', generation, [], 'abc', 5)
+        self.assertEqual(self.cache.get('a', 5), None)
+
+if __name__ == '__main__':
+    unittest.main()
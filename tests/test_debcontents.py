@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from daklib.debcontents import scan_contents
+
+class ScanContentsTestCase(DakTestCase):
+    files = ['./usr/bin/hello', './usr/share/doc/hello/copyright', './usr/share/caf\xe9']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def data_tar(self):
+        fh = StringIO()
+        tar = tarfile.open(fileobj=fh, mode='w')
+        for name in ['./usr', './usr/bin'] + self.files:
+            info = tarfile.TarInfo(name)
+            if name in self.files:
+                info.size = len(name)
+                tar.addfile(info, StringIO(name))
+            else:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+        tar.close()
+        return fh.getvalue()
+
+    def build(self, member, cmd):
+        data = self.data_tar()
+        if cmd is not None:
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            data = process.communicate(data)[0]
+        deb = os.path.join(self.directory, 'hello.deb')
+        members = [('debian-binary', '2.0\n'), ('control.tar.gz', 'x'), (member, data)]
+        with open(deb, 'w') as fh:
+            fh.write('!<arch>\n')
+            for name, content in members:
+                fh.write('{0:<16}{1:<12}{2:<6}{3:<6}{4:<8}{5:<10}`\n'.format(name, 0, 0, 0, 100644, len(content)))
+                fh.write(content)
+                if len(content) % 2:
+                    fh.write('\n')
+        return deb
+
+    def assertContents(self, member, cmd):
+        deb = self.build(member, cmd)
+        expected = ['usr/bin/hello', 'usr/share/doc/hello/copyright', 'usr/share/caf\xc3\xa9']
+        self.assertEqual(list(scan_contents(deb)), expected)
+
+    def testUncompressed(self):
+        self.assertContents('data.tar', None)
+
+    def testGzip(self):
+        self.assertContents('data.tar.gz', ['gzip', '-c'])
+
+    def testBzip2(self):
+        self.assertContents('data.tar.bz2', ['bzip2', '-c'])
+
+    def testXz(self):
+        self.assertContents('data.tar.xz', ['xz', '-c'])
+
+    def testZstd(self):
+        self.assertContents('data.tar.zst', ['zstd', '-c', '-q'])
+
+if __name__ == '__main__':
+    unittest.main()
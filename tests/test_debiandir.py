@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import gzip
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from daklib.debiandir import read_debian_files, DebianDirError
+
+SUFFIXES = ('changelog', 'copyright', 'NEWS', 'NEWS.Debian', 'README.Debian')
+
+CHANGELOG = 'hello (1.0-1) unstable; urgency=low\n\n  * Initial release.\n'
+
+class ReadDebianFilesTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def tar(self, filename, files, cmd=None):
+        fh = StringIO()
+        tar = tarfile.open(fileobj=fh, mode='w')
+        for name, content in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, StringIO(content))
+        tar.close()
+        data = fh.getvalue()
+        if cmd is not None:
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            data = process.communicate(data)[0]
+        with open(os.path.join(self.directory, filename), 'w') as fh:
+            fh.write(data)
+
+    def diff(self, filename, content):
+        fh = gzip.GzipFile(os.path.join(self.directory, filename), 'w')
+        fh.write(content)
+        fh.close()
+
+    def testDebianTar(self):
+        self.tar('hello_1.0-1.debian.tar.xz', [
+            ('debian/changelog', CHANGELOG),
+            ('debian/copyright', 'GPL\n'),
+            ('debian/hello.NEWS', 'news\n'),
+            ('debian/rules', 'rules\n'),
+            ('debian/source/format', '3.0 (quilt)\n'),
+        ], ['xz', '-c'])
+        files = read_debian_files(self.directory, ['hello_1.0.orig.tar.gz', 'hello_1.0-1.debian.tar.xz'], SUFFIXES)
+        self.assertEqual(files, {'changelog': CHANGELOG, 'copyright': 'GPL\n', 'hello.NEWS': 'news\n'})
+
+    def testNative(self):
+        self.tar('hello_1.0.tar.gz', [
+            ('hello-1.0/README', 'readme\n'),
+            ('hello-1.0/debian/changelog', CHANGELOG),
+            ('hello-1.0/debian/README.Debian', 'readme\n'),
+        ], ['gzip', '-c'])
+        files = read_debian_files(self.directory, ['hello_1.0.tar.gz'], SUFFIXES)
+        self.assertEqual(files, {'changelog': CHANGELOG, 'README.Debian': 'readme\n'})
+
+    def testDiff(self):
+        changelog_lines = CHANGELOG.splitlines(True)
+        self.diff('hello_1.0-1.diff.gz', ''.join([
+            '--- hello-1.0.orig/src/hello.c\n',
+            '+++ hello-1.0/src/hello.c\n',
+            '@@ -1,2 +1,2 @@\n',
+            ' int main()\n',
+            '-{}\n',
+            '+{ return 0; }\n',
+            '--- hello-1.0.orig/debian/changelog\n',
+            '+++ hello-1.0/debian/changelog\n',
+            '@@ -0,0 +1,{0} @@\n'.format(len(changelog_lines)),
+            ] + [ '+' + line for line in changelog_lines ] + [
+            '--- hello-1.0.orig/debian/copyright\n',
+            '+++ hello-1.0/debian/copyright\n',
+            '@@ -0,0 +1 @@\n',
+            '+GPL\n',
+            '\\ No newline at end of file\n',
+            ]))
+        files = read_debian_files(self.directory, ['hello_1.0.orig.tar.gz', 'hello_1.0-1.diff.gz'], SUFFIXES)
+        self.assertEqual(files, {'changelog': CHANGELOG, 'copyright': 'GPL'})
+
+    def testDiffModifiesFile(self):
+        self.diff('hello_1.0-1.diff.gz', ''.join([
+            '--- hello-1.0.orig/debian/changelog\n',
+            '+++ hello-1.0/debian/changelog\n',
+            '@@ -1,1 +1,2 @@\n',
+            '+new entry\n',
+            ' old entry\n',
+            ]))
+        with self.assertRaises(DebianDirError):
+            read_debian_files(self.directory, ['hello_1.0.orig.tar.gz', 'hello_1.0-1.diff.gz'], SUFFIXES)
+
+    def testUnsupported(self):
+        with self.assertRaises(DebianDirError):
+            read_debian_files(self.directory, ['hello_1.0-1.git'], SUFFIXES)
+
+if __name__ == '__main__':
+    unittest.main()
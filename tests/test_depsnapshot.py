@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from daklib.depsnapshot import DependencySnapshot, _Relations, read_snapshot, write_snapshot
+
+class DependencySnapshotTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        snapshot = DependencySnapshot('unstable', 'key')
+        amd64 = snapshot.binaries['amd64'] = _Relations()
+        snapshot._add(amd64, 'hello', 'hello', 'main',
+                      [[('libc6', '2.14', '>=')], [('mail-transport-agent', '', ''), ('exim4', '', '')]],
+                      [])
+        snapshot._add(amd64, 'exim4', 'exim4', 'main',
+                      [[('libc6', '2.14', '>=')]],
+                      ['mail-transport-agent'])
+        snapshot._add(snapshot.sources, 'hello', None, None, [[('debhelper', '9', '>=')]], [])
+        self.snapshot = snapshot
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertSnapshot(self, snapshot):
+        binaries = list(snapshot.binary_packages('amd64'))
+        self.assertEqual([(b[0], b[1], b[2], b[4]) for b in binaries], [
+            ('hello', 'hello', 'main', []),
+            ('exim4', 'exim4', 'main', ['mail-transport-agent']),
+        ])
+        hello_clauses = [snapshot.clause(c) for c in binaries[0][3]]
+        self.assertEqual(hello_clauses, [
+            [('libc6', '2.14', '>=')],
+            [('mail-transport-agent', '', ''), ('exim4', '', '')],
+        ])
+        # identical clauses are stored once
+        self.assertEqual(binaries[0][3][0], binaries[1][3][0])
+        self.assertEqual(snapshot.clause_names(binaries[0][3][1]), frozenset(['mail-transport-agent', 'exim4']))
+
+        sources = [(source, [snapshot.clause(c) for c in clauses]) for source, clauses in snapshot.source_packages()]
+        self.assertEqual(sources, [('hello', [[('debhelper', '9', '>=')]])])
+        self.assertEqual(list(snapshot.binary_packages('i386')), [])
+
+    def testSnapshot(self):
+        self.assertSnapshot(self.snapshot)
+
+    def testReadWrite(self):
+        filename = os.path.join(self.directory, 'snapshot', 'unstable.pickle')
+        self.assertEqual(read_snapshot(filename), None)
+        write_snapshot(self.snapshot, filename)
+        snapshot = read_snapshot(filename)
+        self.assertEqual(snapshot.key, 'key')
+        self.assertSnapshot(snapshot)
+
+        # the loaded snapshot can still be extended
+        snapshot._add(snapshot.sources, 'exim4', None, None, [[('debhelper', '9', '>=')]], [])
+        self.assertEqual(len(snapshot.atom_offsets), len(self.snapshot.atom_offsets))
+
+    def testReadUntrusted(self):
+        filename = os.path.join(self.directory, 'unstable.pickle')
+        write_snapshot(self.snapshot, filename)
+        self.assertEqual(os.stat(filename).st_mode & 0o777, 0o644)
+        os.chmod(filename, 0o664)
+        self.assertEqual(read_snapshot(filename), None)
+
+    def testReadInvalid(self):
+        filename = os.path.join(self.directory, 'unstable.pickle')
+        with open(filename, 'w') as fh:
+            fh.write('garbage')
+        self.assertEqual(read_snapshot(filename), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import bz2
+import gzip
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from daklib.filewriter import BaseFileWriter
+
+class BaseFileWriterTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, compression, lines):
+        writer = BaseFileWriter('%(directory)s/sub/Packages', directory=self.directory, compression=compression)
+        fh = writer.open()
+        for line in lines:
+            print >>fh, line
+        writer.close()
+        return writer
+
+    def assertHashes(self, hashes, data):
+        self.assertEqual(hashes.size, len(data))
+        self.assertEqual(hashes.md5sum, hashlib.md5(data).hexdigest())
+        self.assertEqual(hashes.sha1sum, hashlib.sha1(data).hexdigest())
+        self.assertEqual(hashes.sha256sum, hashlib.sha256(data).hexdigest())
+
+    def testAllVariants(self):
+        lines = [ 'Package: dak{0}\nVersion: 1.{0}\n'.format(i) for i in range(5000) ]
+        expected = ''.join(line + '\n' for line in lines)
+        writer = self.write(['none', 'gzip', 'bzip2', 'xz'], lines)
+
+        path = os.path.join(self.directory, 'sub', 'Packages')
+        self.assertEqual(sorted(writer.hashes.keys()),
+                         sorted([path, path + '.gz', path + '.bz2', path + '.xz']))
+
+        self.assertEqual(open(path).read(), expected)
+        self.assertEqual(gzip.GzipFile(path + '.gz').read(), expected)
+        self.assertEqual(bz2.BZ2File(path + '.bz2').read(), expected)
+        self.assertEqual(subprocess.check_output(['xz', '-dc', path + '.xz']), expected)
+
+        self.assertHashes(writer.hashes[path], expected)
+        for suffix in ('.gz', '.bz2', '.xz'):
+            self.assertHashes(writer.hashes[path + suffix], open(path + suffix).read())
+            self.assertEqual(os.stat(path + suffix).st_mode & 0o777, 0o644)
+
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                         ['Packages', 'Packages.bz2', 'Packages.gz', 'Packages.xz'])
+        self.assertEqual(sorted(writer.written),
+                         sorted([path, path + '.gz', path + '.bz2', path + '.xz']))
+
+    def testCompressedOnly(self):
+        writer = self.write(['gzip'], ['Package: dak'])
+        path = os.path.join(self.directory, 'sub', 'Packages')
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + '.new'))
+        self.assertHashes(writer.hashes[path], 'Package: dak\n')
+        self.assertEqual(gzip.GzipFile(path + '.gz').read(), 'Package: dak\n')
+        self.assertEqual(writer.written, [path + '.gz'])
+
+if __name__ == '__main__':
+    unittest.main()
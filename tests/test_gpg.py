@@ -19,7 +19,7 @@
 import datetime
 import unittest
 from base_test import DakTestCase, fixture
-from daklib.gpg import GpgException, SignedFile
+from daklib.gpg import GpgException, SignedFile, SignedFileVerifier, _run_gpg
 
 keyring = fixture('gpg/gnupghome/pubring.gpg')
 fpr_valid = '0ABB89079CB58F8F94F6F310CB9D5C5828606E84'
@@ -69,5 +69,44 @@ class GpgTest(DakTestCase):
         with self.assertRaises(GpgException):
             verify('gpg/plaintext.txt')
 
+class SignedFileVerifierTest(DakTestCase):
+    files = ['gpg/valid.asc', 'gpg/expired.asc', 'gpg/expired-subkey.asc',
+             'gpg/message.asc', 'gpg/plaintext.txt']
+
+    def setUp(self):
+        self.verifier = SignedFileVerifier([keyring], workers=2)
+
+    def tearDown(self):
+        self.verifier.close()
+
+    def read(self, filename):
+        with open(fixture(filename)) as fh:
+            return fh.read()
+
+    def test_same_output(self):
+        for filename in self.files:
+            data = self.read(filename)
+            self.assertEqual(self.verifier.run(data), _run_gpg("/usr/bin/gpg", [keyring], data))
+
+    def test_verify_many(self):
+        datas = [ self.read(filename) for filename in self.files ]
+        results = self.verifier.verify_many(datas, require_signature=False)
+        self.assertEqual(len(results), len(datas))
+        for data, result in zip(datas, results):
+            try:
+                expected = SignedFile(data, [keyring], require_signature=False)
+            except GpgException as e:
+                self.assertTrue(isinstance(result, GpgException))
+                self.assertEqual(str(result), str(e))
+                continue
+            self.assertEqual(result.valid, expected.valid)
+            self.assertEqual(result.contents, expected.contents)
+            self.assertEqual(result.fingerprints, expected.fingerprints)
+
+    def test_different_keyrings(self):
+        data = self.read('gpg/valid.asc')
+        with self.assertRaises(ValueError):
+            SignedFile(data, [keyring, fixture('gpg/other.gpg')], verifier=self.verifier)
+
 if __name__ == '__main__':
     unittest.main()
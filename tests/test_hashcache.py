@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import gzip
+import hashlib
+import shutil
+import tempfile
+import unittest
+import os
+
+from daklib.filewriter import FileHashes
+from daklib.hashcache import HashCache, hash_fh
+
+class HashFhTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertHashes(self, hashes, data):
+        self.assertEqual(hashes.size, len(data))
+        self.assertEqual(hashes.md5sum, hashlib.md5(data).hexdigest())
+        self.assertEqual(hashes.sha1sum, hashlib.sha1(data).hexdigest())
+        self.assertEqual(hashes.sha256sum, hashlib.sha256(data).hexdigest())
+
+    def testEmpty(self):
+        filename = os.path.join(self.directory, 'empty')
+        open(filename, 'w').close()
+        with open(filename) as fh:
+            self.assertHashes(hash_fh(fh), '')
+
+    def testChunked(self):
+        data = ''.join('line {0}\n'.format(i) for i in range(10000))
+        filename = os.path.join(self.directory, 'data.gz')
+        with gzip.GzipFile(filename, 'w') as fh:
+            fh.write(data)
+        fh = gzip.GzipFile(filename, 'r')
+        self.assertHashes(hash_fh(fh, chunk_size=1000), data)
+        fh.close()
+
+class FakeResult(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+class FakeSession(object):
+    """
+    Keeps the rows of the file_hash_cache table in a dict and understands
+    the statements used by HashCache.
+    """
+    columns = ('source', 'source_inode', 'source_size', 'source_mtime_ns',
+               'size', 'md5sum', 'sha1sum', 'sha256sum')
+
+    def __init__(self):
+        self.rows = {}
+
+    def execute(self, statement, params):
+        if 'INSERT INTO' in statement:
+            for row in params:
+                self.rows[row['path']] = row
+        elif 'DELETE FROM' in statement:
+            for path in params['paths']:
+                self.rows.pop(path, None)
+        elif 'LIKE' in statement:
+            prefix = params['pattern'][:-1].replace('\\_', '_').replace('\\%', '%').replace('\\\\', '\\')
+            return FakeResult([(path,) + tuple(row[c] for c in self.columns)
+                               for path, row in sorted(self.rows.iteritems()) if path.startswith(prefix)])
+        else:
+            row = self.rows.get(params['path'])
+            return FakeResult([tuple(row[c] for c in self.columns)] if row is not None else [])
+
+class HashCacheTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.session = FakeSession()
+        self.opened = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def opener(self, filename, mode):
+        self.opened.append(filename)
+        return open(filename, mode)
+
+    def write(self, name, data):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as fh:
+            fh.write(data)
+        return filename
+
+    def hash_file(self, filename, prefix=None):
+        cache = HashCache(self.session, prefix)
+        hashes = cache.hash_file(filename, opener=self.opener)
+        cache.save()
+        return hashes
+
+    def testReuse(self):
+        filename = self.write('Packages', 'abc')
+        self.assertEqual(self.hash_file(filename).sha256sum, hashlib.sha256('abc').hexdigest())
+        self.assertEqual(self.hash_file(filename).sha256sum, hashlib.sha256('abc').hexdigest())
+        self.assertEqual(self.hash_file(filename, prefix=self.directory).size, 3)
+        self.assertEqual(self.opened, [filename])
+
+    def testChanged(self):
+        filename = self.write('Packages', 'abc')
+        self.hash_file(filename)
+
+        # size
+        self.write('Packages', 'abcd')
+        self.assertEqual(self.hash_file(filename).size, 4)
+        self.assertEqual(len(self.opened), 2)
+
+        # modification time
+        st = os.stat(filename)
+        os.utime(filename, (st.st_atime, st.st_mtime - 10))
+        self.hash_file(filename)
+        self.assertEqual(len(self.opened), 3)
+
+        # inode
+        st = os.stat(filename)
+        other = self.write('other', 'abcd')
+        os.utime(other, (st.st_atime, st.st_mtime))
+        os.rename(other, filename)
+        self.hash_file(filename)
+        self.assertEqual(len(self.opened), 4)
+
+        self.hash_file(filename)
+        self.assertEqual(len(self.opened), 4)
+
+    def testPrune(self):
+        a = self.write('a', 'a')
+        b = self.write('b', 'b')
+        outside = os.path.join(os.path.dirname(self.directory), 'outside')
+        cache = HashCache(self.session, self.directory)
+        cache.hash_file(a)
+        cache.hash_file(b)
+        cache.set(outside, FileHashes(0, '', '', ''), source=a)
+        cache.save()
+        self.assertEqual(sorted(self.session.rows), sorted([a, b, outside]))
+
+        # entries below the prefix that were not used are removed
+        cache = HashCache(self.session, self.directory)
+        cache.get(a)
+        cache.save(prune=True)
+        self.assertEqual(sorted(self.session.rows), sorted([a, outside]))
+
+    def testAddWrittenFiles(self):
+        data = 'Package: hello\n'
+        compressed = os.path.join(self.directory, 'Packages.gz')
+        with gzip.GzipFile(compressed, 'w') as fh:
+            fh.write(data)
+        uncompressed = os.path.join(self.directory, 'Packages')
+        # an old uncompressed file that was not written this time
+        with open(uncompressed, 'w') as fh:
+            fh.write('Package: old\n')
+        with open(compressed) as fh:
+            compressed_hashes = hash_fh(fh)
+        uncompressed_hashes = FileHashes(len(data), hashlib.md5(data).hexdigest(),
+                                         hashlib.sha1(data).hexdigest(), hashlib.sha256(data).hexdigest())
+
+        cache = HashCache(self.session)
+        cache.add_written_files({compressed: compressed_hashes, uncompressed: uncompressed_hashes},
+                                [compressed])
+        cache.save()
+
+        # the uncompressed file was not written, its entry depends on the
+        # compressed one
+        self.assertEqual(self.session.rows[uncompressed]['source'], compressed)
+        cache = HashCache(self.session, self.directory)
+        self.assertEqual(cache.get(uncompressed), uncompressed_hashes)
+        self.assertEqual(cache.get(compressed), compressed_hashes)
+
+        os.unlink(compressed)
+        self.assertEqual(HashCache(self.session).get(uncompressed), None)
+
+if __name__ == '__main__':
+    unittest.main()
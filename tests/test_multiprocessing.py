@@ -6,6 +6,7 @@ from daklib.dakmultiprocessing import DakProcessPool, \
                                       PROC_STATUS_SUCCESS,   PROC_STATUS_MISCFAILURE, \
                                       PROC_STATUS_EXCEPTION, PROC_STATUS_SIGNALRAISED
 import signal
+import sqlalchemy.orm.session
 
 def test_function(num, num2):
     from os import kill, getpid
@@ -22,6 +23,9 @@ def test_function(num, num2):
 
     return (PROC_STATUS_SUCCESS, 'blah, %d, %d' % (num, num2))
 
+def registered_sessions():
+    return (PROC_STATUS_SUCCESS, len(sqlalchemy.orm.session._sessions))
+
 class DakProcessPoolTestCase(DakTestCase):
     def testPool(self):
         def alarm_handler(signum, frame):
@@ -59,3 +63,14 @@ class DakProcessPoolTestCase(DakTestCase):
 
         for r in range(len(p.results)):
             self.assertEqual(p.results[r], expected[r])
+
+    def testInheritedSessions(self):
+        # workers must not close sessions of the parent process
+        session = sqlalchemy.orm.session.Session()
+        p = DakProcessPool(1)
+        p.apply_async(registered_sessions)
+        p.close()
+        p.join()
+        session.close()
+
+        self.assertEqual(p.results, [(PROC_STATUS_SUCCESS, 0)])
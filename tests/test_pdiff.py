@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import gzip
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from daklib.pdiff import write_patch, read_patch, merge_patches, write_hunks
+
+def apply_ed(lines, script):
+    """apply an ed script as produced by diff --ed to a list of lines"""
+    script = script.split('\n')[:-1]
+    pos = 0
+    while pos < len(script):
+        match = re.match(r'^(\d+)(?:,(\d+))?([acd])$', script[pos])
+        pos += 1
+        start, end, command = int(match.group(1)), match.group(2), match.group(3)
+        end = int(end) if end is not None else start
+        text = []
+        if command in 'ac':
+            while script[pos] != '.':
+                text.append(script[pos] + '\n')
+                pos += 1
+            pos += 1
+        if command == 'a':
+            lines[start:start] = text
+        else:
+            lines[start - 1:end] = text
+    return lines
+
+def stanza(name, version):
+    return 'Package: {0}\nVersion: {1}\nArchitecture: amd64\nDescription: {0}\n some text\n .\n more\n\n'.format(name, version)
+
+class WritePatchTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        filename = os.path.join(self.directory, name)
+        with gzip.GzipFile(filename, 'w') as fh:
+            fh.write(content)
+        return filename
+
+    def assertPatch(self, old, new, by_line=False):
+        old_filename = self.write('old.gz', old)
+        new_filename = self.write('new.gz', new)
+        patch_filename = os.path.join(self.directory, 'patch.gz')
+        result = write_patch(old_filename, new_filename, patch_filename, by_line=by_line)
+        if old == new:
+            self.assertEqual(result, None)
+            return None
+        script = gzip.GzipFile(patch_filename).read()
+        self.assertEqual(''.join(apply_ed(old.splitlines(True), script)), new)
+        self.assertEqual(result.old.size, len(old))
+        self.assertEqual(result.new.size, len(new))
+        self.assertEqual(result.patch.size, len(script))
+        self.assertEqual(result.patch_download.size, os.path.getsize(patch_filename))
+        return script
+
+    def testUnchanged(self):
+        content = stanza('a', '1') + stanza('b', '1')
+        self.assertPatch(content, content)
+
+    def testSmallChanges(self):
+        old = ''.join(stanza(n, '1') for n in 'abcdefgh')
+        self.assertPatch(old, old.replace(stanza('c', '1'), stanza('c', '2')))
+        self.assertPatch(old, old.replace(stanza('a', '1'), ''))
+        self.assertPatch(old, old.replace(stanza('h', '1'), ''))
+        self.assertPatch(old, stanza('0', '1') + old + stanza('z', '1'))
+        self.assertPatch(old, '')
+        self.assertPatch('', old)
+
+    def testOnlyChangedStanzaIsSent(self):
+        old = ''.join(stanza('pkg{0}'.format(i), '1') for i in range(100))
+        new = old.replace(stanza('pkg50', '1'), stanza('pkg50', '2'))
+        script = self.assertPatch(old, new)
+        self.assertEqual(script.count('\n.\n'), 1)
+        self.assertTrue('pkg49' not in script)
+
+    def testRandomChanges(self):
+        rnd = random.Random(42)
+        for run in range(20):
+            names = [ 'pkg{0}'.format(i) for i in range(200) ]
+            old = [ stanza(n, '1') for n in names ]
+            new = list(old)
+            for change in range(rnd.randint(1, 30)):
+                pos = rnd.randrange(len(new))
+                action = rnd.choice(['insert', 'delete', 'modify', 'duplicate'])
+                if action == 'insert':
+                    new.insert(pos, stanza('new{0}'.format(change), '1'))
+                elif action == 'delete':
+                    del new[pos]
+                elif action == 'modify':
+                    new[pos] = new[pos].replace('Version: 1', 'Version: 2')
+                else:
+                    new.insert(rnd.randrange(len(new)), new[pos])
+            self.assertPatch(''.join(old), ''.join(new))
+
+    def testLines(self):
+        old = ''.join('usr/bin/tool{0}    admin/pkg{0}\n'.format(i) for i in range(100))
+        new = old.replace('tool5 ', 'tool5a ').replace('admin/pkg7\n', 'admin/pkg7,admin/other\n')
+        self.assertPatch(old, new, by_line=True)
+
+    def testSingleDot(self):
+        # handled by falling back to diff --ed
+        old_filename = self.write('old.gz', 'a\n')
+        new_filename = self.write('new.gz', 'a\n.\n')
+        patch_filename = os.path.join(self.directory, 'patch.gz')
+        result = write_patch(old_filename, new_filename, patch_filename, by_line=True)
+        self.assertEqual(result.new.size, 4)
+        self.assertEqual(result.patch.size, len(gzip.GzipFile(patch_filename).read()))
+
+    def testMissingNewline(self):
+        self.assertRaises(subprocess.CalledProcessError, self.assertPatch, 'a\n', 'a\nb', True)
+
+class MergePatchesTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def patch(self, old, new, name):
+        filenames = []
+        for suffix, content in (('old', old), ('new', new)):
+            filename = os.path.join(self.directory, '{0}.{1}'.format(name, suffix))
+            with open(filename, 'w') as fh:
+                fh.write(content)
+            filenames.append(filename)
+        patch_filename = os.path.join(self.directory, name + '.gz')
+        write_patch(filenames[0], filenames[1], patch_filename)
+        return read_patch(patch_filename)
+
+    def testRandomVersions(self):
+        rnd = random.Random(23)
+        names = [ 'pkg{0}'.format(i) for i in range(100) ]
+        versions = [ [ stanza(n, '1') for n in names ] ]
+        for run in range(8):
+            new = list(versions[-1])
+            for change in range(rnd.randint(1, 10)):
+                pos = rnd.randrange(len(new) + 1)
+                action = rnd.choice(['insert', 'delete', 'modify'])
+                if action == 'insert' or pos == len(new):
+                    new.insert(pos, stanza('new{0}_{1}'.format(run, change), '1'))
+                elif action == 'delete':
+                    del new[pos]
+                else:
+                    new[pos] = new[pos].replace('Version: 1', 'Version: 2')
+            versions.append(new)
+        versions = [ ''.join(v) for v in versions ]
+
+        merged = self.patch(versions[0], versions[1], 'p0')
+        for i in range(1, len(versions) - 1):
+            merged = merge_patches(merged, self.patch(versions[i], versions[i + 1], 'p{0}'.format(i)))
+
+        filename = os.path.join(self.directory, 'merged.gz')
+        patch, download = write_hunks(merged, filename)
+        script = gzip.GzipFile(filename).read()
+        self.assertEqual(patch.size, len(script))
+        self.assertEqual(''.join(apply_ed(versions[0].splitlines(True), script)), versions[-1])
+
+    def testDeleteAll(self):
+        old = stanza('a', '1') + stanza('b', '1')
+        merged = merge_patches(self.patch(old, stanza('a', '1'), 'p0'), self.patch(stanza('a', '1'), '', 'p1'))
+        self.assertEqual(merged, [(0, 16, [])])
+
+if __name__ == '__main__':
+    unittest.main()
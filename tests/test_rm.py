@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import unittest
+
+import daklib.rm
+from daklib.depsnapshot import DependencySnapshot, _Relations
+from daklib.rm import ReverseDependencyChecker
+
+class FakeArchitecture(object):
+    def __init__(self, arch_id, arch_string):
+        self.arch_id = arch_id
+        self.arch_string = arch_string
+
+def depends(*clauses):
+    return [[(name, '', '') for name in clause] for clause in clauses]
+
+class ReverseDependencyCheckerTestCase(DakTestCase):
+    """
+    This TestCase checks the results of the indexed reverse dependency
+    check. The expected results are those of the previous implementation
+    that looked at the dependencies of every package in the suite.
+    """
+
+    def setUp(self):
+        snapshot = DependencySnapshot('unstable', 'key')
+        for arch in ('amd64', 'i386'):
+            binaries = snapshot.binaries[arch] = _Relations()
+            snapshot._add(binaries, 'libfoo1', 'foo', 'main', [], ['libfoo-abi-1'])
+            snapshot._add(binaries, 'foo-bin', 'foo', 'main', depends(['libfoo1']), [])
+            snapshot._add(binaries, 'mta-a', 'mta-a', 'main', [], ['mail-transport-agent'])
+            snapshot._add(binaries, 'mailer', 'mailer', 'main',
+                          depends(['mail-transport-agent', 'mta-a'], ['libbar1', 'libfoo1']), [])
+        snapshot._add(snapshot.binaries['amd64'], 'mta-b', 'mta-b', 'main', [], ['mail-transport-agent'])
+        binaries = snapshot.binaries['all'] = _Relations()
+        snapshot._add(binaries, 'foo-doc', 'foo', 'main', depends(['foo-bin']), [])
+        snapshot._add(binaries, 'plugin', 'plugin', 'main', depends(['libfoo-abi-1']), [])
+        snapshot._add(snapshot.sources, 'mailer', None, None, depends(['mta-a']), [])
+        snapshot._add(snapshot.sources, 'plugin', None, None, depends(['libfoo1', 'libbar1'], ['foo-bin']), [])
+
+        architectures = [FakeArchitecture(i, arch) for i, arch in enumerate(('source', 'all', 'amd64', 'i386'))]
+        self.old_functions = daklib.rm.get_suite, daklib.rm.get_suite_architectures, daklib.rm.load_snapshot
+        daklib.rm.get_suite = lambda suite, session: suite
+        daklib.rm.get_suite_architectures = lambda suite: architectures
+        daklib.rm.load_snapshot = lambda session, suite: snapshot
+        self.checker = ReverseDependencyChecker(None, 'unstable')
+
+    def tearDown(self):
+        daklib.rm.get_suite, daklib.rm.get_suite_architectures, daklib.rm.load_snapshot = self.old_functions
+
+    def assertProblems(self, removal_requests, expected):
+        self.assertEqual(dict(self.checker.check_reverse_depends(removal_requests)), expected)
+
+    def test_depends(self):
+        self.assertProblems({'foo-bin': None}, {
+            ('foo-bin', 'amd64'): set([('foo-doc', 'amd64'), ('plugin', 'source')]),
+            ('foo-bin', 'i386'): set([('foo-doc', 'i386'), ('plugin', 'source')]),
+        })
+        self.assertProblems({'foo-bin': ['amd64']}, {
+            ('foo-bin', 'amd64'): set([('foo-doc', 'amd64'), ('plugin', 'source')]),
+        })
+        # removing the reverse dependencies as well breaks nothing
+        self.assertProblems({'foo-bin': None, 'foo-doc': None, 'plugin': None}, {})
+
+    def test_virtual(self):
+        # libfoo1 is the only package providing libfoo-abi-1
+        self.assertProblems({'libfoo1': None}, {
+            ('libfoo1', 'amd64'): set([('foo-bin', 'amd64'), ('plugin', 'amd64')]),
+            ('libfoo1', 'i386'): set([('foo-bin', 'i386'), ('plugin', 'i386')]),
+        })
+        # mta-b still provides mail-transport-agent on amd64
+        self.assertProblems({'mta-a': ['amd64', 'i386']}, {
+            ('mta-a', 'i386'): set([('mailer', 'i386'), ('mailer', 'source')]),
+            ('mta-a', 'amd64'): set([('mailer', 'source')]),
+        })
+        self.assertProblems({'mta-a': ['amd64'], 'mta-b': ['amd64']}, {
+            ('mta-a', 'amd64'): set([('mailer', 'amd64'), ('mailer', 'source')]),
+        })
+
+    def test_build_depends(self):
+        # another alternative still satisfies the build-dependency
+        self.assertProblems({'libbar1': None}, {})
+        self.assertProblems({'libfoo1': ['i386'], 'libbar1': ['i386']}, {
+            ('libfoo1', 'i386'): set([('foo-bin', 'i386'), ('mailer', 'i386'), ('plugin', 'i386'),
+                                      ('plugin', 'source')]),
+            ('libbar1', 'i386'): set([('mailer', 'i386'), ('plugin', 'source')]),
+        })
+        # removing the source package does not break its own build-dependencies
+        self.assertProblems({'mta-a': None, 'mailer': ['source']}, {
+            ('mta-a', 'i386'): set([('mailer', 'i386')]),
+        })
+
+    def test_arch_all(self):
+        self.assertProblems({'foo-doc': ['all']}, {})
+        self.assertProblems({'foo-doc': ['all'], 'foo-bin': ['all']}, {
+            ('foo-bin', 'amd64'): set([('plugin', 'source')]),
+            ('foo-bin', 'i386'): set([('plugin', 'source')]),
+        })
+        self.assertProblems({'foo-doc': ['source']}, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import daklib.upload
+from daklib.upload import FileDoesNotExist, HashedFile, InvalidHashException, \
+    UploadFileCache
+
+class UploadFileCacheTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hashed = []
+        self.old_hash_file = daklib.upload._hash_file
+        def hash_file(path):
+            self.hashed.append(os.path.basename(path))
+            return self.old_hash_file(path)
+        daklib.upload._hash_file = hash_file
+
+    def tearDown(self):
+        daklib.upload._hash_file = self.old_hash_file
+        shutil.rmtree(self.directory)
+
+    def write(self, filename, data):
+        with open(os.path.join(self.directory, filename), 'w') as fh:
+            fh.write(data)
+
+    def hashed_file(self, filename, data):
+        return HashedFile(filename, len(data), hashlib.md5(data).hexdigest(),
+                          hashlib.sha1(data).hexdigest(), hashlib.sha256(data).hexdigest())
+
+    def testHashesReused(self):
+        self.write('hello_1.0.dsc', 'dsc')
+        cache = UploadFileCache(self.directory)
+        hashes = cache.hashes('hello_1.0.dsc')
+        self.assertEqual(hashes.size, 3)
+        self.assertEqual(hashes.sha256sum, hashlib.sha256('dsc').hexdigest())
+        self.assertEqual(cache.hashes('hello_1.0.dsc'), hashes)
+        self.hashed_file('hello_1.0.dsc', 'dsc').check(self.directory, cache)
+        self.assertEqual(self.hashed, ['hello_1.0.dsc'])
+
+    def testHashesInvalidated(self):
+        self.write('hello_1.0.dsc', 'dsc')
+        cache = UploadFileCache(self.directory)
+        cache.hashes('hello_1.0.dsc')
+        self.write('hello_1.0.dsc', 'changed dsc')
+        hashes = cache.hashes('hello_1.0.dsc')
+        self.assertEqual(hashes.size, 11)
+        self.assertEqual(hashes.md5sum, hashlib.md5('changed dsc').hexdigest())
+        self.assertEqual(self.hashed, ['hello_1.0.dsc', 'hello_1.0.dsc'])
+        self.assertRaises(InvalidHashException,
+                          self.hashed_file('hello_1.0.dsc', 'dsc').check, self.directory, cache)
+
+        os.unlink(os.path.join(self.directory, 'hello_1.0.dsc'))
+        self.assertRaises(FileDoesNotExist, cache.hashes, 'hello_1.0.dsc')
+
+    def testHashFiles(self):
+        for workers in (1, 4):
+            cache = UploadFileCache(self.directory)
+            self.hashed = []
+            filenames = ['hello_1.0.dsc', 'hello_1.0.tar.gz', 'hello_1.0_amd64.deb']
+            for filename in filenames:
+                self.write(filename, filename)
+            cache.hash_files(filenames + ['missing.diff.gz'], workers)
+            self.assertEqual(sorted(self.hashed), filenames)
+            for filename in filenames:
+                self.assertEqual(cache.hashes(filename).sha1sum, hashlib.sha1(filename).hexdigest())
+            self.assertEqual(sorted(self.hashed), filenames)
+            self.assertRaises(FileDoesNotExist, cache.hashes, 'missing.diff.gz')
+
+    def testCheckOtherDirectory(self):
+        self.write('hello_1.0.dsc', 'dsc')
+        cache = UploadFileCache(self.directory)
+        hashed_file = self.hashed_file('hello_1.0.dsc', 'dsc')
+        hashed_file.check(self.directory + '/', cache)
+        self.assertRaises(ValueError, hashed_file.check, os.path.dirname(self.directory), cache)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# (c) 2016 Debian FTP Masters <ftpmaster@debian.org>
+# Free software licensed under the GPL version 2 or later
+
+"""Compare verifying signed files with SignedFile and SignedFileVerifier
+
+Usage: benchmark-gpg.py [-n ROUNDS] [-w WORKERS] [-m MB] -k KEYRING... FILE...
+
+Every FILE is verified ROUNDS times, first by forking gpg from this process
+for every file, then with a SignedFileVerifier using WORKERS helper
+processes. With -m, MB megabytes of memory are allocated first to simulate
+a large dak process. The results of both methods are compared.
+"""
+
+import getopt
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from daklib.gpg import GpgException, SignedFile, SignedFileVerifier
+
+def result_of(result):
+    if isinstance(result, GpgException):
+        return ('error', str(result))
+    return (result.valid, result.contents, result.fingerprints, result.signature_ids)
+
+def main():
+    options, filenames = getopt.getopt(sys.argv[1:], 'n:w:m:k:')
+    rounds = 10
+    workers = 4
+    memory = 0
+    keyrings = []
+    for option, value in options:
+        if option == '-n':
+            rounds = int(value)
+        elif option == '-w':
+            workers = int(value)
+        elif option == '-m':
+            memory = int(value)
+        elif option == '-k':
+            keyrings.append(os.path.abspath(value))
+    if not keyrings or not filenames:
+        print __doc__
+        sys.exit(1)
+
+    ballast = [ bytearray(1024 * 1024) for i in range(memory) ]
+    datas = [ open(f).read() for f in filenames ] * rounds
+
+    start = time.time()
+    forked = []
+    for data in datas:
+        try:
+            forked.append(SignedFile(data, keyrings, require_signature=False))
+        except GpgException as e:
+            forked.append(e)
+    forked_time = time.time() - start
+
+    start = time.time()
+    with SignedFileVerifier(keyrings, workers=workers) as verifier:
+        pooled = verifier.verify_many(datas, require_signature=False)
+    pooled_time = time.time() - start
+
+    same = [ result_of(a) for a in forked ] == [ result_of(b) for b in pooled ]
+    print 'files verified:      %d' % len(datas)
+    print 'fork per file:       %.3fs (%.2fms per file)' % (forked_time, forked_time * 1000 / len(datas))
+    print 'verifier (%2d jobs):  %.3fs (%.2fms per file)' % (workers, pooled_time, pooled_time * 1000 / len(datas))
+    print 'identical results:   %s' % same
+    if not same:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()